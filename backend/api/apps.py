@@ -1,5 +1,15 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.signals import request_started
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from backend.routers import check_connections
+
+        request_started.connect(check_connections)
+        if settings.PROFILING_ENABLED:
+            from api.profiling import instrument_serializers
+            instrument_serializers()
@@ -1,23 +1,71 @@
+from django.conf import settings
+from django.db import connections
+from django.db.models import BooleanField, F, FloatField, Func, Q, Value
 from django_filters.rest_framework import FilterSet, filters
-from rest_framework.filters import SearchFilter
+from rest_framework.filters import BaseFilterBackend
 
-from recipes.models import Recipe, Tag
+from recipes.models import Ingredient, Recipe
+from recipes.reference import ingredients, tags
 
 
-class IngredientsFilter(SearchFilter):
+class TrigramMatch(Func):
+    arity = 2
+    output_field = BooleanField()
+
+    def as_sql(self, compiler, connection):
+        field, value = (compiler.compile(expression)
+                        for expression in self.source_expressions)
+        return (f'UPPER({field[0]}::text) %% UPPER({value[0]})',
+                field[1] + value[1])
+
+
+class IngredientsFilter(BaseFilterBackend):
     search_param = 'name'
 
+    def filter_queryset(self, request, queryset, view):
+        name = request.query_params.get(self.search_param, '').strip()
+        if not name or view.detail:
+            return queryset
+        limit = settings.INGREDIENTS_SEARCH_LIMIT
+        results = ingredients.load().startswith(name, limit)
+        # Короткую подстроку не обслуживает ни один индекс: для неё
+        # остаются только совпадения с начала названия.
+        if (len(results) == limit
+                or len(name) < settings.INGREDIENTS_SEARCH_MIN_SUBSTRING):
+            return results
+        matches = Q(name__icontains=name)
+        queryset = Ingredient.objects.all()
+        ordering = ('name',)
+        if (settings.INGREDIENTS_SEARCH_TRIGRAM
+                and connections[queryset.db].vendor == 'postgresql'):
+            matches |= Q(TrigramMatch('name', Value(name)))
+            queryset = queryset.annotate(similarity=Func(
+                F('name'), Value(name), function='SIMILARITY',
+                output_field=FloatField()))
+            ordering = ('-similarity', 'name')
+        return results + list(queryset.filter(matches).exclude(
+            name__istartswith=name).order_by(*ordering).values(
+            *ingredients.fields)[:limit - len(results)])
+
+
+def get_tag_choices():
+    return [(tag['slug'], tag['name']) for tag in tags.load().items]
+
 
 class RecipeFilter(FilterSet):
     is_favorited = filters.BooleanFilter(method='get_is_favorited')
     is_in_shopping_cart = filters.BooleanFilter(
         method='get_is_in_shopping_cart'
     )
-    tags = filters.ModelMultipleChoiceFilter(
-        queryset=Tag.objects.all(),
-        field_name='tags__slug',
-        to_field_name='slug'
+    tags = filters.MultipleChoiceFilter(
+        choices=get_tag_choices,
+        field_name='tags__slug'
+    )
+    ordering = filters.ChoiceFilter(
+        choices=(('popular', 'По популярности'),),
+        method='get_ordering'
     )
+    search = filters.CharFilter(method='get_search')
 
     class Meta:
         model = Recipe
@@ -32,3 +80,11 @@ class RecipeFilter(FilterSet):
         if not value:
             return queryset
         return queryset.filter(favorites__user=self.request.user)
+
+    def get_search(self, queryset, name, value):
+        if not value.strip():
+            return queryset
+        return queryset.search(value)
+
+    def get_ordering(self, queryset, name, value):
+        return queryset.order_by('-favorites_count', '-pub_date', '-id')
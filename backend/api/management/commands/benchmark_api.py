@@ -0,0 +1,472 @@
+import base64
+import io
+import json
+import math
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import (CaptureQueriesContext, override_settings,
+                               setup_test_environment,
+                               teardown_test_environment)
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from api.pagination import RecipesPagination
+from api.query_plans import find_seq_scans
+from api.urls import router
+from backend.settings import BASE_DIR
+from recipes import pantry
+from recipes.models import (Cart, Favorite, Ingredient, IngredientRecipe,
+                            Recipe, ShoppingListItem, Tag)
+from recipes.recommendations import RecommendationBuilder
+from users.models import Subscription, User
+
+BUDGETS_PATH = BASE_DIR / 'data' / 'query_budgets.json'
+BATCH_SIZE = 1000
+PASSWORD = 'benchmark-password'
+LATENCY_HEADROOM = 3
+LATENCY_FLOOR_MS = 50
+# PBKDF2 при создании пользователя и смене пароля занимает больше времени,
+# чем сам эндпоинт: на время прогона хешер заменяется быстрым.
+FAST_PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+# На маленьких таблицах полный просмотр дешевле индекса, и планировщик
+# выбирает его: планы проверяются только на данных не меньше этих.
+PLAN_CHECK_MIN_USERS = 1000
+PLAN_CHECK_MIN_RECIPES = 10000
+
+
+def make_image():
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), '#E26C2D').save(buffer, 'PNG')
+    return ('data:image/png;base64,'
+            + base64.b64encode(buffer.getvalue()).decode())
+
+
+class Command(BaseCommand):
+    help = ('Наполняет тестовую базу синтетическими данными, вызывает '
+            'каждый эндпоинт API и сверяет число запросов и время ответа '
+            'с сохранёнными бюджетами')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--recipes', type=int, default=20000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--budgets', default=str(BUDGETS_PATH))
+        parser.add_argument('--write-budgets', action='store_true',
+                            help='Сохранить текущие результаты как бюджеты')
+        parser.add_argument('--output', help='Файл для JSON-отчёта')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Не удалять тестовую базу после прогона')
+        parser.add_argument(
+            '--strict-latency', action='store_true',
+            help='Считать ошибкой и превышение бюджета времени ответа')
+
+    @override_settings(PASSWORD_HASHERS=FAST_PASSWORD_HASHERS,
+                       CACHE_SINGLE_PROCESS=True)
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        # Загруженные изображения и их копии не попадают в MEDIA_ROOT.
+        media_root = tempfile.mkdtemp()
+        try:
+            with override_settings(MEDIA_ROOT=media_root):
+                if not Recipe.objects.exists():
+                    self.seed(options['users'], options['recipes'])
+                # Как воркер при запуске с PANTRY_WARM_UP.
+                pantry.index.warm()
+                check_plans = (
+                    User.objects.count() >= PLAN_CHECK_MIN_USERS
+                    and Recipe.objects.count() >= PLAN_CHECK_MIN_RECIPES)
+                results = self.run_cases(options['repeat'], check_plans)
+        finally:
+            connection.creation.destroy_test_db(
+                old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        self.report(results)
+        if not check_plans:
+            self.stdout.write(self.style.WARNING(
+                f'Планы запросов не проверялись: нужно не меньше '
+                f'{PLAN_CHECK_MIN_USERS} пользователей и '
+                f'{PLAN_CHECK_MIN_RECIPES} рецептов'))
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(results, file, ensure_ascii=False, indent=2)
+        if options['write_budgets']:
+            self.write_budgets(options['budgets'], results)
+            return
+        self.check_budgets(options['budgets'], results,
+                           options['strict_latency'])
+
+    def seed(self, users_count, recipes_count):
+        started = time.perf_counter()
+        password = make_password(PASSWORD)
+        User.objects.bulk_create(
+            (User(username=f'user{i}', email=f'user{i}@foodgram.ru',
+                  first_name=f'Имя{i}', last_name=f'Фамилия{i}',
+                  password=password) for i in range(users_count)),
+            batch_size=BATCH_SIZE)
+        user_ids = list(User.objects.values_list('id', flat=True))
+
+        Tag.objects.bulk_create(
+            Tag(name=f'Тег {i}', slug=f'tag{i}', color=f'#{i:06X}')
+            for i in range(10))
+        tag_ids = list(Tag.objects.values_list('id', flat=True))
+
+        with open(BASE_DIR / 'data' / 'ingredients.json', 'rb') as file:
+            Ingredient.objects.bulk_create(
+                (Ingredient(**ingredient) for ingredient in json.load(file)),
+                batch_size=BATCH_SIZE)
+        ingredient_ids = list(Ingredient.objects.values_list('id', flat=True))
+
+        Recipe.objects.bulk_create(
+            (Recipe(name=f'Рецепт {i}', text=f'Описание рецепта {i}',
+                    image='recipes/benchmark.png',
+                    author_id=random.choice(user_ids),
+                    cooking_time=random.randint(1, 180))
+             for i in range(recipes_count)),
+            batch_size=BATCH_SIZE)
+        recipe_ids = list(Recipe.objects.values_list('id', flat=True))
+
+        Recipe.tags.through.objects.bulk_create(
+            (Recipe.tags.through(recipe_id=recipe_id, tag_id=tag_id)
+             for recipe_id in recipe_ids
+             for tag_id in random.sample(tag_ids, random.randint(1, 3))),
+            batch_size=BATCH_SIZE)
+        IngredientRecipe.objects.bulk_create(
+            (IngredientRecipe(recipe_id=recipe_id, ingredient_id=ingredient_id,
+                              amount=random.randint(1, 999))
+             for recipe_id in recipe_ids
+             for ingredient_id in random.sample(ingredient_ids,
+                                                random.randint(3, 12))),
+            batch_size=BATCH_SIZE)
+        Recipe.objects.update_search_index()
+
+        main_user = user_ids[0]
+        Favorite.objects.bulk_create(
+            (Favorite(user_id=main_user, recipe_id=recipe_id)
+             for recipe_id in random.sample(recipe_ids,
+                                            min(200, len(recipe_ids)))),
+            batch_size=BATCH_SIZE)
+        Favorite.objects.bulk_create(
+            (Favorite(user_id=user_id, recipe_id=recipe_id)
+             for user_id in random.sample(user_ids[1:], len(user_ids) // 2)
+             for recipe_id in random.sample(recipe_ids,
+                                            min(10, len(recipe_ids)))),
+            batch_size=BATCH_SIZE)
+        Cart.objects.bulk_create(
+            (Cart(user_id=main_user, recipe_id=recipe_id)
+             for recipe_id in random.sample(recipe_ids,
+                                            min(40, len(recipe_ids)))),
+            batch_size=BATCH_SIZE)
+        Cart.objects.bulk_create(
+            (Cart(user_id=user_id, recipe_id=recipe_id)
+             for user_id in random.sample(user_ids[1:], len(user_ids) // 4)
+             for recipe_id in random.sample(recipe_ids,
+                                            min(5, len(recipe_ids)))),
+            batch_size=BATCH_SIZE)
+        Recipe.objects.recount()
+        ShoppingListItem.objects.rebuild(User.objects.values('id'))
+        Subscription.objects.bulk_create(
+            (Subscription(user_id=main_user, author_id=author_id)
+             for author_id in random.sample(user_ids[1:],
+                                            min(200, len(user_ids) // 2))),
+            batch_size=BATCH_SIZE)
+        Subscription.objects.bulk_create(
+            (Subscription(user_id=user_id, author_id=author_id)
+             for user_id in random.sample(user_ids[1:], len(user_ids) // 2)
+             for author_id in random.sample(user_ids, 5)
+             if author_id != user_id),
+            batch_size=BATCH_SIZE)
+        RecommendationBuilder().build()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.stdout.write(
+            f'Данные созданы за {time.perf_counter() - started:.1f} с: '
+            f'{len(user_ids)} пользователей, {len(recipe_ids)} рецептов, '
+            f'{len(ingredient_ids)} ингредиентов')
+
+    def get_cases(self):
+        user = User.objects.order_by('id').first()
+        token, _ = Token.objects.get_or_create(user=user)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        anonymous = APIClient()
+
+        own_recipe = Recipe.objects.filter(author=user).first()
+        if own_recipe is None:
+            own_recipe = Recipe.objects.order_by('id').first()
+            own_recipe.author = user
+            own_recipe.save()
+        recipe = Recipe.objects.exclude(favorites__user=user).exclude(
+            carts__user=user).order_by('id').first()
+        favorite = Recipe.objects.filter(favorites__user=user).first()
+        cart = Recipe.objects.filter(carts__user=user).first()
+        bulk_payload = {'recipes': list(Recipe.objects.exclude(
+            favorites__user=user).exclude(carts__user=user).order_by(
+            'id').values_list('id', flat=True)[:20])}
+        favorites_payload = {'recipes': list(Recipe.objects.filter(
+            favorites__user=user).values_list('id', flat=True)[:20])}
+        cart_payload = {'recipes': list(Recipe.objects.filter(
+            carts__user=user).values_list('id', flat=True)[:20])}
+        author = User.objects.exclude(id=user.id).exclude(
+            author_subscriptions__user=user).order_by('id').first()
+        followed = User.objects.filter(author_subscriptions__user=user).first()
+        tag = Tag.objects.order_by('id').first()
+        ingredient = Ingredient.objects.order_by('id').first()
+        recipes_count = Recipe.objects.count()
+        deep_recipe = Recipe.objects.order_by('-pub_date', '-id')[
+            max(recipes_count - 20, 0)]
+        deep_cursor = RecipesPagination().encode_cursor('n', deep_recipe)
+        ingredient_ids = list(Ingredient.objects.order_by('id').values_list(
+            'id', flat=True)[:10])
+
+        recipe_payload = {
+            'name': 'Новый рецепт',
+            'text': 'Описание нового рецепта',
+            'image': make_image(),
+            'cooking_time': 30,
+            'tags': [tag.id],
+            'ingredients': [{'id': ingredient_id, 'amount': 10}
+                            for ingredient_id in ingredient_ids],
+        }
+        user_payload = {
+            'username': 'benchmark', 'email': 'benchmark@foodgram.ru',
+            'first_name': 'Имя', 'last_name': 'Фамилия',
+            'password': 'Sup3r-secret-pass',
+        }
+        tag_payload = {'name': 'Новый тег', 'slug': 'new-tag',
+                       'color': '#ABCDEF'}
+        ingredient_payload = {'name': 'новый ингредиент',
+                              'measurement_unit': 'г'}
+
+        return [
+            ('recipes-list', 'recipes', 'list', client, 'get',
+             '/api/recipes/?limit=10', None),
+            ('recipes-list-anonymous', 'recipes', 'list', anonymous, 'get',
+             '/api/recipes/?limit=10', None),
+            ('recipes-list-filtered', 'recipes', 'list', client, 'get',
+             f'/api/recipes/?limit=10&tags={tag.slug}&is_favorited=1', None),
+            ('recipes-list-cart', 'recipes', 'list', client, 'get',
+             '/api/recipes/?limit=100&is_in_shopping_cart=1', None),
+            ('recipes-list-popular', 'recipes', 'list', client, 'get',
+             '/api/recipes/?limit=10&ordering=popular', None),
+            ('recipes-list-search', 'recipes', 'list', client, 'get',
+             f'/api/recipes/?limit=10&search={ingredient.name}', None),
+            ('recipes-list-deep-page', 'recipes', 'list', client, 'get',
+             f'/api/recipes/?limit=10&page={recipes_count // 10}', None),
+            ('recipes-list-deep-cursor', 'recipes', 'list', client, 'get',
+             f'/api/recipes/?limit=10&count=false&cursor={deep_cursor}',
+             None),
+            ('recipes-create', 'recipes', 'create', client, 'post',
+             '/api/recipes/', recipe_payload),
+            ('recipes-retrieve', 'recipes', 'retrieve', client, 'get',
+             f'/api/recipes/{recipe.id}/', None),
+            ('recipes-update', 'recipes', 'update', client, 'put',
+             f'/api/recipes/{own_recipe.id}/', recipe_payload),
+            ('recipes-partial-update', 'recipes', 'partial_update', client,
+             'patch', f'/api/recipes/{own_recipe.id}/', recipe_payload),
+            ('recipes-destroy', 'recipes', 'destroy', client, 'delete',
+             f'/api/recipes/{own_recipe.id}/', None),
+            ('recipes-favorite-add', 'recipes', 'favorite', client, 'post',
+             f'/api/recipes/{recipe.id}/favorite/', None),
+            ('recipes-favorite-remove', 'recipes', 'favorite', client,
+             'delete', f'/api/recipes/{favorite.id}/favorite/', None),
+            ('recipes-cart-add', 'recipes', 'shopping_cart', client, 'post',
+             f'/api/recipes/{recipe.id}/shopping_cart/', None),
+            ('recipes-cart-remove', 'recipes', 'shopping_cart', client,
+             'delete', f'/api/recipes/{cart.id}/shopping_cart/', None),
+            ('recipes-cart-servings', 'recipes', 'shopping_cart', client,
+             'patch', f'/api/recipes/{cart.id}/shopping_cart/',
+             {'servings': 2}),
+            ('recipes-favorite-bulk-add', 'recipes', 'favorite_bulk', client,
+             'post', '/api/recipes/favorite/', bulk_payload),
+            ('recipes-favorite-bulk-remove', 'recipes', 'favorite_bulk',
+             client, 'delete', '/api/recipes/favorite/', favorites_payload),
+            ('recipes-cart-bulk-add', 'recipes', 'shopping_cart_bulk', client,
+             'post', '/api/recipes/shopping_cart/', bulk_payload),
+            ('recipes-what-can-i-cook', 'recipes', 'what_can_i_cook',
+             anonymous, 'get', '/api/recipes/what_can_i_cook/?' + '&'.join(
+                 f'ingredients={ingredient_id}'
+                 for ingredient_id in ingredient_ids), None),
+            ('recipes-recommendations', 'recipes', 'recommendations',
+             client, 'get', '/api/recipes/recommendations/?limit=10', None),
+            ('recipes-shopping-list', 'recipes', 'shopping_list', client,
+             'get', '/api/recipes/shopping_list/', None),
+            ('recipes-cart-bulk-remove', 'recipes', 'shopping_cart_bulk',
+             client, 'delete', '/api/recipes/shopping_cart/', cart_payload),
+            ('recipes-cart-clear', 'recipes', 'clear_shopping_cart', client,
+             'delete', '/api/recipes/shopping_cart/clear/', None),
+            ('recipes-download-shopping-cart', 'recipes',
+             'download_shopping_cart', client, 'get',
+             '/api/recipes/download_shopping_cart/', None),
+            ('recipes-download-shopping-cart-csv', 'recipes',
+             'download_shopping_cart', client, 'get',
+             '/api/recipes/download_shopping_cart/?type=csv', None),
+            ('recipes-download-shopping-cart-pdf', 'recipes',
+             'download_shopping_cart', client, 'get',
+             '/api/recipes/download_shopping_cart/?type=pdf', None),
+            ('users-list', 'users', 'list', client, 'get',
+             '/api/users/?limit=10', None),
+            ('users-create', 'users', 'create', anonymous, 'post',
+             '/api/users/', user_payload),
+            ('users-me', 'users', 'me', client, 'get', '/api/users/me/', None),
+            ('users-set-password', 'users', 'set_password', client, 'post',
+             '/api/users/set_password/',
+             {'current_password': PASSWORD,
+              'new_password': 'An0ther-secret-pass'}),
+            ('users-subscriptions', 'users', 'subscriptions', client, 'get',
+             '/api/users/subscriptions/?limit=10&recipes_limit=3', None),
+            ('users-retrieve', 'users', 'retrieve', client, 'get',
+             f'/api/users/{author.id}/', None),
+            ('users-update', 'users', 'update', client, 'put',
+             f'/api/users/{user.id}/', user_payload),
+            ('users-partial-update', 'users', 'partial_update', client,
+             'patch', f'/api/users/{user.id}/', {'first_name': 'Другое'}),
+            ('users-destroy', 'users', 'destroy', client, 'delete',
+             f'/api/users/{author.id}/', None),
+            ('users-subscribe', 'users', 'subscribe', client, 'post',
+             f'/api/users/{author.id}/subscribe/', None),
+            ('users-unsubscribe', 'users', 'subscribe', client, 'delete',
+             f'/api/users/{followed.id}/subscribe/', None),
+            ('tags-list', 'tags', 'list', anonymous, 'get', '/api/tags/',
+             None),
+            ('tags-create', 'tags', 'create', client, 'post', '/api/tags/',
+             tag_payload),
+            ('tags-retrieve', 'tags', 'retrieve', anonymous, 'get',
+             f'/api/tags/{tag.id}/', None),
+            ('tags-update', 'tags', 'update', client, 'put',
+             f'/api/tags/{tag.id}/', tag_payload),
+            ('tags-partial-update', 'tags', 'partial_update', client, 'patch',
+             f'/api/tags/{tag.id}/', {'name': 'Другой тег'}),
+            ('tags-destroy', 'tags', 'destroy', client, 'delete',
+             f'/api/tags/{tag.id}/', None),
+            ('ingredients-list', 'ingredients', 'list', anonymous, 'get',
+             '/api/ingredients/', None),
+            ('ingredients-search', 'ingredients', 'list', anonymous, 'get',
+             '/api/ingredients/?name=аб', None),
+            ('ingredients-search-substring', 'ingredients', 'list', anonymous,
+             'get', '/api/ingredients/?name=Kahlua', None),
+            ('ingredients-create', 'ingredients', 'create', client, 'post',
+             '/api/ingredients/', ingredient_payload),
+            ('ingredients-retrieve', 'ingredients', 'retrieve', anonymous,
+             'get', f'/api/ingredients/{ingredient.id}/', None),
+            ('ingredients-update', 'ingredients', 'update', client, 'put',
+             f'/api/ingredients/{ingredient.id}/', ingredient_payload),
+            ('ingredients-partial-update', 'ingredients', 'partial_update',
+             client, 'patch', f'/api/ingredients/{ingredient.id}/',
+             {'measurement_unit': 'кг'}),
+            ('ingredients-destroy', 'ingredients', 'destroy', client,
+             'delete', f'/api/ingredients/{ingredient.id}/', None),
+        ]
+
+    def check_coverage(self, cases):
+        covered = {(basename, action, method)
+                   for _, basename, action, _, method, _, _ in cases}
+        missing = [
+            f'{basename} {method.upper()} {action}'
+            for _, viewset, basename in router.registry
+            for route in router.get_routes(viewset)
+            for method, action in route.mapping.items()
+            if (basename, action, method) not in covered
+        ]
+        if missing:
+            raise CommandError('Нет сценариев для эндпоинтов: '
+                               + ', '.join(missing))
+
+    def run_cases(self, repeat, check_plans=True):
+        cases = self.get_cases()
+        self.check_coverage(cases)
+        results = {}
+        for name, _, _, client, method, url, data in cases:
+            queries = []
+            timings = []
+            for _ in range(repeat):
+                with transaction.atomic():
+                    with CaptureQueriesContext(connection) as context:
+                        started = time.perf_counter()
+                        response = getattr(client, method)(url, data,
+                                                           format='json')
+                        if response.streaming:
+                            content = b''.join(response.streaming_content)
+                        else:
+                            content = response.content
+                        timings.append(time.perf_counter() - started)
+                    if not queries:
+                        seq_scans = (find_seq_scans(connection, context)
+                                     if check_plans else set())
+                    transaction.set_rollback(True)
+                queries.append(len(context))
+            results[name] = {
+                'method': method.upper(),
+                'url': url,
+                'status': response.status_code,
+                'queries': max(queries),
+                'latency_ms': round(statistics.median(timings) * 1000, 2),
+                'size_bytes': len(content),
+                'seq_scans': sorted(seq_scans),
+            }
+        return results
+
+    def report(self, results):
+        self.stdout.write(f'{"endpoint":<36}{"status":>7}{"queries":>9}'
+                          f'{"ms":>10}{"bytes":>10}  seq scans')
+        for name, result in results.items():
+            self.stdout.write(
+                f'{name:<36}{result["status"]:>7}{result["queries"]:>9}'
+                f'{result["latency_ms"]:>10.2f}{result["size_bytes"]:>10}'
+                f'  {" ".join(result["seq_scans"])}')
+
+    def write_budgets(self, path, results):
+        budgets = {
+            name: {
+                'queries': result['queries'],
+                'latency_ms': max(LATENCY_FLOOR_MS, math.ceil(
+                    result['latency_ms'] * LATENCY_HEADROOM)),
+            }
+            for name, result in results.items()
+        }
+        with open(path, 'w') as file:
+            json.dump(budgets, file, indent=2, sort_keys=True)
+            file.write('\n')
+        self.stdout.write(self.style.SUCCESS(f'Бюджеты сохранены в {path}'))
+
+    def check_budgets(self, path, results, strict_latency=False):
+        with open(path) as file:
+            budgets = json.load(file)
+        errors = []
+        slow = []
+        for name, result in results.items():
+            budget = budgets.get(name)
+            if budget is None:
+                errors.append(f'{name}: нет бюджета')
+                continue
+            if result['queries'] > budget['queries']:
+                errors.append(f'{name}: {result["queries"]} запросов, '
+                              f'бюджет {budget["queries"]}')
+            if result['latency_ms'] > budget['latency_ms']:
+                slow.append(f'{name}: {result["latency_ms"]} мс, '
+                            f'бюджет {budget["latency_ms"]}')
+            if result['seq_scans']:
+                errors.append(f'{name}: полный просмотр таблиц '
+                              f'{", ".join(result["seq_scans"])}')
+        if strict_latency:
+            errors.extend(slow)
+        elif slow:
+            self.stdout.write(self.style.WARNING(
+                'Время ответа выше бюджета:\n' + '\n'.join(slow)))
+        if errors:
+            raise CommandError('Превышены бюджеты:\n' + '\n'.join(errors))
+        self.stdout.write(self.style.SUCCESS('Все бюджеты соблюдены'))
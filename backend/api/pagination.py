@@ -0,0 +1,138 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as DecodeError
+from collections import OrderedDict
+from functools import partial
+
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+FALSE_VALUES = ('0', 'false', 'False')
+KEYSET_ORDERINGS = ((), ('-pub_date',), ('-pub_date', '-id'))
+
+
+# Число объектов уже посчитано представлением, второй COUNT не нужен.
+class CountedPaginator(Paginator):
+    def __init__(self, *args, count, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.count = count
+
+
+class KeysetPaginationMixin:
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    invalid_cursor_message = 'Неверный курсор'
+
+    def counts_results(self, request):
+        return (self.cursor_query_param not in request.query_params
+                or request.query_params.get(self.count_query_param)
+                not in FALSE_VALUES)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = self.cursor_query_param in request.query_params
+        count = getattr(view, 'queryset_count', None)
+        if not self.keyset:
+            if count is not None:
+                self.django_paginator_class = partial(CountedPaginator,
+                                                      count=count)
+            return super().paginate_queryset(queryset, request, view)
+        if tuple(queryset.query.order_by) not in KEYSET_ORDERINGS:
+            raise ValidationError({self.cursor_query_param: (
+                'Курсорная пагинация доступна только при сортировке '
+                'по дате публикации')})
+        self.request = request
+        page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(
+            request.query_params[self.cursor_query_param])
+        self.count = None
+        if self.counts_results(request):
+            self.count = count if count is not None else queryset.count()
+
+        backwards = cursor is not None and cursor[0] == 'p'
+        if cursor is not None:
+            _, pub_date, pk = cursor
+            if backwards:
+                queryset = queryset.filter(
+                    Q(pub_date__gt=pub_date)
+                    | Q(pub_date=pub_date, id__gt=pk))
+            else:
+                queryset = queryset.filter(
+                    Q(pub_date__lt=pub_date)
+                    | Q(pub_date=pub_date, id__lt=pk))
+        if backwards:
+            queryset = queryset.order_by('pub_date', 'id')
+        else:
+            queryset = queryset.order_by('-pub_date', '-id')
+
+        page = list(queryset[:page_size + 1])
+        has_more = len(page) > page_size
+        page = page[:page_size]
+        if backwards:
+            page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+        self.page = page
+        return page
+
+    def encode_cursor(self, direction, recipe):
+        position = f'{direction}|{recipe.pub_date.isoformat()}|{recipe.id}'
+        return urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, encoded):
+        if not encoded:
+            return None
+        try:
+            direction, pub_date, pk = urlsafe_b64decode(
+                encoded.encode()).decode().split('|')
+            pub_date = parse_datetime(pub_date)
+            pk = int(pk)
+        except (DecodeError, UnicodeDecodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if direction not in ('n', 'p') or pub_date is None:
+            raise NotFound(self.invalid_cursor_message)
+        return direction, pub_date, pk
+
+    def get_cursor_link(self, direction, recipe):
+        url = remove_query_param(self.request.build_absolute_uri(),
+                                 self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param,
+                                   self.encode_cursor(direction, recipe))
+
+    def get_next_link(self):
+        if not self.keyset:
+            return super().get_next_link()
+        if not self.has_next or not self.page:
+            return None
+        return self.get_cursor_link('n', self.page[-1])
+
+    def get_previous_link(self):
+        if not self.keyset:
+            return super().get_previous_link()
+        if not self.has_previous or not self.page:
+            return None
+        return self.get_cursor_link('p', self.page[0])
+
+    def get_paginated_response(self, data):
+        if not self.keyset:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+
+class ResultsSetPagination(KeysetPaginationMixin, PageNumberPagination):
+    max_page_size = 100
+    page_size_query_param = 'limit'
+
+
+class RecipesPagination(KeysetPaginationMixin, PageNumberPagination):
+    page_size_query_param = 'limit'
+    max_page_size = 10
@@ -0,0 +1,246 @@
+import cProfile
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack
+from functools import partial
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from rest_framework import serializers
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+DUPLICATE_QUERIES_WARNING = 5
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+local = threading.local()
+
+
+class RequestProfile:
+    def __init__(self):
+        self.view = 'unresolved'
+        self.queries = Counter()
+        self.query_time = 0
+        self.serializer_time = 0
+        self.serializer_depth = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_time += time.perf_counter() - started
+            self.queries[sql] += 1
+
+    @property
+    def query_count(self):
+        return sum(self.queries.values())
+
+    @property
+    def duplicate_queries(self):
+        return self.query_count - len(self.queries)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.latency_buckets = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+        self.sums = defaultdict(Counter)
+
+    def observe(self, profile, method, status, latency):
+        labels = (profile.view, method)
+        with self.lock:
+            self.requests[(*labels, status)] += 1
+            buckets = self.latency_buckets[labels]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    buckets[index] += 1
+            sums = self.sums[labels]
+            sums['count'] += 1
+            sums['latency'] += latency
+            sums['queries'] += profile.query_count
+            sums['query_time'] += profile.query_time
+            sums['duplicate_queries'] += profile.duplicate_queries
+            sums['serializer_time'] += profile.serializer_time
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines += [
+                '# HELP foodgram_requests_total Обработанные запросы',
+                '# TYPE foodgram_requests_total counter',
+            ]
+            for (view, method, status), value in sorted(
+                    self.requests.items()):
+                lines.append(
+                    f'foodgram_requests_total{{view="{view}",'
+                    f'method="{method}",status="{status}"}} {value}')
+            lines += [
+                '# HELP foodgram_request_duration_seconds Время ответа',
+                '# TYPE foodgram_request_duration_seconds histogram',
+            ]
+            for (view, method), buckets in sorted(
+                    self.latency_buckets.items()):
+                labels = f'view="{view}",method="{method}"'
+                for bound, value in zip(LATENCY_BUCKETS, buckets):
+                    lines.append(
+                        f'foodgram_request_duration_seconds_bucket'
+                        f'{{{labels},le="{bound}"}} {value}')
+                sums = self.sums[(view, method)]
+                lines += [
+                    f'foodgram_request_duration_seconds_bucket'
+                    f'{{{labels},le="+Inf"}} {sums["count"]}',
+                    f'foodgram_request_duration_seconds_sum{{{labels}}} '
+                    f'{sums["latency"]:.6f}',
+                    f'foodgram_request_duration_seconds_count{{{labels}}} '
+                    f'{sums["count"]}',
+                ]
+            for name, key, help_text in (
+                    ('db_queries_total', 'queries', 'SQL-запросы'),
+                    ('db_query_duration_seconds_total', 'query_time',
+                     'Время выполнения SQL-запросов'),
+                    ('db_duplicate_queries_total', 'duplicate_queries',
+                     'Повторяющиеся SQL-запросы'),
+                    ('serializer_duration_seconds_total', 'serializer_time',
+                     'Время работы сериализаторов')):
+                lines += [f'# HELP foodgram_{name} {help_text}',
+                          f'# TYPE foodgram_{name} counter']
+                for (view, method), sums in sorted(self.sums.items()):
+                    lines.append(
+                        f'foodgram_{name}{{view="{view}",method="{method}"}} '
+                        f'{sums[key]:g}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def instrument_serializers():
+    data = serializers.BaseSerializer.data
+
+    def timed_data(serializer):
+        profile = getattr(local, 'profile', None)
+        if profile is None:
+            return data.fget(serializer)
+        profile.serializer_depth += 1
+        started = time.perf_counter()
+        try:
+            return data.fget(serializer)
+        finally:
+            profile.serializer_depth -= 1
+            if not profile.serializer_depth:
+                profile.serializer_time += time.perf_counter() - started
+
+    serializers.BaseSerializer.data = property(timed_data)
+
+
+def is_profiling_requested(request):
+    token = request.META.get(PROFILE_HEADER)
+    return bool(token and settings.PROFILING_TOKEN
+                and constant_time_compare(token, settings.PROFILING_TOKEN))
+
+
+class ProfiledStream:
+    def __init__(self, content, finish):
+        self.content = content
+        self.finish = finish
+
+    def __iter__(self):
+        return iter(self.content)
+
+    # Сервер закрывает ответ и тогда, когда тело не читалось (HEAD).
+    def close(self):
+        finish, self.finish = self.finish, None
+        if finish is not None:
+            finish()
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.PROFILING_ENABLED:
+            return self.get_response(request)
+        profile = local.profile = RequestProfile()
+        profiler = cProfile.Profile() if is_profiling_requested(
+            request) else None
+        started = time.perf_counter()
+        stack = ExitStack()
+        try:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(profile))
+            if profiler is None:
+                response = self.get_response(request)
+            else:
+                response = profiler.runcall(self.get_response, request)
+        except BaseException:
+            stack.close()
+            raise
+        finally:
+            local.profile = None
+        finish = partial(self.finish, stack, profile, request.method,
+                         response.status_code, started)
+        if response.streaming:
+            # Тело потокового ответа читается после выхода из middleware:
+            # его запросы учитываются до закрытия ответа.
+            response.streaming_content = ProfiledStream(
+                response.streaming_content, finish)
+        else:
+            finish()
+        if profiler is not None:
+            latency = time.perf_counter() - started
+            response['X-Profile-Dump'] = self.dump(profiler, profile)
+            response['Server-Timing'] = ', '.join((
+                f'db;desc="{profile.query_count} queries";'
+                f'dur={profile.query_time * 1000:.1f}',
+                f'serializer;dur={profile.serializer_time * 1000:.1f}',
+                f'total;dur={latency * 1000:.1f}',
+            ))
+        return response
+
+    def finish(self, stack, profile, method, status, started):
+        stack.close()
+        metrics.observe(profile, method, status,
+                        time.perf_counter() - started)
+        if profile.duplicate_queries >= DUPLICATE_QUERIES_WARNING:
+            logger.warning('%s: %d повторяющихся SQL-запросов из %d',
+                           profile.view, profile.duplicate_queries,
+                           profile.query_count)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profile = getattr(local, 'profile', None)
+        if profile is None:
+            return None
+        view_class = getattr(view_func, 'cls', None)
+        if view_class is None:
+            profile.view = f'{view_func.__module__}.{view_func.__name__}'
+            return None
+        actions = getattr(view_func, 'actions', None) or {}
+        action = actions.get(request.method.lower(), request.method.lower())
+        profile.view = f'{view_class.__name__}.{action}'
+        return None
+
+    def dump(self, profiler, profile):
+        directory = Path(settings.PROFILING_DUMP_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f'{profile.view}-{time.time_ns()}.prof'
+        profiler.dump_stats(path)
+        return path.name
+
+
+# Без токена метрики закрыты: по ним видны эндпоинты и нагрузка.
+def metrics_view(request):
+    if not settings.METRICS_TOKEN or not constant_time_compare(
+            request.META.get('HTTP_AUTHORIZATION', ''),
+            f'Bearer {settings.METRICS_TOKEN}'):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type=METRICS_CONTENT_TYPE)
@@ -0,0 +1,67 @@
+import json
+import re
+
+EXPLAINED_STATEMENTS = ('SELECT', 'UPDATE', 'DELETE', 'WITH')
+# Справочники, которые целиком помещаются в память: полный просмотр
+# таких таблиц дешевле обращения к индексу.
+SEQ_SCAN_ALLOWED = {'recipes_tag', 'recipes_ingredient'}
+SQLITE_ALIAS = re.compile(r'"(\w+)" ([A-Z]\d+)\b')
+SQLITE_SCAN = re.compile(r'^SCAN (\w+)$')
+SQLITE_LIMIT = re.compile(r' LIMIT \d+( OFFSET \d+)?$')
+
+
+def walk_plan(node, parent=None):
+    yield node, parent
+    for child in node.get('Plans', ()):
+        yield from walk_plan(child, node)
+
+
+# Полный просмотр под LIMIT без сортировки останавливается после первых
+# строк и не зависит от размера таблицы.
+def postgresql_seq_scans(cursor, sql):
+    cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}')
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return {node['Relation Name']
+            for node, parent in walk_plan(plan[0]['Plan'])
+            if node['Node Type'] == 'Seq Scan'
+            and (parent is None or parent['Node Type'] != 'Limit')}
+
+
+def sqlite_seq_scans(cursor, sql):
+    aliases = {alias: table for table, alias in SQLITE_ALIAS.findall(sql)}
+    cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+    rows = [(parent, detail) for _, parent, _, detail in cursor.fetchall()]
+    # Внешний цикл запроса под LIMIT без сортировки, как Limit над
+    # Seq Scan в PostgreSQL; подзапросы проверяются отдельно.
+    if SQLITE_LIMIT.search(sql) and not any(
+            detail.startswith('USE TEMP B-TREE') for _, detail in rows):
+        rows = rows[1:]
+    tables = set()
+    for _, detail in rows:
+        match = SQLITE_SCAN.match(detail)
+        if match:
+            tables.add(aliases.get(match[1], match[1]))
+    return tables
+
+
+PLANNERS = {
+    'postgresql': postgresql_seq_scans,
+    'sqlite': sqlite_seq_scans,
+}
+
+
+def find_seq_scans(connection, queries):
+    planner = PLANNERS.get(connection.vendor)
+    if planner is None:
+        return set()
+    tables = set()
+    with connection.cursor() as cursor:
+        for query in queries:
+            sql = query['sql']
+            if sql.lstrip().upper().startswith(EXPLAINED_STATEMENTS):
+                tables |= planner(cursor, sql)
+        # Подзапросы в FROM SQLite тоже показывает как SCAN.
+        tables &= set(connection.introspection.table_names(cursor))
+    return tables - SEQ_SCAN_ALLOWED
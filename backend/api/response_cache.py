@@ -0,0 +1,138 @@
+import time
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+
+from backend import routers
+from backend.caches import is_shared
+from recipes.models import Recipe
+from recipes.versions import responses
+
+CACHED_PARAMS = {
+    'list': {'tags', 'author', 'page', 'limit', 'cursor', 'count'},
+    'retrieve': set(),
+}
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control',
+                  'Vary')
+LOCK_TIMEOUT = 10
+LOCK_WAIT = 2
+LOCK_POLL_INTERVAL = 0.05
+
+
+def get_cache():
+    return caches[settings.RESPONSE_CACHE]
+
+
+def get_author_id(recipe_id):
+    key = f'responses:recipe-author:{recipe_id}'
+    author_id = get_cache().get(key)
+    if author_id is None:
+        author_id = Recipe.objects.filter(id=recipe_id).values_list(
+            'author_id', flat=True).first()
+        if author_id is not None:
+            get_cache().set(key, author_id, settings.RESPONSE_CACHE_TIMEOUT)
+    return author_id
+
+
+def get_scopes(view, params):
+    if view.action == 'retrieve':
+        pk = view.kwargs['pk']
+        author_id = get_author_id(pk) if pk.isdigit() else None
+        if author_id is None:
+            return None
+        return (f'recipe:{pk}', f'author:{author_id}')
+    authors = params.getlist('author')
+    if len(authors) == 1 and authors[0].isdigit():
+        return (f'author:{authors[0]}', f'author-recipes:{authors[0]}')
+    return ('feed',)
+
+
+def get_cache_key(request, view):
+    allowed = CACHED_PARAMS.get(view.action)
+    params = request.query_params
+    if (allowed is None or request.method != 'GET'
+            or not request.user.is_anonymous or set(params) - allowed):
+        return None
+    normalized = {
+        name: sorted(set(value for value in params.getlist(name) if value))
+        for name in params}
+    if normalized.get('page') == ['1']:
+        del normalized['page']
+    if 'limit' in normalized:
+        # Значения за пределами max_page_size дают ту же страницу.
+        normalized['limit'] = [view.paginator.get_page_size(request)]
+    scopes = get_scopes(view, params)
+    if scopes is None:
+        return None
+    versions = responses.get('catalog', *scopes)
+    digest = md5(repr((
+        request.scheme, request.get_host(), view.action,
+        view.kwargs.get('pk'), sorted(normalized.items()), versions,
+    )).encode()).hexdigest()
+    return f'responses:{digest}'
+
+
+def restore(request, cached):
+    content, headers = cached
+    response = get_conditional_response(
+        request, etag=headers.get('ETag'),
+        last_modified=parse_http_date_safe(headers.get('Last-Modified', '')))
+    if response is None:
+        response = HttpResponse(content)
+    for header in CACHED_HEADERS:
+        if header in headers:
+            response[header] = headers[header]
+    return response
+
+
+def store(key, response):
+    headers = {header: response[header] for header in CACHED_HEADERS
+               if response.has_header(header)}
+    get_cache().set(key, (response.content, headers),
+                    settings.RESPONSE_CACHE_TIMEOUT)
+
+
+def cached_response(request, view, handler, *args, **kwargs):
+    # Без общего кеша сброс версий не дойдёт до других воркеров.
+    if not is_shared(settings.RESPONSE_CACHE):
+        return handler(request, *args, **kwargs)
+    key = get_cache_key(request, view)
+    if key is None:
+        return handler(request, *args, **kwargs)
+    cache = get_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        return restore(request, cached)
+
+    lock = f'{key}:lock'
+    if not cache.add(lock, 1, LOCK_TIMEOUT):
+        deadline = time.monotonic() + LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            cached = cache.get(key)
+            if cached is not None:
+                return restore(request, cached)
+        return handler(request, *args, **kwargs)
+
+    try:
+        with routers.primary():
+            response = handler(request, *args, **kwargs)
+    except Exception:
+        cache.delete(lock)
+        raise
+    if response.status_code != 200:
+        cache.delete(lock)
+        return response
+
+    def release(rendered):
+        try:
+            store(key, rendered)
+        finally:
+            cache.delete(lock)
+
+    response.add_post_render_callback(release)
+    return response
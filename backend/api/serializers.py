@@ -1,17 +1,33 @@
 import base64
+import binascii
+import io
 
+from django.conf import settings
 from django.contrib.auth.password_validation import validate_password
-from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import (InMemoryUploadedFile,
+                                            TemporaryUploadedFile)
+from django.db import transaction
 from djoser.serializers import UserCreateSerializer
 from djoser.serializers import UserSerializer
+from PIL import Image
 from rest_framework import serializers
 from rest_framework.validators import UniqueTogetherValidator
 
-from recipes.models import Ingredient, IngredientRecipe, Recipe, Tag
+from recipes import pantry, reference
+from recipes.images import get_variants
+from recipes.models import (Cart, Ingredient, IngredientRecipe, Recipe,
+                            RecipeTag, ShoppingListItem, Tag)
 from users.models import User
 
 MIN_INGREDIENT_AMOUNT = 0
 MAX_INGREDIENT_AMOUNT = 1000
+MAX_BULK_RECIPES = 100
+MAX_SERVINGS = 100
+MAX_PANTRY_INGREDIENTS = 50
+MAX_PANTRY_RESULTS = 100
+PANTRY_RESULTS = 20
+BASE64_CHUNK_SIZE = 64 * 1024
 
 
 class CustomUserSerializer(UserSerializer):
@@ -25,6 +41,9 @@ class CustomUserSerializer(UserSerializer):
             'is_subscribed')
 
     def get_is_subscribed(self, obj):
+        is_subscribed = getattr(obj, 'is_subscribed', None)
+        if is_subscribed is not None:
+            return is_subscribed
         user = self.context['request'].user
         return (not user.is_anonymous
                 and obj.author_subscriptions.filter(user=user).exists())
@@ -52,13 +71,20 @@ class SubscriptionSerializer(CustomUserSerializer):
                   'last_name', 'is_subscribed', 'recipes_count', 'recipes')
 
     def get_recipes_count(self, obj):
+        recipes_count = getattr(obj, 'recipes_count', None)
+        if recipes_count is not None:
+            return recipes_count
         return obj.recipes.count()
 
     def get_recipes(self, obj):
-        recipe_limit = int(self.context['request'].GET.get('recipes_limit'))
-        recipes = obj.recipes.all()
-        recipes = recipes[:recipe_limit] if recipe_limit else recipes
-        serializer = DetailRecipeSerializer(recipes, many=True)
+        recipes = getattr(obj, 'recipe_previews', None)
+        if recipes is None:
+            recipes = obj.recipes.all()
+            recipes_limit = self.context.get('recipes_limit')
+            if recipes_limit:
+                recipes = recipes[:recipes_limit]
+        serializer = DetailRecipeSerializer(recipes, many=True,
+                                            context=self.context)
         return serializer.data
 
 
@@ -106,10 +132,25 @@ class RecipeIngredientsSerializer(serializers.ModelSerializer):
         )
 
 
+class ReferenceIdField(serializers.IntegerField):
+    default_error_messages = {
+        'does_not_exist': 'Объект с id={pk_value} не найден',
+    }
+
+    def __init__(self, reference, **kwargs):
+        self.reference = reference
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        pk = super().to_internal_value(data)
+        if self.reference.get(pk) is None:
+            self.fail('does_not_exist', pk_value=pk)
+        return pk
+
+
 class CreateRecipeIngredientsSerializer(serializers.ModelSerializer):
-    id = serializers.PrimaryKeyRelatedField(queryset=Ingredient.objects.all(),
-                                            source='ingredient',
-                                            write_only=True)
+    id = ReferenceIdField(reference.ingredients, source='ingredient_id',
+                          write_only=True)
 
     class Meta:
         model = IngredientRecipe
@@ -117,25 +158,119 @@ class CreateRecipeIngredientsSerializer(serializers.ModelSerializer):
 
 
 class Base64ImageField(serializers.ImageField):
+    default_error_messages = {
+        'invalid_base64': 'Изображение должно быть передано в base64',
+        'too_large': 'Размер изображения превышает {max_size} байт',
+        'too_wide': ('Стороны изображения не должны превышать '
+                     '{max_dimension} пикселей'),
+    }
+
     def to_internal_value(self, data):
         if isinstance(data, str) and data.startswith('data:image'):
-            format, imgstr = data.split(';base64,')
-            ext = format.split('/')[-1]
-            data = ContentFile(base64.b64decode(imgstr), name='temp.' + ext)
+            data = self.decode(data)
 
         return super().to_internal_value(data)
 
+    def decode(self, data):
+        format, separator, imgstr = data.partition(';base64,')
+        if not separator:
+            self.fail('invalid_base64')
+        # Переносы строк и пробелы допустимы в base64 (RFC 2045).
+        imgstr = ''.join(imgstr.split())
+        content_type = format.partition(':')[2]
+        name = 'temp.' + content_type.split('/')[-1]
+        size = len(imgstr) * 3 // 4 - imgstr[-2:].count('=')
+        if size > settings.IMAGE_MAX_UPLOAD_SIZE:
+            self.fail('too_large', max_size=settings.IMAGE_MAX_UPLOAD_SIZE)
+        # Как и обычная загрузка, большой файл пишется на диск: проверка
+        # ImageField читает его по пути, не копируя в память.
+        if size > settings.FILE_UPLOAD_MAX_MEMORY_SIZE:
+            file = TemporaryUploadedFile(name, content_type, size, None)
+        else:
+            file = InMemoryUploadedFile(io.BytesIO(), None, name,
+                                        content_type, size, None)
+        try:
+            self.write_image(file, imgstr)
+        except serializers.ValidationError:
+            file.close()
+            raise
+        file.seek(0)
+        return file
+
+    def write_image(self, file, imgstr):
+        try:
+            for start in range(0, len(imgstr), BASE64_CHUNK_SIZE):
+                file.write(base64.b64decode(
+                    imgstr[start:start + BASE64_CHUNK_SIZE], validate=True))
+        except binascii.Error:
+            self.fail('invalid_base64')
+        file.seek(0)
+        try:
+            with Image.open(file) as image:
+                width, height = image.size
+        except (OSError, Image.DecompressionBombError):
+            self.fail('invalid_image')
+        if max(width, height) > settings.IMAGE_MAX_DIMENSION:
+            self.fail('too_wide',
+                      max_dimension=settings.IMAGE_MAX_DIMENSION)
+
+
+class ImageVariantsField(serializers.Field):
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, recipe):
+        request = self.context.get('request')
+        urls = {}
+        for variant, files in get_variants(recipe).items():
+            urls[variant] = {}
+            for extension, name in files.items():
+                url = default_storage.url(name)
+                urls[variant][extension] = (
+                    request.build_absolute_uri(url) if request else url)
+        return urls
+
+
+class RecipeIdsSerializer(serializers.Serializer):
+    recipes = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False, max_length=MAX_BULK_RECIPES)
+
+    def validate_recipes(self, recipes):
+        return list(dict.fromkeys(recipes))
+
+
+class CartServingsSerializer(serializers.Serializer):
+    servings = serializers.IntegerField(min_value=1, max_value=MAX_SERVINGS,
+                                        default=1)
+
+
+class PantrySerializer(serializers.Serializer):
+    ingredients = serializers.ListField(
+        child=ReferenceIdField(reference.ingredients),
+        allow_empty=False, max_length=MAX_PANTRY_INGREDIENTS)
+    limit = serializers.IntegerField(min_value=1,
+                                     max_value=MAX_PANTRY_RESULTS,
+                                     default=PANTRY_RESULTS)
+
+    def validate_ingredients(self, ingredients):
+        return set(ingredients)
+
 
 class DetailRecipeSerializer(serializers.ModelSerializer):
     image = Base64ImageField()
+    image_variants = ImageVariantsField()
 
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'cooking_time', 'image')
+        fields = ('id', 'name', 'cooking_time', 'image', 'image_variants')
 
 
 class RecipeSerializer(serializers.ModelSerializer):
     image = Base64ImageField()
+    image_variants = ImageVariantsField()
     is_favorited = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
     tags = TagsSerializer(many=True, read_only=True)
@@ -145,23 +280,35 @@ class RecipeSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'text', 'author', 'image', 'tags',
-                  'ingredients', 'cooking_time', 'is_in_shopping_cart',
-                  'is_favorited')
+        fields = ('id', 'name', 'text', 'author', 'image', 'image_variants',
+                  'tags', 'ingredients', 'cooking_time',
+                  'is_in_shopping_cart', 'is_favorited')
+
+    def to_representation(self, instance):
+        is_subscribed = getattr(instance, 'author_is_subscribed', None)
+        if is_subscribed is not None:
+            instance.author.is_subscribed = is_subscribed
+        return super().to_representation(instance)
 
     def get_is_favorited(self, obj):
+        is_favorited = getattr(obj, 'is_favorited', None)
+        if is_favorited is not None:
+            return is_favorited
         user = self.context['request'].user
         return (not user.is_anonymous
                 and obj.favorites.filter(user=user).exists())
 
     def get_is_in_shopping_cart(self, obj):
+        is_in_shopping_cart = getattr(obj, 'is_in_shopping_cart', None)
+        if is_in_shopping_cart is not None:
+            return is_in_shopping_cart
         user = self.context['request'].user
         return not user.is_anonymous and obj.carts.filter(user=user).exists()
 
 
 class RecipeCreateSerializer(RecipeSerializer):
-    tags = serializers.PrimaryKeyRelatedField(queryset=Tag.objects.only('id'),
-                                              many=True, write_only=True)
+    tags = serializers.ListField(child=ReferenceIdField(reference.tags),
+                                 write_only=True)
     ingredients = CreateRecipeIngredientsSerializer(many=True,
                                                     write_only=True)
 
@@ -173,48 +320,91 @@ class RecipeCreateSerializer(RecipeSerializer):
     def validate_tags(self, tags):
         if not tags:
             raise serializers.ValidationError('Нужны тэги')
-        unique_tags = []
-        for tag in tags:
-            if tag.id in unique_tags:
-                continue
-            unique_tags.append(tag)
-
-        return unique_tags
-
+        return list(dict.fromkeys(tags))
+
+    # Декодированное изображение закрывается, как Django закрывает файлы
+    # запроса: временный файл удаляется, если хранилище его не забрало.
+    def save(self, **kwargs):
+        try:
+            return super().save(**kwargs)
+        finally:
+            image = self.validated_data.get('image')
+            if image is not None:
+                image.close()
+
+    @transaction.atomic
     def create(self, validated_data):
         tags = validated_data.pop('tags', [])
         ingredients = validated_data.pop('ingredients', [])
         recipe = Recipe.objects.create(**validated_data)
-        recipe.tags.set(tags)
-        for ingredient in ingredients:
-            IngredientRecipe.objects.create(recipe=recipe,
-                                            ingredient=ingredient[
-                                                'ingredient'],
-                                            amount=ingredient['amount'])
+        RecipeTag.objects.bulk_create(
+            RecipeTag(recipe=recipe, tag_id=tag_id) for tag_id in tags)
+        IngredientRecipe.objects.bulk_create(
+            IngredientRecipe(recipe=recipe, **ingredient)
+            for ingredient in ingredients)
+        Recipe.objects.filter(id=recipe.id).update_search_index()
+        pantry.record_changes([recipe.id])
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
-        tags = validated_data.pop('tags', [])
-        ingredients = validated_data.pop('ingredients', [])
+        tags = validated_data.pop('tags', None)
+        ingredients = validated_data.pop('ingredients', None)
         super().update(instance, validated_data)
-        instance.tags.set(tags)
-        IngredientRecipe.objects.filter(recipe=instance).delete()
-        for ingredient in ingredients:
-            IngredientRecipe.objects.create(recipe=instance,
-                                            ingredient=ingredient[
-                                                'ingredient'],
-                                            amount=ingredient['amount'])
+        if tags is not None:
+            self.update_tags(instance, tags)
+        if ingredients is not None:
+            self.update_ingredients(instance, ingredients)
+            pantry.record_changes([instance.id])
+        Recipe.objects.filter(id=instance.id).update_search_index()
         return instance
 
+    def update_tags(self, recipe, tags):
+        current = set(recipe.recipe_tags.values_list('tag_id', flat=True))
+        removed = current - set(tags)
+        if removed:
+            recipe.recipe_tags.filter(tag_id__in=removed).delete()
+        RecipeTag.objects.bulk_create(
+            RecipeTag(recipe=recipe, tag_id=tag_id)
+            for tag_id in tags if tag_id not in current)
+
+    def update_ingredients(self, recipe, ingredients):
+        current = {item.ingredient_id: item
+                   for item in recipe.recipe_ingredients.all()}
+        amounts = {ingredient['ingredient_id']: ingredient['amount']
+                   for ingredient in ingredients}
+        removed = current.keys() - amounts.keys()
+        added = amounts.keys() - current.keys()
+        changed = []
+        for ingredient_id, amount in amounts.items():
+            item = current.get(ingredient_id)
+            if item is not None and item.amount != amount:
+                item.amount = amount
+                changed.append(item)
+        affected = removed | added | {item.ingredient_id for item in changed}
+        if not affected:
+            return
+        carts = Cart.objects.filter(recipe=recipe)
+        ShoppingListItem.objects.remove_carts(carts, affected)
+        if removed:
+            recipe.recipe_ingredients.filter(
+                ingredient_id__in=removed).delete()
+        if changed:
+            IngredientRecipe.objects.bulk_update(changed, ('amount',))
+        IngredientRecipe.objects.bulk_create(
+            IngredientRecipe(recipe=recipe, ingredient_id=ingredient_id,
+                             amount=amount)
+            for ingredient_id, amount in amounts.items()
+            if ingredient_id in added)
+        ShoppingListItem.objects.add_carts(carts, affected)
+
     def validate_ingredients(self, ingredients):
         ingredient_ids = []
-        validate_ingredients = []
         for ingredient in ingredients:
-            if ingredient['ingredient'].id in ingredient_ids:
+            if ingredient['ingredient_id'] in ingredient_ids:
                 raise serializers.ValidationError(
                     'Уберите дубликаты ингредиентов')
-            ingredient_ids.append(ingredient['ingredient'].id)
-            validate_ingredients.append(ingredient)
+            ingredient_ids.append(ingredient['ingredient_id'])
             amount = ingredient['amount']
             if not (MIN_INGREDIENT_AMOUNT < amount < MAX_INGREDIENT_AMOUNT):
                 raise serializers.ValidationError(
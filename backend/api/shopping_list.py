@@ -0,0 +1,110 @@
+import csv
+import io
+
+from django.conf import settings
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+from recipes.models import ShoppingListItem
+
+TITLE = 'Список покупок'
+CHUNK_SIZE = 500
+PDF_FONT = 'ShoppingListFont'
+PDF_FONT_SIZE = 12
+PDF_MARGIN = 50
+PDF_LINE_HEIGHT = 20
+
+# Единица измерения -> (базовая единица, множитель).
+UNIT_CONVERSIONS = {
+    'г': ('г', 1),
+    'кг': ('г', 1000),
+    'мл': ('мл', 1),
+    'л': ('мл', 1000),
+    'стакан': ('мл', 200),
+    'ст. л.': ('мл', 15),
+    'ч. л.': ('мл', 5),
+}
+# Базовая единица -> (крупная единица, множитель).
+DISPLAY_UNITS = {
+    'г': ('кг', 1000),
+    'мл': ('л', 1000),
+}
+
+
+def format_amount(amount, unit):
+    large_unit, factor = DISPLAY_UNITS.get(unit, (None, None))
+    if large_unit is None or amount < factor:
+        return amount, unit
+    amount = round(amount / factor, 3)
+    return int(amount) if amount.is_integer() else amount, large_unit
+
+
+def get_shopping_list(user):
+    items = ShoppingListItem.objects.filter(user=user).values_list(
+        'ingredient__name', 'ingredient__measurement_unit',
+        'amount').iterator(chunk_size=CHUNK_SIZE)
+    # Одинаковые названия без учёта регистра, пробелов по краям и «ё»
+    # объединяются, количества приводятся к базовой единице.
+    merged = {}
+    for name, unit, amount in items:
+        name = name.strip()
+        unit, factor = UNIT_CONVERSIONS.get(unit, (unit, 1))
+        key = (name.casefold().replace('ё', 'е'), unit)
+        if key in merged:
+            merged[key]['total_amount'] += amount * factor
+            merged[key]['name'] = min(merged[key]['name'], name)
+        else:
+            merged[key] = {'name': name, 'unit': unit,
+                           'total_amount': amount * factor}
+    for key in sorted(merged):
+        item = merged[key]
+        amount, unit = format_amount(item['total_amount'], item['unit'])
+        yield {'name': item['name'], 'measurement_unit': unit,
+               'amount': amount}
+
+
+def render_txt(items):
+    yield f'{TITLE}\n'
+    for item in items:
+        yield (f'{item["name"]} ({item["measurement_unit"]}) - '
+               f'{item["amount"]}\n')
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+def render_csv(items):
+    writer = csv.writer(Echo())
+    yield writer.writerow(('Ингредиент', 'Единица измерения', 'Количество'))
+    for item in items:
+        yield writer.writerow((item['name'], item['measurement_unit'],
+                               item['amount']))
+
+
+def render_pdf(items):
+    if PDF_FONT not in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(TTFont(PDF_FONT, settings.PDF_FONT_PATH))
+    buffer = io.BytesIO()
+    page = canvas.Canvas(buffer, pagesize=A4)
+    _, height = A4
+    y = height - PDF_MARGIN
+    for line in render_txt(items):
+        if y < PDF_MARGIN:
+            page.showPage()
+            y = height - PDF_MARGIN
+        page.setFont(PDF_FONT, PDF_FONT_SIZE)
+        page.drawString(PDF_MARGIN, y, line.rstrip('\n'))
+        y -= PDF_LINE_HEIGHT
+    page.save()
+    yield buffer.getvalue()
+
+
+FORMATS = {
+    'txt': (render_txt, 'text/plain'),
+    'csv': (render_csv, 'text/csv'),
+    'pdf': (render_pdf, 'application/pdf'),
+}
@@ -0,0 +1,1031 @@
+import base64
+import io
+import shutil
+import tempfile
+from pathlib import Path
+from unittest import mock, skipUnless
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient, APITestCase
+
+from api import profiling
+from api.serializers import MAX_BULK_RECIPES, Base64ImageField
+from api.shopping_list import format_amount
+from backend import routers
+from recipes import pantry
+from recipes.models import (Cart, Favorite, Ingredient, IngredientRecipe,
+                            Recipe, RecipeTag, ShoppingListItem, Tag)
+from recipes.search import FTS_TABLE, stem
+from users.models import RelationQuerySet, Subscription, User
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+
+def make_image(size=8):
+    buffer = io.BytesIO()
+    Image.new('RGB', (size, size), '#E26C2D').save(buffer, 'PNG')
+    return ('data:image/png;base64,'
+            + base64.b64encode(buffer.getvalue()).decode())
+
+
+# Тесты идут в одном процессе, поэтому локальный кеш считается общим.
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, CACHE_SINGLE_PROCESS=True)
+class ApiTestCase(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        image = Path(MEDIA_ROOT, 'recipes', 'test.png')
+        image.parent.mkdir(exist_ok=True)
+        Image.new('RGB', (64, 64), '#E26C2D').save(image)
+        cls.user = cls.create_user('cook')
+        cls.author = cls.create_user('author')
+        cls.tag = Tag.objects.create(name='Завтрак', slug='breakfast',
+                                     color='#E26C2D')
+        cls.ingredients = [
+            Ingredient.objects.create(name=name, measurement_unit=unit)
+            for name, unit in (('мука', 'г'), ('молоко', 'мл'),
+                               ('яйца', 'шт'))]
+        cls.recipes = [cls.create_recipe(cls.author, number)
+                       for number in range(3)]
+
+    @classmethod
+    def create_user(cls, username):
+        return User.objects.create_user(
+            username=username, email=f'{username}@foodgram.ru',
+            password='Sup3r-secret-pass', first_name='Имя',
+            last_name='Фамилия')
+
+    @classmethod
+    def create_recipe(cls, author, number, amounts=(100, 200)):
+        recipe = Recipe.objects.create(
+            author=author, name=f'Рецепт {number}',
+            text=f'Описание рецепта {number}', image='recipes/test.png',
+            cooking_time=10)
+        RecipeTag.objects.create(recipe=recipe, tag=cls.tag)
+        for ingredient, amount in zip(cls.ingredients, amounts):
+            IngredientRecipe.objects.create(
+                recipe=recipe, ingredient=ingredient, amount=amount)
+        return recipe
+
+    def setUp(self):
+        caches['default'].clear()
+        # Копии изображений строятся сразу, без пула потоков.
+        executor = mock.patch('recipes.images.executor', None)
+        executor.start()
+        self.addCleanup(executor.stop)
+        self.client = self.get_client(self.user)
+        self.anonymous = APIClient()
+
+    def get_client(self, user):
+        token, _ = Token.objects.get_or_create(user=user)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        return client
+
+    # Изменения применяются так, как после коммита запроса: с вызовом
+    # колбэков сброса кешей и версий.
+    def commit(self):
+        return self.captureOnCommitCallbacks(execute=True)
+
+
+class RecipeFlagsTests(ApiTestCase):
+    def get_flags(self, client):
+        response = client.get('/api/recipes/')
+        return {recipe['id']: (recipe['is_favorited'],
+                               recipe['is_in_shopping_cart'],
+                               recipe['author']['is_subscribed'])
+                for recipe in response.data['results']}
+
+    def test_flags(self):
+        first, second, third = self.recipes
+        Favorite.objects.create(user=self.user, recipe=first)
+        Cart.objects.create(user=self.user, recipe=second)
+        Subscription.objects.create(user=self.user, author=self.author)
+        self.assertEqual(self.get_flags(self.client), {
+            first.id: (True, False, True),
+            second.id: (False, True, True),
+            third.id: (False, False, True)})
+        self.assertEqual(set(self.get_flags(self.anonymous).values()),
+                         {(False, False, False)})
+
+    def test_flags_do_not_add_queries_per_recipe(self):
+        self.client.get('/api/recipes/')
+        with CaptureQueriesContext(connection) as context:
+            self.client.get('/api/recipes/')
+        for number in range(3, 6):
+            recipe = self.create_recipe(self.author, number)
+            Favorite.objects.create(user=self.user, recipe=recipe)
+        with self.assertNumQueries(len(context)):
+            self.client.get('/api/recipes/')
+
+
+class RecipeWriteTests(ApiTestCase):
+    def get_amounts(self, recipe_id):
+        return dict(IngredientRecipe.objects.filter(
+            recipe_id=recipe_id).values_list('ingredient__name', 'amount'))
+
+    def count_inserts(self, context):
+        return len([query for query in context.captured_queries
+                    if query['sql'].startswith(
+                        'INSERT INTO "recipes_ingredientrecipe"')])
+
+    def test_create_inserts_ingredients_at_once(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post('/api/recipes/', {
+                'name': 'Омлет', 'text': 'Взбить и пожарить',
+                'cooking_time': 10, 'image': make_image(),
+                'tags': [self.tag.id],
+                'ingredients': [
+                    {'id': ingredient.id, 'amount': amount}
+                    for ingredient, amount in zip(self.ingredients,
+                                                  (10, 20, 3))]},
+                format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.count_inserts(context), 1)
+        self.assertEqual(self.get_amounts(response.data['id']),
+                         {'мука': 10, 'молоко': 20, 'яйца': 3})
+
+    def test_update_changes_only_affected_rows(self):
+        recipe = self.recipes[0]
+        flour, milk, eggs = self.ingredients
+        kept = IngredientRecipe.objects.get(recipe=recipe, ingredient=flour)
+        with CaptureQueriesContext(connection) as context:
+            response = self.get_client(self.author).patch(
+                f'/api/recipes/{recipe.id}/',
+                {'ingredients': [{'id': flour.id, 'amount': 100},
+                                 {'id': eggs.id, 'amount': 2}]},
+                format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.count_inserts(context), 1)
+        self.assertEqual(self.get_amounts(recipe.id),
+                         {'мука': 100, 'яйца': 2})
+        self.assertTrue(IngredientRecipe.objects.filter(id=kept.id).exists())
+
+
+class Base64ImageFieldTests(SimpleTestCase):
+    def decode(self, data):
+        return Base64ImageField().to_internal_value(data)
+
+    def test_decodes_in_chunks(self):
+        data = make_image(64)
+        header, body = data.split(',')
+        # Переносы строк допустимы и не сдвигают границы блоков.
+        wrapped = '\n'.join(body[start:start + 76]
+                            for start in range(0, len(body), 76))
+        with mock.patch('api.serializers.BASE64_CHUNK_SIZE', 16):
+            file = self.decode(f'{header},{wrapped}')
+        self.assertEqual(file.read(), base64.b64decode(body))
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=10)
+    def test_large_image_is_written_to_disk(self):
+        file = self.decode(make_image())
+        self.assertIsInstance(file, TemporaryUploadedFile)
+        file.close()
+
+    def test_rejected_images(self):
+        for data, overrides in (
+                ('data:image/png;base64,@@@@', {}),
+                ('data:image/png,iVBORw0KGgo=', {}),
+                (make_image(), {'IMAGE_MAX_UPLOAD_SIZE': 10}),
+                (make_image(), {'IMAGE_MAX_DIMENSION': 4})):
+            with self.subTest(data[:30], **overrides), \
+                    override_settings(**overrides):
+                with self.assertRaises(ValidationError):
+                    self.decode(data)
+
+
+class IngredientSearchTests(ApiTestCase):
+    def search(self, name):
+        response = self.anonymous.get('/api/ingredients/', {'name': name})
+        return [ingredient['name'] for ingredient in response.data]
+
+    def test_prefix_matches_first(self):
+        with self.commit():
+            Ingredient.objects.create(name='сгущённое молоко',
+                                      measurement_unit='г')
+            Ingredient.objects.create(name='молоко топлёное',
+                                      measurement_unit='мл')
+        self.assertEqual(self.search('мол'),
+                         ['молоко', 'молоко топлёное', 'сгущённое молоко'])
+
+    @override_settings(INGREDIENTS_SEARCH_LIMIT=1)
+    def test_limit(self):
+        self.assertEqual(self.search('мо'), ['молоко'])
+
+    def test_short_query_skips_substring(self):
+        self.search('мук')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.search('ук'), [])
+        self.assertEqual(self.search('ука'), ['мука'])
+
+
+class ReferenceDataTests(ApiTestCase):
+    def test_snapshot_is_reused(self):
+        etag = self.anonymous.get('/api/tags/')['ETag']
+        with self.assertNumQueries(0):
+            response = self.anonymous.get('/api/tags/',
+                                          HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_change_reloads_snapshot(self):
+        etag = self.anonymous.get('/api/tags/')['ETag']
+        with self.commit():
+            Tag.objects.create(name='Обед', slug='lunch', color='#49B64E')
+        response = self.anonymous.get('/api/tags/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual([tag['slug'] for tag in response.data],
+                         ['breakfast', 'lunch'])
+
+    @override_settings(CACHE_SINGLE_PROCESS=False)
+    def test_unshared_cache_reloads_snapshot(self):
+        etag = self.anonymous.get('/api/tags/')['ETag']
+        with self.assertNumQueries(1):
+            response = self.anonymous.get('/api/tags/',
+                                          HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class PantryTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.index = pantry.PantryIndex()
+        index = mock.patch.object(pantry, 'index', self.index)
+        index.start()
+        self.addCleanup(index.stop)
+
+    def what_can_i_cook(self, *ingredients):
+        return self.anonymous.get(
+            '/api/recipes/what_can_i_cook/',
+            {'ingredients': [ingredient.id for ingredient in ingredients]})
+
+    def test_warm_builds_index(self):
+        self.index.warm()
+        flour, milk, eggs = self.ingredients
+        self.assertEqual(list(self.index.postings[milk.id]),
+                         [recipe.id for recipe in self.recipes])
+        self.assertNotIn(eggs.id, self.index.postings)
+
+    def test_ingredient_missing_from_snapshot(self):
+        self.anonymous.get('/api/ingredients/')
+        # Ингредиент появился без сброса версии справочника.
+        sugar = Ingredient.objects.create(name='сахар', measurement_unit='г')
+        IngredientRecipe.objects.create(recipe=self.recipes[0],
+                                        ingredient=sugar, amount=50)
+        response = self.what_can_i_cook(self.ingredients[0])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        missing = {result['id']: [item['name'] for item in result['missing']]
+                   for result in response.data['results']}
+        self.assertEqual(missing[self.recipes[0].id], ['молоко', 'сахар'])
+        response = self.what_can_i_cook(sugar)
+        self.assertEqual([result['id'] for result in response.data['results']],
+                         [self.recipes[0].id])
+
+    @override_settings(CACHE_SINGLE_PROCESS=False)
+    def test_unshared_cache_rebuilds_index(self):
+        self.index.warm()
+        eggs = self.ingredients[2]
+        IngredientRecipe.objects.create(recipe=self.recipes[1],
+                                        ingredient=eggs, amount=2)
+        response = self.what_can_i_cook(eggs)
+        self.assertEqual([result['id'] for result in response.data['results']],
+                         [self.recipes[1].id])
+
+
+class ConditionalRequestTests(ApiTestCase):
+    def test_recipe_not_modified(self):
+        url = f'/api/recipes/{self.recipes[0].id}/'
+        response = self.client.get(url)
+        self.assertIn('Last-Modified', response)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_recipe_etag_changes_after_update(self):
+        recipe = self.recipes[0]
+        url = f'/api/recipes/{recipe.id}/'
+        etag = self.client.get(url)['ETag']
+        with self.commit():
+            response = self.get_client(self.author).patch(
+                url, {'name': 'Новое название'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['name'], 'Новое название')
+
+    def test_list_etag_changes_after_own_favorite(self):
+        etag = self.client.get('/api/recipes/')['ETag']
+        with self.commit():
+            self.client.post(f'/api/recipes/{self.recipes[0].id}/favorite/')
+        response = self.client.get('/api/recipes/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        flags = {recipe['id']: recipe['is_favorited']
+                 for recipe in response.data['results']}
+        self.assertTrue(flags[self.recipes[0].id])
+
+    def test_list_etag_ignores_other_users_favorites(self):
+        etag = self.client.get('/api/recipes/')['ETag']
+        with self.commit():
+            self.get_client(self.author).post(
+                f'/api/recipes/{self.recipes[0].id}/favorite/')
+        response = self.client.get('/api/recipes/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_etag_depends_on_user(self):
+        url = f'/api/recipes/{self.recipes[0].id}/'
+        self.assertNotEqual(self.client.get(url)['ETag'],
+                            self.anonymous.get(url)['ETag'])
+
+
+class CursorPaginationTests(ApiTestCase):
+    def get_ids(self, response):
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def test_cursor_walks_forward_and_back(self):
+        # Одинаковая дата публикации: порядок держится на id.
+        Recipe.objects.update(pub_date=self.recipes[0].pub_date)
+        newest = [recipe.id for recipe in reversed(self.recipes)]
+        first = self.client.get('/api/recipes/?cursor=&limit=2')
+        self.assertEqual(self.get_ids(first), newest[:2])
+        self.assertIsNone(first.data['previous'])
+        second = self.client.get(first.data['next'])
+        self.assertEqual(self.get_ids(second), newest[2:])
+        self.assertIsNone(second.data['next'])
+        back = self.client.get(second.data['previous'])
+        self.assertEqual(self.get_ids(back), newest[:2])
+
+    def test_count_disabled(self):
+        url = '/api/recipes/?cursor=&limit=2&count=false'
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertIsNone(response.data['count'])
+        self.assertFalse([query for query in context.captured_queries
+                          if 'COUNT(' in query['sql']])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_count_disabled_etag_follows_page(self):
+        url = '/api/recipes/?cursor=&limit=2&count=false'
+        etag = self.client.get(url)['ETag']
+        with self.commit():
+            Recipe.objects.filter(id=self.recipes[-1].id).touch()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_page_number_counts_once(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/recipes/?page=2&limit=2')
+        self.assertEqual(response.data['count'], len(self.recipes))
+        self.assertEqual(len([query for query in context.captured_queries
+                              if 'COUNT(' in query['sql']]), 1)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/recipes/?cursor=broken')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cursor_requires_date_ordering(self):
+        response = self.client.get('/api/recipes/?cursor=&ordering=popular')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class RecipeSearchTests(ApiTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        first, second, third = cls.recipes
+        for recipe, name, text in (
+                (first, 'Сырники', 'Творог смешать с мукой'),
+                (second, 'Ватрушки с творогом', 'Тесто и начинка'),
+                (third, 'Ёжики', 'Фарш с рисом')):
+            recipe.name = name
+            recipe.text = text
+            recipe.save()
+        Recipe.objects.update_search_index()
+
+    def search(self, text):
+        response = self.client.get('/api/recipes/', {'search': text})
+        return [recipe['name'] for recipe in response.data['results']]
+
+    def test_stem_and_rank(self):
+        self.assertEqual(stem('творогом'), 'творог')
+        self.assertEqual(self.search('творогом'),
+                         ['Ватрушки с творогом', 'Сырники'])
+        self.assertEqual(self.search('ЕЖИКИ'), ['Ёжики'])
+        self.assertEqual(self.search('яблоки'), [])
+
+    def test_ingredients_are_indexed(self):
+        self.assertEqual(len(self.search('молоко')), 3)
+
+    @skipUnless(connection.vendor == 'sqlite', 'Индекс FTS5 есть в SQLite')
+    def test_delete_removes_from_index(self):
+        self.recipes[2].delete()
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT rowid FROM {FTS_TABLE}')
+            self.assertEqual(
+                {row[0] for row in cursor.fetchall()},
+                {recipe.id for recipe in self.recipes[:2]})
+
+
+class RelationToggleTests(ApiTestCase):
+    def test_favorite_twice(self):
+        recipe = self.recipes[0]
+        url = f'/api/recipes/{recipe.id}/favorite/'
+        for method, expected in (
+                ('post', status.HTTP_201_CREATED),
+                ('post', status.HTTP_400_BAD_REQUEST),
+                ('delete', status.HTTP_204_NO_CONTENT),
+                ('delete', status.HTTP_400_BAD_REQUEST)):
+            self.assertEqual(getattr(self.client, method)(url).status_code,
+                             expected)
+            self.assertLessEqual(Favorite.objects.filter(
+                user=self.user, recipe=recipe).count(), 1)
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.favorites_count, 0)
+
+    def test_subscribe_twice(self):
+        url = f'/api/users/{self.author.id}/subscribe/'
+        self.assertEqual(self.client.post(url).status_code,
+                         status.HTTP_201_CREATED)
+        self.assertEqual(self.client.post(url).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Subscription.objects.filter(
+            user=self.user, author=self.author).count(), 1)
+        response = self.client.post(f'/api/users/{self.user.id}/subscribe/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.delete('/api/users/0/subscribe/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_existing_relation_is_not_inserted(self):
+        recipe = self.recipes[0]
+        self.assertEqual(Favorite.objects.add(self.user, recipe=recipe), 1)
+        watermark = User.objects.get(id=self.user.id).favorites_updated_at
+        with self.assertNumQueries(1):
+            self.assertEqual(Favorite.objects.add(self.user, recipe=recipe),
+                             0)
+        self.assertEqual(
+            User.objects.get(id=self.user.id).favorites_updated_at,
+            watermark)
+
+
+class BulkToggleTests(ApiTestCase):
+    def toggle(self, method, recipe_ids):
+        response = getattr(self.client, method)(
+            '/api/recipes/favorite/', {'recipes': recipe_ids}, format='json')
+        return [(result['id'], result['status'])
+                for result in response.data['results']]
+
+    def test_favorite_statuses(self):
+        first, second, _ = [recipe.id for recipe in self.recipes]
+        self.assertEqual(self.toggle('post', [first, first, 999]),
+                         [(first, 'added'), (999, 'not_found')])
+        self.assertEqual(self.toggle('post', [first, second]),
+                         [(first, 'exists'), (second, 'added')])
+        self.assertEqual(
+            dict(Recipe.objects.filter(id__in=[first, second]).values_list(
+                'id', 'favorites_count')), {first: 1, second: 1})
+        self.assertEqual(self.toggle('delete', [second, 999]),
+                         [(second, 'removed'), (999, 'missing')])
+        self.assertEqual(list(Favorite.objects.filter(
+            user=self.user).values_list('recipe_id', flat=True)), [first])
+
+    def test_limits(self):
+        for recipe_ids in ([], list(range(1, MAX_BULK_RECIPES + 2))):
+            response = self.client.post('/api/recipes/shopping_cart/',
+                                        {'recipes': recipe_ids},
+                                        format='json')
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+
+
+class RecipeCounterTests(ApiTestCase):
+    def get_counts(self, recipe):
+        recipe.refresh_from_db()
+        return recipe.favorites_count, recipe.carts_count
+
+    def test_favorite_counter(self):
+        recipe = self.recipes[0]
+        url = f'/api/recipes/{recipe.id}/favorite/'
+        self.client.post(url)
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.get_client(self.author).post(url)
+        self.assertEqual(self.get_counts(recipe), (2, 0))
+        self.client.delete(url)
+        self.client.delete(url)
+        self.assertEqual(self.get_counts(recipe), (1, 0))
+
+    def test_cart_counter(self):
+        recipe = self.recipes[0]
+        url = f'/api/recipes/{recipe.id}/shopping_cart/'
+        self.client.post(url)
+        self.assertEqual(self.get_counts(recipe), (0, 1))
+        self.client.delete(url)
+        self.assertEqual(self.get_counts(recipe), (0, 0))
+
+    def test_bulk_favorite_counter(self):
+        ids = [recipe.id for recipe in self.recipes[:2]]
+        self.client.post('/api/recipes/favorite/', {'recipes': ids},
+                         format='json')
+        self.client.post('/api/recipes/favorite/', {'recipes': ids},
+                         format='json')
+        self.assertEqual(self.get_counts(self.recipes[0]), (1, 0))
+        self.client.delete('/api/recipes/favorite/', {'recipes': ids},
+                           format='json')
+        self.assertEqual(self.get_counts(self.recipes[1]), (0, 0))
+
+    def test_popular_ordering(self):
+        recipe = self.recipes[0]
+        url = '/api/recipes/?ordering=popular'
+        etag = self.client.get(url)['ETag']
+        with self.commit():
+            self.get_client(self.author).post(
+                f'/api/recipes/{recipe.id}/favorite/')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['id'], recipe.id)
+
+
+class ResponseCacheTests(ApiTestCase):
+    def test_anonymous_list_is_cached(self):
+        self.anonymous.get('/api/recipes/')
+        with self.assertNumQueries(0):
+            response = self.anonymous.get('/api/recipes/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_recipe_update_invalidates(self):
+        recipe = self.recipes[0]
+        url = f'/api/recipes/{recipe.id}/'
+        self.anonymous.get(url)
+        self.anonymous.get('/api/recipes/')
+        with self.commit():
+            self.get_client(self.author).patch(
+                url, {'name': 'Новое название'}, format='json')
+        self.assertEqual(self.anonymous.get(url).data['name'],
+                         'Новое название')
+        names = {item['id']: item['name'] for item in
+                 self.anonymous.get('/api/recipes/').data['results']}
+        self.assertEqual(names[recipe.id], 'Новое название')
+
+    def test_tag_update_invalidates(self):
+        url = f'/api/recipes/{self.recipes[0].id}/'
+        self.anonymous.get(url)
+        self.anonymous.get('/api/tags/')
+        with self.commit():
+            self.tag.name = 'Обед'
+            self.tag.save()
+        self.assertEqual(self.anonymous.get(url).data['tags'][0]['name'],
+                         'Обед')
+        self.assertEqual(self.anonymous.get('/api/tags/').data[0]['name'],
+                         'Обед')
+
+    def test_author_update_invalidates(self):
+        url = f'/api/recipes/{self.recipes[0].id}/'
+        self.anonymous.get(url)
+        with self.commit():
+            self.author.first_name = 'Другое'
+            self.author.save()
+        self.assertEqual(
+            self.anonymous.get(url).data['author']['first_name'], 'Другое')
+
+    def test_recipe_write_keeps_other_authors_cached(self):
+        urls = (f'/api/recipes/{self.recipes[0].id}/',
+                f'/api/recipes/?author={self.author.id}')
+        for url in urls:
+            self.anonymous.get(url)
+        with self.commit():
+            self.create_recipe(self.user, 10)
+        for url in urls:
+            with self.assertNumQueries(0):
+                self.anonymous.get(url)
+        response = self.anonymous.get('/api/recipes/')
+        self.assertEqual(response.data['count'], 4)
+
+    @override_settings(ALLOWED_HOSTS=['first.example', 'second.example'])
+    def test_key_includes_host(self):
+        for host in ('first.example', 'second.example'):
+            response = self.anonymous.get('/api/recipes/?limit=1',
+                                          HTTP_HOST=host)
+            self.assertTrue(response.json()['next'].startswith(
+                f'http://{host}/'))
+
+    def test_limit_is_clamped(self):
+        self.anonymous.get('/api/recipes/?limit=10')
+        with self.assertNumQueries(0):
+            response = self.anonymous.get('/api/recipes/?limit=500')
+        self.assertEqual(len(response.json()['results']), 3)
+
+    @override_settings(CACHE_SINGLE_PROCESS=False)
+    def test_unshared_cache_is_bypassed(self):
+        self.anonymous.get('/api/recipes/')
+        with CaptureQueriesContext(connection) as context:
+            self.anonymous.get('/api/recipes/')
+        self.assertTrue(context.captured_queries)
+
+    def test_new_ingredient_is_listed(self):
+        self.anonymous.get('/api/ingredients/')
+        with self.commit():
+            Ingredient.objects.create(name='сахар', measurement_unit='г')
+        names = {item['name'] for item in
+                 self.anonymous.get('/api/ingredients/').data}
+        self.assertIn('сахар', names)
+
+    def test_authenticated_list_is_not_shared(self):
+        with self.commit():
+            self.client.post(f'/api/recipes/{self.recipes[0].id}/favorite/')
+        self.anonymous.get('/api/recipes/')
+        flags = {item['id']: item['is_favorited'] for item in
+                 self.client.get('/api/recipes/').data['results']}
+        self.assertTrue(flags[self.recipes[0].id])
+        flags = {item['id']: item['is_favorited'] for item in
+                 self.anonymous.get('/api/recipes/').json()['results']}
+        self.assertFalse(flags[self.recipes[0].id])
+
+
+class TokenCacheTests(ApiTestCase):
+    def get_token_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/users/me/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [query for query in context.captured_queries
+                if 'authtoken_token' in query['sql']]
+
+    def test_token_is_cached(self):
+        self.assertTrue(self.get_token_queries())
+        self.assertFalse(self.get_token_queries())
+
+    def test_logout_revokes_cached_token(self):
+        self.get_token_queries()
+        with self.commit():
+            self.client.post('/api/auth/token/logout/')
+        self.assertEqual(self.client.get('/api/users/me/').status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivation_revokes_cached_token(self):
+        self.get_token_queries()
+        with self.commit():
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(self.client.get('/api/users/me/').status_code,
+                         status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(CACHE_SINGLE_PROCESS=False)
+    def test_unshared_cache_checks_database(self):
+        self.get_token_queries()
+        self.assertTrue(self.get_token_queries())
+
+
+class RecommendationTests(ApiTestCase):
+    def get_recommended(self):
+        response = self.client.get('/api/recipes/recommendations/')
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def test_similar_recipes(self):
+        fan = self.create_user('fan')
+        other = self.create_recipe(self.create_user('baker'), 3)
+        liked = self.recipes[0]
+        Favorite.objects.bulk_create([
+            Favorite(user=self.user, recipe=liked),
+            Favorite(user=fan, recipe=liked),
+            Favorite(user=fan, recipe=other)])
+        call_command('build_recommendations', stdout=io.StringIO())
+        self.assertEqual(self.get_recommended(), [other.id])
+        self.client.post(f'/api/recipes/{other.id}/favorite/')
+        self.assertEqual(self.get_recommended(), [])
+
+    def test_followed_authors(self):
+        Subscription.objects.create(user=self.user, author=self.author)
+        call_command('build_recommendations', stdout=io.StringIO())
+        self.assertEqual(set(self.get_recommended()),
+                         {recipe.id for recipe in self.recipes})
+
+
+class ShoppingListUnitsTests(ApiTestCase):
+    def test_format_amount(self):
+        self.assertEqual(format_amount(999, 'г'), (999, 'г'))
+        self.assertEqual(format_amount(1500, 'г'), (1.5, 'кг'))
+        self.assertEqual(format_amount(2000, 'мл'), (2, 'л'))
+        self.assertEqual(format_amount(3, 'шт'), (3, 'шт'))
+
+    def test_units_and_names_are_merged(self):
+        recipe = Recipe.objects.create(
+            author=self.author, name='Блины', text='Описание блинов',
+            image='recipes/test.png', cooking_time=30)
+        for name, unit, amount in (('Мука ', 'кг', 1), ('молоко', 'стакан', 2),
+                                   ('Ёжевика', 'г', 50),
+                                   ('ежевика', 'г', 20)):
+            IngredientRecipe.objects.create(
+                recipe=recipe, amount=amount,
+                ingredient=Ingredient.objects.create(
+                    name=name, measurement_unit=unit))
+        for item in (self.recipes[0], recipe):
+            self.client.post(f'/api/recipes/{item.id}/shopping_cart/')
+        response = self.client.get('/api/recipes/shopping_list/')
+        self.assertEqual(
+            [(item['name'], item['measurement_unit'], item['amount'])
+             for item in response.data],
+            [('Ёжевика', 'г', 70), ('молоко', 'мл', 600),
+             ('Мука', 'кг', 1.1)])
+
+
+class ShoppingListDownloadTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.post(f'/api/recipes/{self.recipes[0].id}/shopping_cart/')
+
+    def download(self, **params):
+        response = self.client.get('/api/recipes/download_shopping_cart/',
+                                   params)
+        if response.status_code != status.HTTP_200_OK:
+            return response, None
+        return response, b''.join(response.streaming_content)
+
+    def test_txt(self):
+        response, content = self.download()
+        self.assertEqual(response['Content-Type'], 'text/plain')
+        self.assertEqual(content.decode().splitlines()[1:],
+                         ['молоко (мл) - 200', 'мука (г) - 100'])
+
+    def test_csv(self):
+        response, content = self.download(type='csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(content.decode().splitlines(), [
+            'Ингредиент,Единица измерения,Количество',
+            'молоко,мл,200', 'мука,г,100'])
+
+    def test_pdf(self):
+        response, content = self.download(type='pdf')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertTrue(content.startswith(b'%PDF'))
+
+    def test_unknown_type(self):
+        response, _ = self.download(type='xls')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ShoppingListTests(ApiTestCase):
+    def get_items(self):
+        self.assertEqual(ShoppingListItem.objects.rebuild(
+            [self.user.id], check=True), 0)
+        return dict(ShoppingListItem.objects.filter(
+            user=self.user).values_list('ingredient__name', 'amount'))
+
+    def add_to_cart(self, recipe, servings=1):
+        return self.client.post(f'/api/recipes/{recipe.id}/shopping_cart/',
+                                {'servings': servings}, format='json')
+
+    def test_cart_with_servings(self):
+        self.add_to_cart(self.recipes[0], servings=2)
+        self.add_to_cart(self.recipes[1])
+        self.assertEqual(self.get_items(), {'мука': 300, 'молоко': 600})
+        self.client.patch(f'/api/recipes/{self.recipes[0].id}/shopping_cart/',
+                          {'servings': 3}, format='json')
+        self.assertEqual(self.get_items(), {'мука': 400, 'молоко': 800})
+        self.client.delete(f'/api/recipes/{self.recipes[1].id}/shopping_cart/')
+        self.assertEqual(self.get_items(), {'мука': 300, 'молоко': 600})
+        response = self.client.get('/api/recipes/shopping_list/')
+        self.assertEqual([item['name'] for item in response.data],
+                         ['молоко', 'мука'])
+
+    def test_concurrent_add_is_counted_once(self):
+        self.add_to_cart(self.recipes[0])
+        for returning in (True, False):
+            # Строка в корзине появилась после проверки существующих.
+            with mock.patch.object(RelationQuerySet, 'get_existing',
+                                   return_value=set()), \
+                    mock.patch('users.models.can_return_inserted',
+                               return_value=returning):
+                response = self.client.post(
+                    '/api/recipes/shopping_cart/',
+                    {'recipes': [self.recipes[0].id]}, format='json')
+            self.assertEqual(response.data['results'],
+                             [{'id': self.recipes[0].id, 'status': 'exists'}])
+            self.assertEqual(self.get_items(), {'мука': 100, 'молоко': 200})
+
+    def test_recipe_ingredients_update(self):
+        recipe = self.recipes[0]
+        self.add_to_cart(recipe, servings=2)
+        self.get_client(self.author).patch(
+            f'/api/recipes/{recipe.id}/',
+            {'ingredients': [{'id': self.ingredients[0].id, 'amount': 50},
+                             {'id': self.ingredients[2].id, 'amount': 3}]},
+            format='json')
+        self.assertEqual(self.get_items(), {'мука': 100, 'яйца': 6})
+
+    def test_clear_cart(self):
+        self.add_to_cart(self.recipes[0])
+        self.add_to_cart(self.recipes[1])
+        self.client.delete('/api/recipes/shopping_cart/clear/')
+        self.assertEqual(self.get_items(), {})
+
+    def test_recipe_delete(self):
+        self.add_to_cart(self.recipes[0])
+        self.add_to_cart(self.recipes[1])
+        self.get_client(self.author).delete(
+            f'/api/recipes/{self.recipes[0].id}/')
+        self.assertEqual(self.get_items(), {'мука': 100, 'молоко': 200})
+
+    def test_author_delete_releases_in_one_batch(self):
+        for recipe in self.recipes:
+            self.add_to_cart(recipe)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.delete(f'/api/users/{self.author.id}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.get_items(), {})
+        self.assertEqual(len([
+            query for query in context.captured_queries
+            if query['sql'].startswith('UPDATE "recipes_shoppinglistitem"')
+        ]), 1)
+
+
+class SubscriptionsFeedTests(ApiTestCase):
+    def get_feed(self, **params):
+        return self.client.get('/api/users/subscriptions/', params)
+
+    def test_recipe_previews_are_limited_per_author(self):
+        other = self.create_user('baker')
+        other_recipes = [self.create_recipe(other, number)
+                         for number in range(3, 5)]
+        for author in (self.author, other):
+            Subscription.objects.create(user=self.user, author=author)
+        response = self.get_feed(recipes_limit=1)
+        self.assertEqual(
+            [(author['username'], author['recipes_count'],
+              [recipe['id'] for recipe in author['recipes']])
+             for author in response.data['results']],
+            [('author', 3, [self.recipes[-1].id]),
+             ('baker', 2, [other_recipes[-1].id])])
+
+    def test_queries_do_not_grow_with_authors(self):
+        Subscription.objects.create(user=self.user, author=self.author)
+        self.get_feed()
+        with CaptureQueriesContext(connection) as context:
+            self.get_feed(recipes_limit=2)
+        for number in range(2):
+            author = self.create_user(f'baker{number}')
+            self.create_recipe(author, 10 + number)
+            Subscription.objects.create(user=self.user, author=author)
+        with self.assertNumQueries(len(context)):
+            response = self.get_feed(recipes_limit=2)
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_invalid_recipes_limit(self):
+        response = self.get_feed(recipes_limit='-1')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class UsersListTests(ApiTestCase):
+    def get_subscribed(self):
+        response = self.client.get('/api/users/', {'limit': 10})
+        return {user['username']: user['is_subscribed']
+                for user in response.data['results']}
+
+    def test_is_subscribed(self):
+        Subscription.objects.create(user=self.user, author=self.author)
+        self.assertEqual(self.get_subscribed(),
+                         {'cook': False, 'author': True})
+
+    def test_queries_do_not_grow_with_users(self):
+        self.get_subscribed()
+        with CaptureQueriesContext(connection) as context:
+            self.get_subscribed()
+        for number in range(3):
+            author = self.create_user(f'author{number}')
+            Subscription.objects.create(user=self.user, author=author)
+        with self.assertNumQueries(len(context.captured_queries)):
+            self.assertEqual(len(self.get_subscribed()), 5)
+
+
+@override_settings(CACHE_SINGLE_PROCESS=True)
+class ReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+        routers.unavailable.clear()
+        self.addCleanup(routers.stop_replica_reads)
+        self.router = routers.ReplicaRouter()
+        replicas = mock.patch.object(routers, 'get_replicas',
+                                     return_value=['replica_1', 'replica_2'])
+        replicas.start()
+        self.addCleanup(replicas.stop)
+
+    def test_primary_without_replica_reads(self):
+        self.assertIsNone(self.router.db_for_read(Recipe))
+        self.assertEqual(self.router.db_for_write(Recipe), 'default')
+
+    def test_replica_chosen_once_per_request(self):
+        with mock.patch.object(routers, 'connect',
+                               return_value=True) as connect:
+            routers.start_replica_reads()
+            alias = self.router.db_for_read(Recipe)
+            self.assertIn(alias, ('replica_1', 'replica_2'))
+            self.assertEqual(self.router.db_for_read(Tag), alias)
+        connect.assert_called_once_with(alias)
+
+    def test_default_when_replicas_are_down(self):
+        with mock.patch.object(routers, 'connect', return_value=False):
+            routers.start_replica_reads()
+            self.assertEqual(self.router.db_for_read(Recipe), 'default')
+
+    def test_primary_block(self):
+        with mock.patch.object(routers, 'connect', return_value=True):
+            routers.start_replica_reads()
+            with routers.primary():
+                self.assertIsNone(self.router.db_for_read(Recipe))
+            self.assertIsNotNone(self.router.db_for_read(Recipe))
+
+    def test_transaction_reads_primary(self):
+        connections = {'default': mock.Mock(in_atomic_block=True)}
+        with mock.patch.object(routers, 'connections', connections):
+            routers.start_replica_reads()
+            self.assertIsNone(self.router.db_for_read(Recipe))
+
+    def test_failed_replica_is_skipped(self):
+        replica = mock.Mock()
+        replica.ensure_connection.side_effect = DatabaseError
+        with mock.patch.object(routers, 'connections',
+                               {'replica_1': replica}), self.assertLogs(
+                'backend.routers', 'WARNING'):
+            self.assertFalse(routers.connect('replica_1'))
+            self.assertFalse(routers.connect('replica_1'))
+        replica.ensure_connection.assert_called_once_with()
+
+    def test_sticky_user(self):
+        user = User(id=1)
+        self.assertFalse(routers.is_sticky(user))
+        routers.stick(user)
+        self.assertTrue(routers.is_sticky(user))
+
+    @override_settings(CACHE_SINGLE_PROCESS=False)
+    def test_unshared_cache_keeps_users_on_primary(self):
+        self.assertTrue(routers.is_sticky(User(id=1)))
+        self.assertFalse(routers.is_sticky(AnonymousUser()))
+
+
+class ReplicaReadTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        replicas = mock.patch.object(routers, 'get_replicas',
+                                     return_value=['replica_1'])
+        replicas.start()
+        self.addCleanup(replicas.stop)
+        start = mock.patch.object(routers, 'start_replica_reads',
+                                  wraps=routers.start_replica_reads)
+        self.start_replica_reads = start.start()
+        self.addCleanup(start.stop)
+
+    def test_get_reads_replicas(self):
+        self.client.get('/api/recipes/')
+        self.start_replica_reads.assert_called_once_with()
+        self.assertFalse(routers.local.enabled)
+
+    def test_write_sticks_to_primary(self):
+        self.client.post(f'/api/recipes/{self.recipes[0].id}/favorite/')
+        self.assertTrue(routers.is_sticky(self.user))
+        self.client.get('/api/recipes/')
+        self.start_replica_reads.assert_not_called()
+        self.anonymous.get('/api/recipes/')
+        self.start_replica_reads.assert_called_once_with()
+
+
+@override_settings(PROFILING_ENABLED=True, METRICS_TOKEN='secret')
+class ProfilingTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.metrics = profiling.Metrics()
+        metrics = mock.patch.object(profiling, 'metrics', self.metrics)
+        metrics.start()
+        self.addCleanup(metrics.stop)
+
+    def test_metrics_require_token(self):
+        response = self.anonymous.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.anonymous.get('/metrics',
+                                      HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_metrics_closed_without_token(self):
+        response = self.anonymous.get('/metrics', HTTP_AUTHORIZATION='Bearer ')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_streaming_queries_are_counted(self):
+        self.client.post(f'/api/recipes/{self.recipes[0].id}/shopping_cart/')
+        response = self.client.get('/api/recipes/download_shopping_cart/')
+        labels = ('RecipesViewSet.download_shopping_cart', 'GET')
+        self.assertNotIn(labels, self.metrics.sums)
+        with CaptureQueriesContext(connection) as context:
+            content = b''.join(response.streaming_content)
+        self.assertIn('мука'.encode(), content)
+        self.assertTrue(context.captured_queries)
+        self.assertGreaterEqual(self.metrics.sums[labels]['queries'],
+                                len(context.captured_queries))
+        self.assertEqual(connection.execute_wrappers, [])
@@ -1,51 +1,105 @@
-from django.db.models import Sum
-from django.http import HttpResponse
+from functools import partial
+from hashlib import md5
+
+from django.db import transaction
+from django.db.models import (BooleanField, Count, Exists, Max, OuterRef,
+                              Prefetch, Value, prefetch_related_objects)
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                patch_vary_headers)
+from django.utils.http import http_date, quote_etag
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import (
-    IsAuthenticated, BasePermission,
+    SAFE_METHODS, IsAuthenticated, BasePermission,
     IsAuthenticatedOrReadOnly)
 
 from rest_framework.response import Response
 
 from api.filters import RecipeFilter, IngredientsFilter
-from api.serializers import (ChangePasswordSerializer,
+from api.pagination import RecipesPagination, ResultsSetPagination
+from api.response_cache import cached_response
+from api.serializers import (CartServingsSerializer, PantrySerializer,
+                             ChangePasswordSerializer,
                              SubscriptionSerializer,
                              CustomUserCreateSerializer,
                              CustomUserSerializer, IngredientsSerializer,
-                             RecipeCreateSerializer,
+                             RecipeCreateSerializer, RecipeIdsSerializer,
                              RecipeSerializer, DetailRecipeSerializer,
                              TagsSerializer)
-from recipes.models import (Favorite, Ingredient,
-                            Recipe, Tag, Cart, IngredientRecipe)
+from api.shopping_list import FORMATS, get_shopping_list
+from backend import routers
+from recipes import pantry, reference
+from recipes.models import (Cart, Favorite, Ingredient, IngredientRecipe,
+                            Recipe, ShoppingListItem, Tag)
+from recipes.versions import popularity
 from users.models import Subscription, User
 
 
-class IngredientsViewSet(viewsets.ModelViewSet):
+class ReplicaReadMixin:
+    # GET и HEAD читают из реплик, кроме нескольких секунд после записи
+    # того же пользователя, пока реплики догоняют основную базу.
+    replica_methods = ('GET', 'HEAD')
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if (request.method in self.replica_methods
+                and routers.get_replicas()
+                and not routers.is_sticky(request.user)):
+            routers.start_replica_reads()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        routers.stop_replica_reads()
+        if (request.method not in SAFE_METHODS
+                and routers.get_replicas()):
+            routers.stick(request.user)
+        return super().finalize_response(request, response, *args,
+                                         **kwargs)
+
+
+class ReferenceDataMixin:
+    reference = None
+
+    def list(self, request, *args, **kwargs):
+        snapshot = self.reference.load()
+        return self.get_reference_response(
+            request, snapshot, self.filter_queryset(snapshot.items))
+
+    def retrieve(self, request, *args, **kwargs):
+        snapshot = self.reference.load()
+        try:
+            item = self.reference.get(int(kwargs['pk']))
+        except ValueError:
+            raise Http404
+        if item is None:
+            raise Http404
+        return self.get_reference_response(request, snapshot, item)
+
+    def get_reference_response(self, request, snapshot, data):
+        response = (get_conditional_response(request, etag=snapshot.etag)
+                    or Response(data))
+        response['ETag'] = snapshot.etag
+        return response
+
+
+class IngredientsViewSet(ReplicaReadMixin, ReferenceDataMixin,
+                         viewsets.ModelViewSet):
     queryset = Ingredient.objects.all()
-    search_fields = ('^name',)
     serializer_class = IngredientsSerializer
     filter_backends = [IngredientsFilter]
     pagination_class = None
+    reference = reference.ingredients
 
 
-class TagsViewSet(viewsets.ModelViewSet):
+class TagsViewSet(ReplicaReadMixin, ReferenceDataMixin,
+                  viewsets.ModelViewSet):
     queryset = Tag.objects.all()
     serializer_class = TagsSerializer
     pagination_class = None
-
-
-class ResultsSetPagination(PageNumberPagination):
-    max_page_size = 100
-    page_size_query_param = 'limit'
-
-
-class RecipesPagination(PageNumberPagination):
-    page_size_query_param = 'limit'
-    max_page_size = 10
+    reference = reference.tags
 
 
 class IsAuthorRecipe(BasePermission):
@@ -53,7 +107,7 @@ class IsAuthorRecipe(BasePermission):
         return view.get_object().author == request.user
 
 
-class RecipesViewSet(viewsets.ModelViewSet):
+class RecipesViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     serializer_class = RecipeCreateSerializer
     filter_backends = (DjangoFilterBackend,)
@@ -61,15 +115,24 @@ class RecipesViewSet(viewsets.ModelViewSet):
     pagination_class = RecipesPagination
     permission_classes = (IsAuthorRecipe,)
 
+    def get_queryset(self):
+        queryset = Recipe.objects.defer('search_vector').with_user_flags(
+            self.request.user)
+        if self.action in ('list', 'retrieve', 'recommendations'):
+            return queryset.with_related()
+        return queryset
+
     def get_permissions(self):
         if self.action in ['update', 'destroy', 'partial_update', 'partial']:
             permission_classes = (IsAuthenticated, IsAuthorRecipe)
-        else:
+        elif self.action in ['list', 'retrieve', 'create']:
             permission_classes = (IsAuthenticatedOrReadOnly,)
+        else:
+            return super().get_permissions()
         return [permission() for permission in permission_classes]
 
     def get_serializer_class(self):
-        if self.action in ['list', 'retrieve']:
+        if self.action in ['list', 'retrieve', 'recommendations']:
             return RecipeSerializer
         return super().get_serializer_class()
 
@@ -79,7 +142,72 @@ class RecipesViewSet(viewsets.ModelViewSet):
         return super().dispatch(request, *args, **kwargs)
 
     def get_object(self):
-        return get_object_or_404(Recipe, id=self.kwargs['pk'])
+        return get_object_or_404(self.get_queryset(), id=self.kwargs['pk'])
+
+    def list(self, request, *args, **kwargs):
+        return cached_response(request, self, self.get_list_response,
+                               *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return cached_response(request, self, self.get_retrieve_response,
+                               *args, **kwargs)
+
+    def get_list_response(self, request, *args, **kwargs):
+        if self.paginator.counts_results(request):
+            state = self.filter_queryset(Recipe.objects.all()).aggregate(
+                count=Count('id'), updated_at=Max('updated_at'))
+            self.queryset_count = state['count']
+            etag_parts = (state['count'], state['updated_at'])
+            handler = super().list
+        else:
+            # Без общего числа рецептов ETag строится по самой странице.
+            page = self.paginate_queryset(
+                self.filter_queryset(self.get_queryset()))
+            etag_parts = (self.paginator.has_next,
+                          self.paginator.has_previous,
+                          *((recipe.id, recipe.updated_at) for recipe in page))
+            handler = partial(self.get_page_response, page)
+        if request.query_params.get('ordering') == 'popular':
+            etag_parts += (popularity.get(),)
+        return self.get_conditional_response(
+            request, handler, args, kwargs, etag_parts=etag_parts)
+
+    def get_page_response(self, page, request, *args, **kwargs):
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def get_retrieve_response(self, request, *args, **kwargs):
+        updated_at = get_object_or_404(
+            Recipe.objects.values_list('updated_at', flat=True),
+            id=kwargs['pk'])
+        return self.get_conditional_response(
+            request, super().retrieve, args, kwargs,
+            etag_parts=(updated_at,), last_modified=updated_at)
+
+    def get_conditional_response(self, request, handler, args, kwargs,
+                                 etag_parts, last_modified=None):
+        user = request.user
+        if not user.is_anonymous:
+            watermarks = (user.favorites_updated_at, user.cart_updated_at,
+                          user.subscriptions_updated_at)
+            etag_parts += (user.id,) + watermarks
+            if last_modified:
+                last_modified = max(last_modified, *watermarks)
+        etag = quote_etag(md5(repr(etag_parts).encode()).hexdigest())
+        if last_modified:
+            last_modified = int(last_modified.timestamp())
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (status.HTTP_200_OK,
+                                    status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = etag
+            if last_modified:
+                response['Last-Modified'] = http_date(last_modified)
+            patch_cache_control(response, private=True, no_cache=True)
+            patch_vary_headers(response, ('Authorization',))
+        return response
 
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
@@ -90,71 +218,232 @@ class RecipesViewSet(viewsets.ModelViewSet):
         permission_classes=[IsAuthenticated]
     )
     def favorite(self, request, *args, **kwargs):
-        recipe = get_object_or_404(Recipe, id=self.kwargs['pk'])
+        return self.toggle_relation(
+            request, Favorite, 'favorites_count',
+            exists_error='Рецепт уже в избранном',
+            missing_error='Рецепта нет в избранном')
+
+    @action(detail=True, methods=['POST', 'PATCH', 'DELETE'],
+            permission_classes=[IsAuthenticated])
+    def shopping_cart(self, request, *args, **kwargs):
+        missing_error = 'Рецепта нет в списке покупок'
+        servings = None
+        if request.method != 'DELETE':
+            serializer = CartServingsSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            servings = serializer.validated_data['servings']
+        if request.method == 'PATCH':
+            with transaction.atomic():
+                current = Cart.objects.set_servings(
+                    request.user, kwargs['pk'], servings)
+            if current is None:
+                get_object_or_404(Recipe, id=kwargs['pk'])
+                raise ValidationError({'errors': missing_error})
+            return Response({'id': int(kwargs['pk']), 'servings': servings})
+        return self.toggle_relation(
+            request, Cart, 'carts_count',
+            exists_error='Рецепт уже в списке покупок',
+            missing_error=missing_error, servings=servings)
+
+    def toggle_relation(self, request, model, counter, exists_error,
+                        missing_error, **values):
+        recipe_id = self.kwargs['pk']
         if request.method == 'POST':
-            Favorite.objects.create(recipe=recipe, user=request.user)
+            recipe = get_object_or_404(Recipe, id=recipe_id)
+            with transaction.atomic():
+                changed = model.objects.add(request.user, recipe=recipe,
+                                            **values)
+                if changed:
+                    Recipe.objects.filter(id=recipe.id).shift_counter(
+                        counter, changed)
+            if not changed:
+                raise ValidationError({'errors': exists_error})
             serializer = DetailRecipeSerializer(recipe, context={
                 'request': request})
-            return Response(serializer.data)
-
-        Favorite.objects.filter(recipe=recipe, user=request.user).delete()
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+        with transaction.atomic():
+            changed = model.objects.remove(request.user, recipe_id=recipe_id)
+            if changed:
+                Recipe.objects.filter(id=recipe_id).shift_counter(
+                    counter, -changed)
+        if not changed:
+            get_object_or_404(Recipe, id=recipe_id)
+            raise ValidationError({'errors': missing_error})
         return Response(status=status.HTTP_204_NO_CONTENT)
 
-    @action(detail=True, methods=['POST', 'DELETE'],
+    @action(detail=False, methods=['POST', 'DELETE'], url_path='favorite',
+            url_name='favorite-bulk', permission_classes=[IsAuthenticated])
+    def favorite_bulk(self, request, *args, **kwargs):
+        return self.toggle_relations(request, Favorite)
+
+    @action(detail=False, methods=['POST', 'DELETE'],
+            url_path='shopping_cart', url_name='shopping-cart-bulk',
             permission_classes=[IsAuthenticated])
-    def shopping_cart(self, request, *args, **kwargs):
-        recipe = get_object_or_404(Recipe, id=self.kwargs['pk'])
-        if self.request.method == 'POST':
-            Cart.objects.create(recipe=recipe, user=request.user)
-            serializer = DetailRecipeSerializer(recipe, context={
-                'request': self.request})
-            return Response(serializer.data, status=status.HTTP_200_OK)
+    def shopping_cart_bulk(self, request, *args, **kwargs):
+        return self.toggle_relations(request, Cart)
 
-        Cart.objects.filter(recipe=recipe, user=self.request.user).delete()
+    @action(detail=False, methods=['DELETE'], url_path='shopping_cart/clear',
+            permission_classes=[IsAuthenticated])
+    def clear_shopping_cart(self, request, *args, **kwargs):
+        with transaction.atomic():
+            Recipe.objects.filter(carts__user=request.user).shift_counter(
+                'carts_count', -1)
+            Cart.objects.remove(request.user)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    def toggle_relations(self, request, model):
+        serializer = RecipeIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        recipe_ids = serializer.validated_data['recipes']
+        with transaction.atomic():
+            if request.method == 'POST':
+                found = set(Recipe.objects.filter(
+                    id__in=recipe_ids).values_list('id', flat=True))
+                changed = model.objects.add_many(
+                    request.user, 'recipe_id',
+                    [recipe_id for recipe_id in recipe_ids
+                     if recipe_id in found])
+                statuses = ('added', 'exists')
+            else:
+                found = None
+                changed = model.objects.remove_many(
+                    request.user, 'recipe_id', recipe_ids)
+                statuses = ('removed', 'missing')
+            if changed:
+                Recipe.objects.filter(id__in=changed).recount()
+        changed = set(changed)
+        results = []
+        for recipe_id in recipe_ids:
+            if found is not None and recipe_id not in found:
+                result = 'not_found'
+            else:
+                result = statuses[recipe_id not in changed]
+            results.append({'id': recipe_id, 'status': result})
+        return Response({'results': results})
+
+    @action(detail=False, permission_classes=[IsAuthenticatedOrReadOnly])
+    def what_can_i_cook(self, request, *args, **kwargs):
+        serializer = PantrySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        available = serializer.validated_data['ingredients']
+        matches = pantry.index.match(available,
+                                     serializer.validated_data['limit'])
+        recipe_ids = [recipe_id for recipe_id, _, _ in matches]
+        recipes = Recipe.objects.only(
+            'id', 'name', 'image', 'image_variants', 'cooking_time').in_bulk(
+            recipe_ids)
+        rows = list(IngredientRecipe.objects.filter(
+            recipe_id__in=recipe_ids).exclude(
+            ingredient_id__in=available).order_by(
+            'id').values_list('recipe_id', 'ingredient_id'))
+        ingredients = reference.ingredients.get_many(
+            {ingredient_id for _, ingredient_id in rows})
+        missing = {recipe_id: [] for recipe_id in recipe_ids}
+        for recipe_id, ingredient_id in rows:
+            # Ингредиент могли удалить после выборки строк.
+            if ingredient_id in ingredients:
+                missing[recipe_id].append(ingredients[ingredient_id])
+        context = self.get_serializer_context()
+        results = [
+            {**DetailRecipeSerializer(recipes[recipe_id],
+                                      context=context).data,
+             'coverage': round(coverage, 3),
+             'matched': matched,
+             'missing': missing[recipe_id]}
+            for recipe_id, coverage, matched in matches
+            if recipe_id in recipes
+        ]
+        return Response({'results': results})
+
     @action(detail=False, permission_classes=[IsAuthenticated])
-    def download_shopping_cart(self, *args, **kwargs):
-        items = IngredientRecipe.objects.filter(
-            recipe__carts__user=self.request.user).values(
-            'ingredient__name',
-            'ingredient__measurement_unit').annotate(
-            total_am=Sum('amount')).order_by()
-        list_shopping = 'Список покупок\n'
-        for item in items:
-            list_shopping += (f'{item["ingredient__name"]} '
-                              f'({item["ingredient__measurement_unit"]}) - '
-                              f'{item["total_am"]}\n')
-        response = HttpResponse(content=list_shopping,
-                                content_type='text/plain')
-        response['Content-Disposition'] = ('attachment; '
-                                           'filename="shopping_list.txt"')
+    def recommendations(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+        if request.user.recommendations.exists():
+            # Подборка пересчитывается периодически: добавленное с тех пор
+            # в избранное из выдачи убирается сразу.
+            queryset = queryset.filter(
+                recommendations__user=request.user).exclude(
+                favorites__user=request.user).order_by(
+                'recommendations__position')
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=False, permission_classes=[IsAuthenticated])
+    def shopping_list(self, request, *args, **kwargs):
+        return Response(list(get_shopping_list(request.user)))
+
+    @action(detail=False, permission_classes=[IsAuthenticated])
+    def download_shopping_cart(self, request, *args, **kwargs):
+        file_type = request.query_params.get('type', 'txt')
+        if file_type not in FORMATS:
+            raise ValidationError(
+                {'type': f'Доступные форматы: {", ".join(FORMATS)}'})
+        render, content_type = FORMATS[file_type]
+        response = StreamingHttpResponse(
+            render(get_shopping_list(request.user)),
+            content_type=content_type)
+        response['Content-Disposition'] = (
+            f'attachment; filename="shopping_list.{file_type}"')
         return response
 
 
-class UsersViewSet(viewsets.ModelViewSet):
+class UsersViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = CustomUserSerializer
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        user = self.request.user
+        if user.is_anonymous:
+            return queryset
+        return queryset.annotate(is_subscribed=Exists(
+            Subscription.objects.filter(user=user, author=OuterRef('pk'))))
+
     def get_serializer_class(self):
         if self.action in ['create', 'update']:
             return CustomUserCreateSerializer
         return super().get_serializer_class()
 
+    def perform_destroy(self, instance):
+        with transaction.atomic(), ShoppingListItem.objects.release_author(
+                instance):
+            instance.delete()
+
     @action(detail=False, methods=['GET'],
             permission_classes=[IsAuthenticated])
     def subscriptions(self, request, *args, **kwargs):
+        recipes_limit = request.query_params.get('recipes_limit')
+        if recipes_limit is not None:
+            if not recipes_limit.isdigit():
+                raise ValidationError({
+                    'recipes_limit': 'Укажите неотрицательное целое число'})
+            recipes_limit = int(recipes_limit)
         subscriptions = User.objects.filter(
-            author_subscriptions__user=request.user)
+            author_subscriptions__user=request.user).annotate(
+            recipes_count=Count('recipes'),
+            is_subscribed=Value(True, output_field=BooleanField()),
+        ).order_by('id')
         page = self.paginate_queryset(subscriptions)
-        serializer = SubscriptionSerializer(page, many=True,
-                                            context={'request': request})
+        recipes = Recipe.objects.filter(author__in=page)
+        if recipes_limit:
+            recipes = recipes.latest_per_author(recipes_limit)
+        prefetch_related_objects(page, Prefetch(
+            'recipes',
+            queryset=recipes.only('id', 'name', 'image', 'image_variants',
+                                  'cooking_time', 'author_id'),
+            to_attr='recipe_previews'))
+        serializer = SubscriptionSerializer(
+            page, many=True,
+            context={'request': request, 'recipes_limit': recipes_limit})
         return self.get_paginated_response(serializer.data)
 
     @action(detail=False, methods=['GET'],
             permission_classes=[IsAuthenticated])
     def me(self, request, *args, **kwargs):
-        user = get_object_or_404(User, id=request.user.id)
+        user = request.user
+        user.is_subscribed = False
         serializer = self.get_serializer(user)
         return Response(serializer.data)
 
@@ -164,14 +453,22 @@ class UsersViewSet(viewsets.ModelViewSet):
         permission_classes=[IsAuthenticated]
     )
     def subscribe(self, request, *args, **kwargs):
-        author = get_object_or_404(User, id=kwargs['pk'])
+        author_id = kwargs['pk']
         if self.request.method == 'DELETE':
-            author.author_subscriptions.filter(user=request.user).delete()
+            if not Subscription.objects.remove(request.user,
+                                               author_id=author_id):
+                get_object_or_404(User, id=author_id)
+                raise ValidationError({'errors': 'Вы не подписаны'})
             return Response(status=status.HTTP_204_NO_CONTENT)
 
-        Subscription.objects.create(author=author, user=request.user)
+        author = get_object_or_404(User, id=author_id)
+        if author == request.user:
+            raise ValidationError({'errors': 'Нельзя подписаться на себя'})
+        if not Subscription.objects.add(request.user, author=author):
+            raise ValidationError({'errors': 'Вы уже подписаны'})
+        author.is_subscribed = True
         serializer = self.get_serializer(author)
-        return Response(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     @action(
         detail=False,
@@ -184,6 +481,6 @@ class UsersViewSet(viewsets.ModelViewSet):
         serializer.is_valid(raise_exception=True)
         self.request.user.set_password(
             serializer.validated_data['new_password'])
-        self.request.user.save()
+        self.request.user.save(update_fields=['password'])
         return Response(data={'status': f'set password '
                                         f' {request.user.username}'})
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+
+# Кеши, которые не видны другим воркерам или в которых add и incr не
+# атомарны.
+UNSHARED_BACKENDS = (DummyCache, FileBasedCache, LocMemCache)
+SHARED_CACHE_SETTINGS = ('REFERENCE_DATA_CACHE', 'RESPONSE_CACHE',
+                         'AUTH_TOKEN_CACHE', 'REPLICA_STICKY_CACHE')
+
+
+# Сброс версий, отзыв токенов и метки записи доходят до всех воркеров
+# только через общий кеш. Без него эти механизмы отключаются, если
+# приложение не работает в одном процессе (CACHE_SINGLE_PROCESS).
+def is_shared(alias):
+    return (settings.CACHE_SINGLE_PROCESS
+            or not isinstance(caches[alias], UNSHARED_BACKENDS))
+
+
+@checks.register(checks.Tags.caches, deploy=True)
+def check_shared_caches(app_configs, **kwargs):
+    return [
+        checks.Warning(
+            f'Кеш {getattr(settings, name)!r} из {name} не общий для '
+            f'воркеров: кеширование, которое от него зависит, отключено.',
+            hint=('Укажите в CACHE_BACKEND общий кеш, например '
+                  'PyMemcacheCache.'),
+            id='backend.W001',
+        )
+        for name in SHARED_CACHE_SETTINGS
+        if not is_shared(getattr(settings, name))
+    ]
@@ -0,0 +1,116 @@
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+from backend.caches import is_shared
+
+logger = logging.getLogger(__name__)
+
+STICKY_KEY = 'replicas:sticky'
+
+local = threading.local()
+# Реплика -> момент, до которого к ней не подключаемся после ошибки.
+unavailable = {}
+
+
+def get_cache():
+    return caches[settings.REPLICA_STICKY_CACHE]
+
+
+def get_replicas():
+    return [alias for alias in settings.DATABASES
+            if alias != DEFAULT_DB_ALIAS]
+
+
+def connect(alias):
+    if time.monotonic() < unavailable.get(alias, 0):
+        return False
+    try:
+        connections[alias].ensure_connection()
+    except DatabaseError:
+        logger.warning('Реплика %s недоступна', alias, exc_info=True)
+        unavailable[alias] = time.monotonic() + settings.REPLICA_RETRY_AFTER
+        return False
+    unavailable.pop(alias, None)
+    return True
+
+
+def choose_replica():
+    replicas = get_replicas()
+    random.shuffle(replicas)
+    for alias in replicas:
+        if connect(alias):
+            return alias
+    return DEFAULT_DB_ALIAS
+
+
+# Метку записи, поставленную в локальном кеше, другие воркеры не увидят:
+# без общего кеша авторизованные пользователи читают из основной базы.
+def is_sticky(user):
+    if not user.is_authenticated:
+        return False
+    return (not is_shared(settings.REPLICA_STICKY_CACHE)
+            or get_cache().get(f'{STICKY_KEY}:{user.id}') is not None)
+
+
+def stick(user):
+    if user.is_authenticated:
+        get_cache().set(f'{STICKY_KEY}:{user.id}', 1,
+                        settings.REPLICA_STICKY_TIMEOUT)
+
+
+def start_replica_reads():
+    local.enabled = True
+    local.replica = None
+
+
+def stop_replica_reads():
+    local.enabled = False
+    local.replica = None
+
+
+# Данные, которые попадают в общий кеш, читаются из основной базы:
+# иначе отставшая реплика закеширует устаревшую версию.
+@contextmanager
+def primary():
+    enabled = getattr(local, 'enabled', False)
+    local.enabled = False
+    try:
+        yield
+    finally:
+        local.enabled = enabled
+
+
+def check_connections(**kwargs):
+    if not settings.DATABASE_HEALTH_CHECKS:
+        return
+    for connection in connections.all():
+        if connection.connection is not None and not connection.is_usable():
+            connection.close()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not getattr(local, 'enabled', False) or connections[
+                DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        if local.replica is None:
+            local.replica = choose_replica()
+        return local.replica
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db != DEFAULT_DB_ALIAS:
+            return False
+        return None
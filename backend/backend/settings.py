@@ -16,6 +16,7 @@ DEBUG = bool(strtobool(os.environ.get('DEBUG', 'False')))
 INSTALLED_APPS = [
     'users',
     'recipes',
+    'api',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -30,6 +31,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -70,8 +72,47 @@ DATABASES = {
         'PASSWORD': os.environ.get('POSTGRES_PASSWORD', 'password'),
         'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
         'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        'CONN_MAX_AGE': int(os.environ.get('CONN_MAX_AGE', 60)),
     }
 }
+# Реплики для чтения через пробел: для PostgreSQL — host[:port],
+# для SQLite — пути к файлам.
+for number, replica in enumerate(
+        os.environ.get('DATABASE_REPLICAS', '').split(), 1):
+    if DATABASES['default']['ENGINE'].endswith('sqlite3'):
+        location = {'NAME': replica}
+    else:
+        host, _, port = replica.partition(':')
+        location = {'HOST': host, 'PORT': port or DATABASES['default']['PORT']}
+    DATABASES[f'replica_{number}'] = {
+        **DATABASES['default'], **location, 'TEST': {'MIRROR': 'default'}}
+
+DATABASE_ROUTERS = ['backend.routers.ReplicaRouter']
+DATABASE_HEALTH_CHECKS = bool(
+    strtobool(os.environ.get('DATABASE_HEALTH_CHECKS', 'True')))
+REPLICA_STICKY_CACHE = 'default'
+REPLICA_STICKY_TIMEOUT = int(os.environ.get('REPLICA_STICKY_TIMEOUT', 5))
+REPLICA_RETRY_AFTER = int(os.environ.get('REPLICA_RETRY_AFTER', 30))
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
+# LocMemCache годится только для одного процесса (runserver).
+CACHE_SINGLE_PROCESS = bool(
+    strtobool(os.environ.get('CACHE_SINGLE_PROCESS', str(DEBUG))))
+REFERENCE_DATA_CACHE = 'default'
+RESPONSE_CACHE = 'default'
+AUTH_TOKEN_CACHE = 'default'
+AUTH_TOKEN_CACHE_TIMEOUT = int(
+    os.environ.get('AUTH_TOKEN_CACHE_TIMEOUT', 300))
+RESPONSE_CACHE_TIMEOUT = int(os.environ.get('RESPONSE_CACHE_TIMEOUT', 600))
 
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -125,7 +166,7 @@ REST_FRAMEWORK = {
         'rest_framework.renderers.JSONRenderer',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'users.authentication.CachedTokenAuthentication',
     ),
     'DEFAULT_PAGINATION_CLASS':
         'rest_framework.pagination.PageNumberPagination',
@@ -140,3 +181,31 @@ SIMPLE_JWT = {
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 LIMIT_VIEW_SYMBOLS = 50
+
+INGREDIENTS_SEARCH_LIMIT = int(
+    os.environ.get('INGREDIENTS_SEARCH_LIMIT', 20))
+INGREDIENTS_SEARCH_TRIGRAM = bool(
+    strtobool(os.environ.get('INGREDIENTS_SEARCH_TRIGRAM', 'True')))
+INGREDIENTS_SEARCH_MIN_SUBSTRING = int(
+    os.environ.get('INGREDIENTS_SEARCH_MIN_SUBSTRING', 3))
+
+PDF_FONT_PATH = os.environ.get(
+    'PDF_FONT_PATH', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+
+IMAGE_MAX_UPLOAD_SIZE = int(
+    os.environ.get('IMAGE_MAX_UPLOAD_SIZE', 5 * 1024 * 1024))
+IMAGE_MAX_DIMENSION = int(os.environ.get('IMAGE_MAX_DIMENSION', 4096))
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 2))
+
+PANTRY_WARM_UP = bool(strtobool(os.environ.get('PANTRY_WARM_UP', 'True')))
+
+RECOMMENDATIONS_LIMIT = int(os.environ.get('RECOMMENDATIONS_LIMIT', 100))
+
+DATA_UPLOAD_MAX_MEMORY_SIZE = IMAGE_MAX_UPLOAD_SIZE * 4 // 3 + 1024 * 1024
+
+PROFILING_ENABLED = bool(
+    strtobool(os.environ.get('PROFILING_ENABLED', 'False')))
+PROFILING_TOKEN = os.environ.get('PROFILING_TOKEN', '')
+PROFILING_DUMP_DIR = os.environ.get(
+    'PROFILING_DUMP_DIR', '/var/tmp/foodgram_profiles')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
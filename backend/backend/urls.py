@@ -2,8 +2,11 @@ from django.contrib import admin
 from django.urls import include, path
 from djoser.views import TokenCreateView, TokenDestroyView
 
+from api.profiling import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
     path('api/', include('rest_framework.urls', namespace='rest_framework')),
     path('api/', include('api.urls')),
     path('api/auth/', include('djoser.urls')),
@@ -1,12 +1,78 @@
 from django.contrib import admin
 
+from recipes import pantry
 from recipes.models import (
-    Cart, Favorite, Ingredient, IngredientRecipe, Recipe, Tag)
+    Cart, Favorite, Ingredient, IngredientRecipe, Recipe, ShoppingListItem,
+    Tag)
+from users.admin import RelationAdmin
 
-admin.site.register(Favorite)
-admin.site.register(IngredientRecipe)
 admin.site.register(Tag)
-admin.site.register(Cart)
+
+
+def rebuild_shopping_lists(recipe_ids):
+    ShoppingListItem.objects.rebuild(set(Cart.objects.filter(
+        recipe_id__in=recipe_ids).values_list('user_id', flat=True)))
+
+
+class RecipeCounterAdmin(RelationAdmin):
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        Recipe.objects.filter(
+            id__in={obj.recipe_id, form.initial.get('recipe')}).recount()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        Recipe.objects.filter(id=obj.recipe_id).recount()
+
+    def delete_queryset(self, request, queryset):
+        recipe_ids = set(queryset.values_list('recipe_id', flat=True))
+        super().delete_queryset(request, queryset)
+        Recipe.objects.filter(id__in=recipe_ids).recount()
+
+
+@admin.register(Cart)
+class CartAdmin(RecipeCounterAdmin):
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        ShoppingListItem.objects.rebuild(
+            {obj.user_id, form.initial.get('user')} - {None})
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        ShoppingListItem.objects.rebuild({obj.user_id})
+
+    def delete_queryset(self, request, queryset):
+        user_ids = set(queryset.values_list('user_id', flat=True))
+        super().delete_queryset(request, queryset)
+        ShoppingListItem.objects.rebuild(user_ids)
+
+
+admin.site.register(Favorite, RecipeCounterAdmin)
+
+
+@admin.register(IngredientRecipe)
+class IngredientRecipeAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        self.recipes_changed({obj.recipe_id, form.initial.get('recipe')})
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        self.recipes_changed({obj.recipe_id})
+
+    def delete_queryset(self, request, queryset):
+        recipe_ids = set(queryset.values_list('recipe_id', flat=True))
+        super().delete_queryset(request, queryset)
+        self.recipes_changed(recipe_ids)
+
+    def recipes_changed(self, recipe_ids):
+        recipe_ids.discard(None)
+        recipes = Recipe.objects.filter(id__in=recipe_ids)
+        recipes.touch()
+        recipes.invalidate_responses()
+        recipes.update_search_index()
+        pantry.record_changes(recipe_ids)
+        rebuild_shopping_lists(recipe_ids)
 
 
 class IngredientInline(admin.TabularInline):
@@ -14,22 +80,35 @@ class IngredientInline(admin.TabularInline):
     min_num = 1
 
 
+class TagInline(admin.TabularInline):
+    model = Recipe.tags.through
+    min_num = 1
+
+
 class IngredientAdmin(admin.ModelAdmin):
     list_filter = ('name',)
     list_display = ('name', 'measurement_unit')
 
 
 class RecipeAdmin(admin.ModelAdmin):
-    list_display = ('name', 'author', 'favorites')
+    list_display = ('name', 'author', 'favorites', 'carts_count')
     list_filter = ('author', 'name', 'tags')
     inlines = (
+        TagInline,
         IngredientInline,
     )
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        Recipe.objects.filter(id=form.instance.id).update_search_index()
+        pantry.record_changes([form.instance.id])
+        rebuild_shopping_lists([form.instance.id])
+
     def favorites(self, obj):
-        return obj.favorites.count()
+        return obj.favorites_count
 
     favorites.short_description = 'Находится в избранном'
+    favorites.admin_order_field = 'favorites_count'
 
 
 admin.site.register(Recipe, RecipeAdmin)
@@ -0,0 +1,113 @@
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import PurePosixPath
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.utils import timezone
+from PIL import Image
+
+from recipes.models import Recipe
+from recipes.versions import get_recipe_scopes, responses
+
+logger = logging.getLogger(__name__)
+
+VARIANTS_DIR = 'recipes/variants'
+VARIANTS = {
+    'thumbnail': (160, 160),
+    'list': (480, 480),
+}
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True,
+                      'progressive': True}),
+}
+
+executor = (ThreadPoolExecutor(max_workers=settings.IMAGE_WORKERS,
+                               thread_name_prefix='recipe-images')
+            if settings.IMAGE_WORKERS else None)
+
+
+def build_variants(source):
+    with default_storage.open(source) as file, Image.open(file) as image:
+        image.draft('RGB', max(VARIANTS.values()))
+        image = image.convert('RGB')
+    stem = PurePosixPath(source).stem
+    files = {}
+    for variant, size in VARIANTS.items():
+        resized = image.copy()
+        resized.thumbnail(size, Image.LANCZOS)
+        files[variant] = {}
+        for extension, (image_format, options) in FORMATS.items():
+            buffer = io.BytesIO()
+            resized.save(buffer, image_format, **options)
+            files[variant][extension] = default_storage.save(
+                f'{VARIANTS_DIR}/{stem}_{variant}.{extension}',
+                ContentFile(buffer.getvalue()))
+    return {'source': source, 'files': files}
+
+
+def get_files(variants):
+    return {name for files in variants.get('files', {}).values()
+            for name in files.values()}
+
+
+def delete_files(names):
+    for name in names:
+        default_storage.delete(name)
+
+
+def process_image(recipe_id, source):
+    try:
+        variants = build_variants(source)
+        with transaction.atomic():
+            row = Recipe.objects.select_for_update().filter(
+                id=recipe_id, image=source).values_list(
+                'image_variants', 'author_id').first()
+            if row is None:
+                # Рецепт удалён или изображение успело смениться.
+                stale = get_files(variants)
+            else:
+                previous, author_id = row
+                Recipe.objects.filter(id=recipe_id).update(
+                    image_variants=variants, updated_at=timezone.now())
+                stale = get_files(previous) - get_files(variants)
+                transaction.on_commit(partial(
+                    responses.invalidate,
+                    *get_recipe_scopes(recipe_id, author_id)))
+            transaction.on_commit(partial(delete_files, stale))
+    except Exception:
+        logger.exception('Не удалось обработать изображение %s', source)
+
+
+# Потоки пула не проходят через обработку запросов Django, поэтому своё
+# соединение с базой закрывают сами.
+def process_image_in_worker(recipe_id, source):
+    try:
+        process_image(recipe_id, source)
+    finally:
+        connection.close()
+
+
+def schedule_variants(recipe):
+    if (not recipe.image
+            or recipe.image_variants.get('source') == recipe.image.name):
+        return
+    if executor is None:
+        transaction.on_commit(
+            partial(process_image, recipe.id, recipe.image.name))
+    else:
+        transaction.on_commit(partial(
+            executor.submit, process_image_in_worker, recipe.id,
+            recipe.image.name))
+
+
+def get_variants(recipe):
+    variants = recipe.image_variants
+    if not recipe.image or variants.get('source') != recipe.image.name:
+        return {}
+    return variants['files']
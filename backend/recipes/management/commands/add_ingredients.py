@@ -1,16 +1,137 @@
+import csv
 import json
+import time
+from functools import partial
+from itertools import islice
+from pathlib import Path
 
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
 
 from backend.settings import BASE_DIR
 from recipes.models import Ingredient
+from recipes.reference import ingredients
+
+READ_SIZE = 64 * 1024
+JSON_SEPARATORS = ' \t\r\n[],'
+
+
+def read_json(file):
+    decoder = json.JSONDecoder()
+    buffer = ''
+    for chunk in iter(partial(file.read, READ_SIZE), ''):
+        buffer += chunk
+        position = 0
+        while True:
+            while (position < len(buffer)
+                   and buffer[position] in JSON_SEPARATORS):
+                position += 1
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break
+            yield item['name'], item['measurement_unit']
+        buffer = buffer[position:]
+    if buffer.strip(JSON_SEPARATORS):
+        raise CommandError('Некорректный JSON в конце файла')
+
+
+def read_csv(file):
+    for row in csv.reader(file):
+        if row:
+            yield row[0], row[1]
+
+
+READERS = {
+    '.json': read_json,
+    '.csv': read_csv,
+}
+
+
+class CSVStream:
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = ''
+        self.writer = csv.writer(self)
+
+    def write(self, value):
+        self.buffer += value
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow(row)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
 
 
 class Command(BaseCommand):
+    help = ('Загружает ингредиенты из JSON или CSV. Повторный запуск '
+            'не создаёт дубликатов')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?',
+            default=str(BASE_DIR / 'data' / 'ingredients.json'))
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--copy', action='store_true',
+                            help='Загрузка через COPY (только PostgreSQL)')
+
     def handle(self, *args, **options):
-        with open(BASE_DIR / 'data' / 'ingredients.json', 'rb') as file:
-            ingredients = json.load(file)
-            for ingredient in ingredients:
-                Ingredient.objects.create(name=ingredient['name'],
-                                          measurement_unit=ingredient[
-                                              'measurement_unit'])
+        path = Path(options['path'])
+        reader = READERS.get(path.suffix.lower())
+        if reader is None:
+            raise CommandError(
+                f'Поддерживаются форматы: {", ".join(READERS)}')
+        if options['copy'] and connection.vendor != 'postgresql':
+            raise CommandError('COPY доступен только для PostgreSQL')
+
+        started = time.perf_counter()
+        before = Ingredient.objects.count()
+        with open(path, encoding='utf-8') as file, transaction.atomic():
+            rows = reader(file)
+            if options['copy']:
+                processed = self.copy(rows)
+            else:
+                processed = self.bulk_create(rows, options['batch_size'])
+        created = Ingredient.objects.count() - before
+        if created:
+            ingredients.invalidate()
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано {processed} строк, добавлено {created} '
+            f'ингредиентов за {elapsed:.2f} с '
+            f'({processed / elapsed:.0f} строк/с)'))
+
+    def bulk_create(self, rows, batch_size):
+        processed = 0
+        while True:
+            batch = [Ingredient(name=name, measurement_unit=measurement_unit)
+                     for name, measurement_unit in islice(rows, batch_size)]
+            if not batch:
+                return processed
+            Ingredient.objects.bulk_create(batch, ignore_conflicts=True)
+            processed += len(batch)
+
+    def copy(self, rows):
+        table = connection.ops.quote_name(Ingredient._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMPORARY TABLE ingredients_import '
+                '(name varchar(120), measurement_unit varchar(10)) '
+                'ON COMMIT DROP')
+            cursor.copy_expert(
+                'COPY ingredients_import (name, measurement_unit) '
+                'FROM STDIN WITH (FORMAT csv)', CSVStream(rows))
+            cursor.execute('SELECT count(*) FROM ingredients_import')
+            processed = cursor.fetchone()[0]
+            cursor.execute(
+                f'INSERT INTO {table} (name, measurement_unit) '
+                'SELECT DISTINCT name, measurement_unit '
+                'FROM ingredients_import '
+                'ON CONFLICT (name, measurement_unit) DO NOTHING')
+        return processed
@@ -0,0 +1,25 @@
+from django.core.management import BaseCommand
+
+from recipes.images import get_variants, process_image
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = ('Создаёт уменьшенные копии изображений рецептов, для которых '
+            'они ещё не построены')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help='Перестроить копии для всех рецептов')
+
+    def handle(self, *args, **options):
+        processed = 0
+        recipes = Recipe.objects.only('id', 'image', 'image_variants')
+        for recipe in recipes.iterator():
+            if not recipe.image or (get_variants(recipe)
+                                    and not options['force']):
+                continue
+            process_image(recipe.id, recipe.image.name)
+            processed += 1
+        self.stdout.write(self.style.SUCCESS(
+            f'Обработано изображений: {processed}'))
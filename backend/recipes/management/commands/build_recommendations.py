@@ -0,0 +1,17 @@
+import time
+
+from django.core.management import BaseCommand
+
+from recipes.recommendations import RecommendationBuilder
+
+
+class Command(BaseCommand):
+    help = ('Пересчитывает персональные рекомендации рецептов по избранному, '
+            'подпискам и тегам')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        created = RecommendationBuilder().build()
+        self.stdout.write(self.style.SUCCESS(
+            f'Сохранено рекомендаций: {created} '
+            f'за {time.perf_counter() - started:.1f} с'))
@@ -0,0 +1,38 @@
+from django.core.management import BaseCommand, CommandError
+
+from recipes.models import ShoppingListItem
+from users.models import User
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = ('Сверяет сохранённые списки покупок с корзинами пользователей '
+            'и исправляет расхождения')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Только проверить, завершиться с ошибкой при расхождениях')
+
+    def handle(self, *args, **options):
+        ids = User.objects.order_by('id').values_list('id', flat=True)
+        mismatched = 0
+        last_id = 0
+        while True:
+            batch = list(ids.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            mismatched += ShoppingListItem.objects.rebuild(
+                batch, check=options['check'])
+            last_id = batch[-1]
+        if options['check']:
+            if mismatched:
+                raise CommandError(
+                    f'Расхождений в списках покупок: {mismatched}')
+            self.stdout.write(self.style.SUCCESS(
+                'Списки покупок совпадают с корзинами'))
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f'Исправлено строк списков покупок: {mismatched}'))
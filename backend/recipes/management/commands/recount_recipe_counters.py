@@ -0,0 +1,13 @@
+from django.core.management import BaseCommand
+
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = ('Сверяет счётчики избранного и списков покупок рецептов '
+            'с фактическими данными и исправляет расхождения')
+
+    def handle(self, *args, **options):
+        fixed = Recipe.objects.recount()
+        self.stdout.write(self.style.SUCCESS(
+            f'Исправлено счётчиков рецептов: {fixed}'))
@@ -0,0 +1,27 @@
+from django.core.management import BaseCommand
+
+from recipes.models import Recipe
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = ('Перестраивает поисковый индекс рецептов: название, описание '
+            'и названия ингредиентов')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        ids = Recipe.objects.order_by('id').values_list('id', flat=True)
+        indexed = 0
+        last_id = 0
+        while True:
+            batch = list(ids.filter(id__gt=last_id)[:options['batch_size']])
+            if not batch:
+                break
+            indexed += Recipe.objects.filter(
+                id__in=batch).update_search_index()
+            last_id = batch[-1]
+        self.stdout.write(self.style.SUCCESS(
+            f'Проиндексировано рецептов: {indexed}'))
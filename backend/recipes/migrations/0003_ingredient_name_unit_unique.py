@@ -0,0 +1,50 @@
+from django.db import migrations, models
+
+MAX_AMOUNT = 32767
+
+
+# Дубликаты ингредиента сливаются в запись с наименьшим id: строки
+# рецептов переносятся на неё, совпавшие в одном рецепте суммируются.
+def merge_duplicate_ingredients(apps, schema_editor):
+    Ingredient = apps.get_model('recipes', 'Ingredient')
+    IngredientRecipe = apps.get_model('recipes', 'IngredientRecipe')
+    duplicates = Ingredient.objects.values(
+        'name', 'measurement_unit').annotate(
+        keep_id=models.Min('id'), count=models.Count('id')).filter(
+        count__gt=1).order_by()
+    for group in duplicates:
+        keep_id = group['keep_id']
+        merged_ids = list(Ingredient.objects.filter(
+            name=group['name'],
+            measurement_unit=group['measurement_unit']).exclude(
+            id=keep_id).values_list('id', flat=True))
+        for item in IngredientRecipe.objects.filter(
+                ingredient_id__in=merged_ids).order_by('id'):
+            kept = IngredientRecipe.objects.filter(
+                recipe_id=item.recipe_id, ingredient_id=keep_id).first()
+            if kept is None:
+                item.ingredient_id = keep_id
+                item.save(update_fields=['ingredient'])
+            else:
+                kept.amount = min(kept.amount + item.amount, MAX_AMOUNT)
+                kept.save(update_fields=['amount'])
+                item.delete()
+        Ingredient.objects.filter(id__in=merged_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_ingredients,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='ingredient',
+            constraint=models.UniqueConstraint(
+                fields=('name', 'measurement_unit'),
+                name='ingredient_name_unit_unique'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+# Из повторяющихся строк корзины остаётся строка с наименьшим id.
+def delete_duplicate_carts(apps, schema_editor):
+    Cart = apps.get_model('recipes', 'Cart')
+    kept = Cart.objects.values('user', 'recipe').annotate(
+        keep_id=models.Min('id')).order_by().values('keep_id')
+    Cart.objects.exclude(id__in=models.Subquery(kept)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0003_ingredient_name_unit_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_carts,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(
+                fields=('user', 'recipe'), name='cart_recipe_user_unique'),
+        ),
+    ]
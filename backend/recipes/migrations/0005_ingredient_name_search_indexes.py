@@ -0,0 +1,33 @@
+from django.db import migrations
+
+from recipes.operations import RunVendorSQL
+
+
+# Django 3.2 не описывает в Meta индексы по выражениям с классами
+# операторов. IF NOT EXISTS нужен для баз, где индексы уже созданы.
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0004_cart_recipe_user_unique'),
+    ]
+
+    operations = [
+        RunVendorSQL(
+            'postgresql',
+            sql='CREATE INDEX IF NOT EXISTS ingredient_name_prefix_idx '
+                'ON recipes_ingredient (UPPER(name::text) text_pattern_ops)',
+            reverse_sql='DROP INDEX IF EXISTS ingredient_name_prefix_idx',
+        ),
+        RunVendorSQL(
+            'postgresql',
+            sql='CREATE EXTENSION IF NOT EXISTS pg_trgm',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        RunVendorSQL(
+            'postgresql',
+            sql='CREATE INDEX IF NOT EXISTS ingredient_name_trgm_idx '
+                'ON recipes_ingredient '
+                'USING gin (UPPER(name::text) gin_trgm_ops)',
+            reverse_sql='DROP INDEX IF EXISTS ingredient_name_trgm_idx',
+        ),
+    ]
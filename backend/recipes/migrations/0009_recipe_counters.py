@@ -0,0 +1,42 @@
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def count_rows(model):
+    return Coalesce(models.Subquery(
+        model.objects.filter(recipe=models.OuterRef('pk')).order_by().values(
+            'recipe').annotate(count=models.Count('id')).values('count')), 0)
+
+
+# Счётчики для уже существующих избранного и корзин.
+def fill_counters(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    Favorite = apps.get_model('recipes', 'Favorite')
+    Cart = apps.get_model('recipes', 'Cart')
+    Recipe.objects.update(favorites_count=count_rows(Favorite),
+                          carts_count=count_rows(Cart))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0008_recipe_image_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='carts_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Добавлений в список покупок'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Добавлений в избранное'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-favorites_count', '-pub_date', '-id'], name='recipe_popular_idx'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
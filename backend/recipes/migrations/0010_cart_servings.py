@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_recipe_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='servings',
+            field=models.PositiveSmallIntegerField(default=1, verbose_name='Множитель порций'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+import django.contrib.postgres.search
+from django.db import migrations
+
+from recipes.operations import RunVendorSQL
+
+
+# В SQLite поиском занимается отдельная таблица FTS5: строки обновляются
+# вместе с рецептом, а удаляются триггером. SQLite удаляет триггер при
+# пересоздании таблицы рецептов, такие миграции должны создавать его снова.
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0011_recipetag_and_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True, verbose_name='Поисковый индекс'),
+        ),
+        RunVendorSQL(
+            'postgresql',
+            sql='CREATE INDEX IF NOT EXISTS recipe_search_vector_idx '
+                'ON recipes_recipe USING gin (search_vector)',
+            reverse_sql='DROP INDEX IF EXISTS recipe_search_vector_idx',
+        ),
+        RunVendorSQL(
+            'sqlite',
+            sql='CREATE VIRTUAL TABLE IF NOT EXISTS recipes_recipe_search '
+                'USING fts5(name, text, ingredients, '
+                'tokenize="unicode61 remove_diacritics 2")',
+            reverse_sql='DROP TABLE IF EXISTS recipes_recipe_search',
+        ),
+        RunVendorSQL(
+            'sqlite',
+            sql='CREATE TRIGGER IF NOT EXISTS recipes_recipe_search_delete '
+                'AFTER DELETE ON recipes_recipe BEGIN '
+                'DELETE FROM recipes_recipe_search WHERE rowid = old.id; END',
+            reverse_sql='DROP TRIGGER IF EXISTS recipes_recipe_search_delete',
+        ),
+    ]
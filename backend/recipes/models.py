@@ -1,9 +1,18 @@
+import threading
+from contextlib import contextmanager
+from functools import partial
+
 from colorfield.fields import ColorField
-from django.db import models
+from django.contrib.postgres.search import SearchVectorField
+from django.db import models, transaction
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce, RowNumber
 from django.conf import settings
-from rest_framework.exceptions import ValidationError
+from django.utils import timezone
 
-from users.models import User
+from recipes import search
+from recipes.versions import get_recipe_scopes, popularity, responses
+from users.models import RelationQuerySet, Subscription, User
 
 
 class Ingredient(models.Model):
@@ -13,6 +22,12 @@ class Ingredient(models.Model):
     class Meta:
         verbose_name = 'Ингредиент'
         verbose_name_plural = 'Ингредиенты'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['name', 'measurement_unit'],
+                name='ingredient_name_unit_unique'
+            )
+        ]
 
     def __str__(self):
         return self.name[:settings.LIMIT_VIEW_SYMBOLS]
@@ -35,38 +50,169 @@ class Tag(models.Model):
         return self.name[:settings.LIMIT_VIEW_SYMBOLS]
 
 
+def count_recipe_rows(model):
+    return Coalesce(models.Subquery(
+        model.objects.filter(recipe=models.OuterRef('pk')).order_by().values(
+            'recipe').annotate(count=models.Count('id')).values('count')), 0)
+
+
+class RecipeQuerySet(models.QuerySet):
+    def with_related(self):
+        return self.select_related('author').prefetch_related(
+            'tags',
+            models.Prefetch(
+                'recipe_ingredients',
+                queryset=IngredientRecipe.objects.select_related(
+                    'ingredient')),
+        )
+
+    def with_user_flags(self, user):
+        if user.is_anonymous:
+            return self
+        return self.annotate(
+            is_favorited=models.Exists(Favorite.objects.filter(
+                user=user, recipe=models.OuterRef('pk'))),
+            is_in_shopping_cart=models.Exists(Cart.objects.filter(
+                user=user, recipe=models.OuterRef('pk'))),
+            author_is_subscribed=models.Exists(Subscription.objects.filter(
+                user=user, author=models.OuterRef('author'))),
+        )
+
+    def touch(self):
+        return self.update(updated_at=timezone.now())
+
+    def invalidate_responses(self):
+        scopes = set()
+        for recipe_id, author_id in self.values_list('id', 'author_id'):
+            scopes.update(get_recipe_scopes(recipe_id, author_id))
+        transaction.on_commit(partial(responses.invalidate, *scopes))
+
+    def update_search_index(self):
+        return search.update_index(self)
+
+    def search(self, text):
+        return search.search(self, text)
+
+    def shift_counter(self, field, delta):
+        transaction.on_commit(popularity.invalidate)
+        return self.update(**{field: models.F(field) + delta})
+
+    def recount(self):
+        counters = {
+            'favorites_count': count_recipe_rows(Favorite),
+            'carts_count': count_recipe_rows(Cart),
+        }
+        fixed = self.exclude(**counters).update(**counters)
+        if fixed:
+            transaction.on_commit(popularity.invalidate)
+        return fixed
+
+    def latest_per_author(self, limit):
+        ranked = self.order_by().annotate(recipe_rank=models.Window(
+            expression=RowNumber(), partition_by=models.F('author'),
+            order_by=(models.F('pub_date').desc(), models.F('id').desc()),
+        )).values('id', 'recipe_rank')
+        sql, params = ranked.query.sql_with_params()
+        return self.model.objects.filter(id__in=RawSQL(
+            f'SELECT id FROM ({sql}) ranked WHERE recipe_rank <= %s',
+            (*params, limit)))
+
+
 class Recipe(models.Model):
     text = models.TextField('Описание', unique=True)
     name = models.CharField('Название', max_length=90)
     image = models.ImageField('Изображение', upload_to='recipes/')
+    image_variants = models.JSONField('Уменьшенные копии изображения',
+                                      default=dict, blank=True,
+                                      editable=False)
     tags = models.ManyToManyField(Tag, verbose_name='Теги',
+                                  through='RecipeTag',
                                   related_name='tag_recipes')
-    pub_date = models.DateTimeField('Дата добавления',
-                                    auto_now_add=True, db_index=True)
+    pub_date = models.DateTimeField('Дата добавления', auto_now_add=True)
+    updated_at = models.DateTimeField('Дата изменения', auto_now=True)
     author = models.ForeignKey(User, verbose_name='Автор',
                                on_delete=models.CASCADE,
-                               related_name='recipes')
+                               related_name='recipes', db_index=False)
     cooking_time = models.PositiveSmallIntegerField(
         'Время приготовления рецепта')
+    favorites_count = models.PositiveIntegerField(
+        'Добавлений в избранное', default=0, editable=False)
+    carts_count = models.PositiveIntegerField(
+        'Добавлений в список покупок', default=0, editable=False)
     ingredients = models.ManyToManyField(Ingredient,
                                          through='IngredientRecipe',
                                          verbose_name='Ингредиенты')
+    search_vector = SearchVectorField('Поисковый индекс', null=True,
+                                      editable=False)
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
         ordering = ('-pub_date',)
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
+        indexes = [
+            models.Index(fields=['-pub_date', '-id'],
+                         name='recipe_pub_date_id_idx'),
+            models.Index(fields=['-favorites_count', '-pub_date', '-id'],
+                         name='recipe_popular_idx'),
+            models.Index(fields=['author', '-pub_date', '-id'],
+                         name='recipe_author_pub_date_idx'),
+            models.Index(fields=['updated_at', 'id'],
+                         name='recipe_updated_at_idx'),
+        ]
+
+    # Поля обновляются запросами в обход экземпляра, поэтому сохранение
+    # загруженного ранее рецепта не должно их перезаписывать.
+    DERIVED_FIELDS = ('favorites_count', 'carts_count', 'image_variants',
+                      'search_vector')
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            skipped = {*self.DERIVED_FIELDS, *self.get_deferred_fields()}
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in skipped]
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.name[:settings.LIMIT_VIEW_SYMBOLS]
 
 
+class RecipeTag(models.Model):
+    recipe = models.ForeignKey(Recipe, verbose_name='Рецепт',
+                               on_delete=models.CASCADE,
+                               related_name='recipe_tags', db_index=False)
+    tag = models.ForeignKey(Tag, verbose_name='Тег',
+                            on_delete=models.CASCADE,
+                            related_name='recipe_tags', db_index=False)
+
+    class Meta:
+        db_table = 'recipes_recipe_tags'
+        verbose_name = 'Рецепт и Тег'
+        verbose_name_plural = 'Рецепты и Теги'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['recipe', 'tag'],
+                name='recipe_tag_unique'
+            )
+        ]
+        indexes = [
+            models.Index(fields=['tag', 'recipe'],
+                         name='recipe_tag_tag_recipe_idx'),
+        ]
+
+    def __str__(self):
+        return f'Рецепт {self.recipe} Тег {self.tag}'
+
+
 class IngredientRecipe(models.Model):
     amount = models.PositiveSmallIntegerField(
         'Количество ингредиентов в рецепте')
     recipe = models.ForeignKey(Recipe, verbose_name='Рецепт',
                                on_delete=models.CASCADE,
-                               related_name='recipe_ingredients')
+                               related_name='recipe_ingredients',
+                               db_index=False)
     ingredient = models.ForeignKey(
         Ingredient, verbose_name='Ингредиент', on_delete=models.CASCADE,
         related_name='recipe_ingredients')
@@ -86,37 +232,194 @@ class IngredientRecipe(models.Model):
         return f'Рецепт {self.recipe} Ингредиент {self.ingredient}'
 
 
+class CartQuerySet(RelationQuerySet):
+    def add(self, user, **values):
+        inserted = super().add(user, **values)
+        if inserted:
+            ShoppingListItem.objects.add_carts(
+                self.filter(user=user, **values))
+        return inserted
+
+    def remove(self, user, **values):
+        if values:
+            ShoppingListItem.objects.remove_carts(
+                self.filter(user=user, **values))
+        else:
+            ShoppingListItem.objects.filter(user=user).delete()
+        return super().remove(user, **values)
+
+    def add_many(self, user, field, values):
+        added = super().add_many(user, field, values)
+        if added:
+            ShoppingListItem.objects.add_carts(
+                self.filter(user=user, **{f'{field}__in': added}))
+        return added
+
+    def set_servings(self, user, recipe_id, servings):
+        carts = self.filter(user=user, recipe_id=recipe_id)
+        current = carts.select_for_update().values_list(
+            'servings', flat=True).first()
+        if current is not None and current != servings:
+            carts.update(servings=servings)
+            ShoppingListItem.objects.shift(carts, servings - current)
+            self.touch_users(user.id)
+        return current
+
+
 class Cart(models.Model):
     user = models.ForeignKey(User, verbose_name='Кому принадлежат покупки',
-                             on_delete=models.CASCADE, related_name='carts')
+                             on_delete=models.CASCADE, related_name='carts',
+                             db_index=False)
     recipe = models.ForeignKey(Recipe, verbose_name='Рецепт',
                                on_delete=models.CASCADE, related_name='carts')
+    servings = models.PositiveSmallIntegerField('Множитель порций',
+                                                default=1)
 
-    def clean(self):
-        if Cart.objects.filter(user=self.user, recipe=self.recipe).exists():
-            raise ValidationError('Рецепт уже есть в корзине')
-
-    def save(self, *args, **kwargs):
-        self.full_clean()
-        return super().save(*args, **kwargs)
+    objects = CartQuerySet.as_manager()
+    user_watermark = 'cart_updated_at'
 
     class Meta:
         ordering = ('-id',)
         verbose_name = 'Список покупок'
         verbose_name_plural = 'Списки покупок'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'recipe'],
+                name='cart_recipe_user_unique'
+            )
+        ]
 
     def __str__(self):
         return f'Рецепт {self.recipe} Пользователь {self.user}'
 
 
+CART_SERVINGS = models.F('recipe__carts__servings')
+
+# Авторы, чьи рецепты уже вычтены из списков покупок перед удалением.
+released = threading.local()
+
+
+def get_cart_totals(servings, **lookups):
+    return IngredientRecipe.objects.filter(**lookups).order_by().values(
+        'recipe__carts__user', 'ingredient').annotate(total=models.Sum(
+            models.ExpressionWrapper(models.F('amount') * servings,
+                                     output_field=models.IntegerField())))
+
+
+class ShoppingListQuerySet(models.QuerySet):
+    # Вклад корзин в список покупок: количество ингредиента умножается
+    # на servings (выражение или число), отрицательное значение вычитает.
+    def shift(self, carts, servings, ingredient_ids=None):
+        lookups = {'recipe__carts__in': carts.values('id')}
+        if ingredient_ids is not None:
+            lookups['ingredient__in'] = ingredient_ids
+        totals = list(get_cart_totals(servings, **lookups).values_list(
+            'recipe__carts__user', 'ingredient', 'total'))
+        if not totals:
+            return 0
+        self.bulk_create(
+            (self.model(user_id=user_id, ingredient_id=ingredient_id,
+                        amount=0)
+             for user_id, ingredient_id, total in totals if total > 0),
+            ignore_conflicts=True)
+        items = self.filter(
+            user__in={user_id for user_id, _, _ in totals},
+            ingredient__in={ingredient_id for _, ingredient_id, _ in totals})
+        delta = get_cart_totals(
+            servings, recipe__carts__user=models.OuterRef('user'),
+            ingredient=models.OuterRef('ingredient'), **lookups).values(
+            'total')
+        updated = items.update(amount=models.F('amount') + Coalesce(
+            models.Subquery(delta), 0))
+        if any(total < 0 for _, _, total in totals):
+            items.filter(amount__lte=0).delete()
+        return updated
+
+    def add_carts(self, carts, ingredient_ids=None):
+        return self.shift(carts, CART_SERVINGS, ingredient_ids)
+
+    def remove_carts(self, carts, ingredient_ids=None):
+        return self.shift(carts, -CART_SERVINGS, ingredient_ids)
+
+    def release_recipe(self, recipe):
+        if recipe.author_id in getattr(released, 'authors', ()):
+            return 0
+        return self.remove_carts(Cart.objects.filter(recipe=recipe))
+
+    # Удаление автора: корзины со всеми его рецептами вычитаются одним
+    # сдвигом, а не в pre_delete каждого рецепта.
+    @contextmanager
+    def release_author(self, author):
+        self.remove_carts(Cart.objects.filter(recipe__author=author))
+        released.authors = {author.id}
+        try:
+            yield
+        finally:
+            released.authors = set()
+
+    def rebuild(self, user_ids, check=False):
+        expected = {
+            (user_id, ingredient_id): total
+            for user_id, ingredient_id, total in get_cart_totals(
+                CART_SERVINGS, recipe__carts__user__in=user_ids).values_list(
+                'recipe__carts__user', 'ingredient', 'total')
+            if total > 0
+        }
+        stale, changed = [], []
+        for item in self.filter(user__in=user_ids):
+            total = expected.pop((item.user_id, item.ingredient_id), None)
+            if total is None:
+                stale.append(item.id)
+            elif item.amount != total:
+                item.amount = total
+                changed.append(item)
+        missing = [self.model(user_id=user_id, ingredient_id=ingredient_id,
+                              amount=total)
+                   for (user_id, ingredient_id), total in expected.items()]
+        if not check:
+            with transaction.atomic():
+                self.filter(id__in=stale).delete()
+                self.bulk_update(changed, ('amount',))
+                self.bulk_create(missing)
+        return len(stale) + len(changed) + len(missing)
+
+
+class ShoppingListItem(models.Model):
+    user = models.ForeignKey(User, verbose_name='Пользователь',
+                             on_delete=models.CASCADE,
+                             related_name='shopping_list', db_index=False)
+    ingredient = models.ForeignKey(Ingredient, verbose_name='Ингредиент',
+                                   on_delete=models.CASCADE,
+                                   related_name='shopping_list')
+    amount = models.IntegerField('Количество')
+
+    objects = ShoppingListQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Ингредиент списка покупок'
+        verbose_name_plural = 'Ингредиенты списков покупок'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='shopping_list_user_ingredient_unique'
+            )
+        ]
+
+    def __str__(self):
+        return f'Ингредиент {self.ingredient} Пользователь {self.user}'
+
+
 class Favorite(models.Model):
     user = models.ForeignKey(User, verbose_name='Пользователь',
                              on_delete=models.CASCADE,
-                             related_name='favorites')
+                             related_name='favorites', db_index=False)
     recipe = models.ForeignKey(Recipe, verbose_name='Рецепт',
                                on_delete=models.CASCADE,
                                related_name='favorites')
 
+    objects = RelationQuerySet.as_manager()
+    user_watermark = 'favorites_updated_at'
+
     class Meta:
         verbose_name = 'Избранное'
         verbose_name_plural = 'Избранные'
@@ -129,3 +432,28 @@ class Favorite(models.Model):
 
     def __str__(self):
         return f'Рецепт {self.recipe} Пользователь {self.user}'
+
+
+class Recommendation(models.Model):
+    user = models.ForeignKey(User, verbose_name='Пользователь',
+                             on_delete=models.CASCADE,
+                             related_name='recommendations', db_index=False)
+    recipe = models.ForeignKey(Recipe, verbose_name='Рецепт',
+                               on_delete=models.CASCADE,
+                               related_name='recommendations')
+    position = models.PositiveSmallIntegerField('Позиция')
+    score = models.FloatField('Оценка')
+
+    class Meta:
+        ordering = ('user', 'position')
+        verbose_name = 'Рекомендация'
+        verbose_name_plural = 'Рекомендации'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'position'],
+                name='recommendation_user_position_unique'
+            )
+        ]
+
+    def __str__(self):
+        return f'Рецепт {self.recipe} Пользователь {self.user}'
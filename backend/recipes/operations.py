@@ -0,0 +1,28 @@
+from django.db import migrations
+
+
+# RunSQL для одной СУБД: на остальных операция ничего не делает, но
+# остаётся в истории миграций и видна в sqlmigrate.
+class RunVendorSQL(migrations.RunSQL):
+    def __init__(self, vendor, *args, **kwargs):
+        self.vendor = vendor
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, args, kwargs = super().deconstruct()
+        return name, args, {'vendor': self.vendor, **kwargs}
+
+    def describe(self):
+        return f'Raw SQL operation for {self.vendor}'
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        if schema_editor.connection.vendor == self.vendor:
+            super().database_forwards(app_label, schema_editor, from_state,
+                                      to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        if schema_editor.connection.vendor == self.vendor:
+            super().database_backwards(app_label, schema_editor,
+                                       from_state, to_state)
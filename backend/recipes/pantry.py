@@ -0,0 +1,138 @@
+import heapq
+import logging
+import threading
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+
+from backend import routers
+from backend.caches import is_shared
+from recipes.models import IngredientRecipe
+
+SEQUENCE_KEY = 'pantry:sequence'
+CHANGE_KEY = 'pantry:change'
+CHANGE_TIMEOUT = 60 * 60 * 24
+# При большем числе изменений дешевле перечитать индекс целиком.
+MAX_CHANGES = 1000
+CHUNK_SIZE = 10000
+
+logger = logging.getLogger(__name__)
+
+
+def get_cache():
+    return caches[settings.REFERENCE_DATA_CACHE]
+
+
+# Инвертированный индекс «ингредиент -> рецепты» в памяти процесса.
+# Записи рецептов публикуют номера изменённых рецептов в общем кеше,
+# каждый процесс применяет их к своей копии при следующем запросе.
+class PantryIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = None
+        self.sizes = {}
+        self.sequence = 0
+
+    def record(self, *recipe_ids):
+        cache = get_cache()
+        cache.add(SEQUENCE_KEY, 0, None)
+        try:
+            sequence = cache.incr(SEQUENCE_KEY)
+        except ValueError:
+            return
+        cache.set(f'{CHANGE_KEY}:{sequence}', recipe_ids, CHANGE_TIMEOUT)
+
+    def load(self):
+        # Без общего кеша изменения из других воркеров сюда не дойдут.
+        if not is_shared(settings.REFERENCE_DATA_CACHE):
+            self.rebuild()
+            return
+        cache = get_cache()
+        cache.add(SEQUENCE_KEY, 0, None)
+        sequence = cache.get(SEQUENCE_KEY, 0)
+        if self.postings is None or sequence < self.sequence or (
+                sequence - self.sequence > MAX_CHANGES):
+            self.rebuild()
+        elif sequence > self.sequence:
+            keys = [f'{CHANGE_KEY}:{number}'
+                    for number in range(self.sequence + 1, sequence + 1)]
+            changes = cache.get_many(keys)
+            if len(changes) < len(keys):
+                self.rebuild()
+            else:
+                self.apply({recipe_id for recipe_ids in changes.values()
+                            for recipe_id in recipe_ids})
+        self.sequence = sequence
+
+    def rebuild(self):
+        postings = defaultdict(lambda: array('I'))
+        sizes = Counter()
+        rows = IngredientRecipe.objects.order_by(
+            'ingredient_id', 'recipe_id').values_list(
+            'ingredient_id', 'recipe_id').iterator(chunk_size=CHUNK_SIZE)
+        for ingredient_id, recipe_id in rows:
+            postings[ingredient_id].append(recipe_id)
+            sizes[recipe_id] += 1
+        self.postings = dict(postings)
+        self.sizes = dict(sizes)
+
+    def apply(self, recipe_ids):
+        for recipe_id in recipe_ids:
+            self.sizes.pop(recipe_id, None)
+        for posting in self.postings.values():
+            for recipe_id in recipe_ids:
+                position = bisect_left(posting, recipe_id)
+                if position < len(posting) and posting[position] == recipe_id:
+                    del posting[position]
+        rows = IngredientRecipe.objects.filter(
+            recipe_id__in=recipe_ids).values_list('ingredient_id',
+                                                  'recipe_id')
+        for ingredient_id, recipe_id in rows:
+            insort(self.postings.setdefault(ingredient_id, array('I')),
+                   recipe_id)
+            self.sizes[recipe_id] = self.sizes.get(recipe_id, 0) + 1
+
+    def warm(self):
+        with self.lock, routers.primary():
+            self.load()
+
+    def match(self, ingredient_ids, limit):
+        with self.lock, routers.primary():
+            self.load()
+            matched = Counter()
+            for ingredient_id in ingredient_ids:
+                matched.update(self.postings.get(ingredient_id, ()))
+            sizes = self.sizes
+            return heapq.nlargest(
+                limit,
+                ((recipe_id, count / sizes[recipe_id], count)
+                 for recipe_id, count in matched.items()),
+                key=lambda item: (item[1], item[2], item[0]))
+
+
+index = PantryIndex()
+
+
+# Индекс строится в фоне при запуске воркера, а не на первом запросе:
+# запросы, пришедшие раньше, ждут его на блокировке индекса.
+def warm_up():
+    def warm():
+        try:
+            index.warm()
+        except Exception:
+            logger.exception('Не удалось построить индекс «что приготовить»')
+        finally:
+            connection.close()
+
+    threading.Thread(target=warm, name='pantry-warm-up', daemon=True).start()
+
+
+def record_changes(recipe_ids):
+    recipe_ids = tuple(recipe_ids)
+    if recipe_ids:
+        transaction.on_commit(partial(index.record, *recipe_ids))
@@ -0,0 +1,153 @@
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from scipy import sparse
+
+from recipes.models import (Favorite, Recipe, RecipeTag, Recommendation,
+                            Tag)
+from users.models import Subscription, User
+
+BATCH_SIZE = 1000
+# Сколько самых похожих рецептов хранится для каждого рецепта.
+NEIGHBORS = 50
+# Популярные рецепты добавляются в кандидаты всем пользователям, чтобы у
+# новых пользователей тоже были рекомендации.
+POPULAR_CANDIDATES = 100
+WEIGHTS = {
+    'similar': 0.5,
+    'authors': 0.2,
+    'tags': 0.2,
+    'popular': 0.1,
+}
+
+
+def load_ids(queryset):
+    return np.fromiter(queryset.order_by('id').values_list('id', flat=True),
+                       dtype=np.int64)
+
+
+def load_matrix(queryset, row_field, column_field, rows, columns):
+    pairs = np.array(list(queryset.values_list(row_field, column_field)),
+                     dtype=np.int64).reshape(-1, 2)
+    return sparse.csr_matrix(
+        (np.ones(len(pairs), dtype=np.float32),
+         (np.searchsorted(rows, pairs[:, 0]),
+          np.searchsorted(columns, pairs[:, 1]))),
+        shape=(len(rows), len(columns)))
+
+
+def normalize_rows(matrix):
+    totals = np.asarray(matrix.sum(axis=1)).ravel()
+    totals[totals == 0] = 1
+    return sparse.diags(1 / totals) @ matrix
+
+
+def top_per_row(matrix, limit):
+    matrix = matrix.tocsr()
+    rows, columns, values = [], [], []
+    for row in range(matrix.shape[0]):
+        start, end = matrix.indptr[row], matrix.indptr[row + 1]
+        data = matrix.data[start:end]
+        top = np.argsort(-data, kind='stable')[:limit]
+        rows.append(np.full(len(top), row))
+        columns.append(matrix.indices[start:end][top])
+        values.append(data[top])
+    if not rows:
+        return sparse.csr_matrix(matrix.shape, dtype=np.float32)
+    return sparse.csr_matrix(
+        (np.concatenate(values),
+         (np.concatenate(rows), np.concatenate(columns))),
+        shape=matrix.shape)
+
+
+def get_similar_recipes(favorites):
+    # Косинусная близость рецептов по совместному добавлению в избранное.
+    popularity = np.asarray(favorites.sum(axis=0)).ravel()
+    popularity[popularity == 0] = 1
+    scaled = (favorites @ sparse.diags(1 / np.sqrt(popularity))).tocsc()
+    blocks = []
+    for start in range(0, scaled.shape[1], BATCH_SIZE):
+        block = (scaled[:, start:start + BATCH_SIZE].T @ scaled).tocoo()
+        keep = block.row + start != block.col
+        block = sparse.csr_matrix(
+            (block.data[keep], (block.row[keep], block.col[keep])),
+            shape=block.shape)
+        blocks.append(top_per_row(block, NEIGHBORS))
+    if not blocks:
+        return sparse.csr_matrix((0, 0), dtype=np.float32)
+    return sparse.vstack(blocks).tocsr()
+
+
+class RecommendationBuilder:
+    def __init__(self):
+        self.users = load_ids(User.objects)
+        self.recipes = load_ids(Recipe.objects)
+        tags = load_ids(Tag.objects)
+        self.favorites = load_matrix(Favorite.objects, 'user_id',
+                                     'recipe_id', self.users, self.recipes)
+        self.subscriptions = load_matrix(Subscription.objects, 'user_id',
+                                         'author_id', self.users, self.users)
+        self.authors = load_matrix(Recipe.objects, 'author_id', 'id',
+                                   self.users, self.recipes)
+        self.recipe_tags = normalize_rows(load_matrix(
+            RecipeTag.objects, 'recipe_id', 'tag_id', self.recipes, tags))
+        self.similar = get_similar_recipes(self.favorites)
+        popularity = np.log1p(np.asarray(
+            self.favorites.sum(axis=0)).ravel())
+        self.popular = np.argsort(-popularity, kind='stable')[
+            :POPULAR_CANDIDATES]
+        self.popularity = popularity[self.popular] / max(
+            popularity.max(initial=0), 1)
+
+    def score(self, start, end):
+        favorites = self.favorites[start:end]
+        similar = favorites @ self.similar
+        peaks = similar.max(axis=1).toarray().ravel()
+        peaks[peaks == 0] = 1
+        similar = sparse.diags(1 / peaks) @ similar
+        followed = self.subscriptions[start:end] @ self.authors
+        followed.data[:] = 1
+        popular = sparse.csr_matrix(
+            (np.tile(self.popularity, end - start),
+             (np.repeat(np.arange(end - start), len(self.popular)),
+              np.tile(self.popular, end - start))),
+            shape=similar.shape)
+        scores = (WEIGHTS['similar'] * similar
+                  + WEIGHTS['authors'] * followed
+                  + WEIGHTS['popular'] * popular).tocsr()
+        excluded = favorites + self.authors[start:end]
+        scores = (scores - scores.multiply(excluded > 0)).tocsr()
+        scores.eliminate_zeros()
+        scores = scores.tocoo()
+        user_tags = normalize_rows(favorites @ self.recipe_tags).toarray()
+        affinity = np.asarray(self.recipe_tags[scores.col].multiply(
+            user_tags[scores.row]).sum(axis=1)).ravel()
+        scores = sparse.csr_matrix(
+            (scores.data + WEIGHTS['tags'] * affinity,
+             (scores.row, scores.col)), shape=scores.shape)
+        scores.eliminate_zeros()
+        return top_per_row(scores, settings.RECOMMENDATIONS_LIMIT).tocoo()
+
+    def build(self):
+        created = 0
+        for start in range(0, len(self.users), BATCH_SIZE):
+            end = min(start + BATCH_SIZE, len(self.users))
+            scores = self.score(start, end)
+            order = np.lexsort((-scores.data, scores.row))
+            rows = scores.row[order]
+            positions = np.arange(len(rows)) - np.searchsorted(rows, rows)
+            recommendations = [
+                Recommendation(user_id=int(self.users[start + row]),
+                               recipe_id=int(self.recipes[column]),
+                               position=int(position) + 1,
+                               score=float(value))
+                for row, column, value, position in zip(
+                    rows, scores.col[order], scores.data[order], positions)
+            ]
+            with transaction.atomic():
+                Recommendation.objects.filter(
+                    user_id__in=self.users[start:end].tolist()).delete()
+                Recommendation.objects.bulk_create(recommendations,
+                                                   batch_size=BATCH_SIZE)
+            created += len(recommendations)
+        return created
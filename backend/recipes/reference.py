@@ -0,0 +1,70 @@
+import threading
+from bisect import bisect_left
+
+from backend import routers
+from recipes.models import Ingredient, Tag
+from recipes.versions import CacheVersion
+
+
+class Snapshot:
+    def __init__(self, version, items):
+        self.version = version
+        self.etag = f'"{version}"'
+        self.items = items
+        self.by_id = {item['id']: item for item in items}
+        self.names = sorted((item['name'].upper(), item['id'])
+                            for item in items)
+
+    def startswith(self, prefix, limit):
+        prefix = prefix.upper()
+        results = []
+        position = bisect_left(self.names, (prefix,))
+        for name, pk in self.names[position:position + limit]:
+            if not name.startswith(prefix):
+                break
+            results.append(self.by_id[pk])
+        return results
+
+
+class ReferenceData:
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = fields
+        self.version = CacheVersion(f'reference:{model._meta.label_lower}')
+        self.lock = threading.Lock()
+        self.snapshot = None
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def invalidate(self):
+        self.version.invalidate()
+
+    # Снимок может отставать от базы до сброса версии после коммита:
+    # недостающие записи дочитываются из базы.
+    def get_many(self, ids):
+        snapshot = self.load()
+        items = {pk: snapshot.by_id[pk] for pk in ids if pk in snapshot.by_id}
+        missing = set(ids) - set(items)
+        if missing:
+            rows = self.model.objects.filter(id__in=missing).values(
+                *self.fields)
+            items.update((item['id'], item) for item in rows)
+        return items
+
+    def get(self, pk):
+        return self.get_many([pk]).get(pk)
+
+    def load(self):
+        version = self.version.get()
+        with self.lock:
+            if self.snapshot is None or self.snapshot.version != version:
+                with routers.primary():
+                    self.snapshot = Snapshot(version, list(
+                        self.model.objects.order_by('id').values(
+                            *self.fields)))
+            return self.snapshot
+
+
+tags = ReferenceData(Tag, ('id', 'name', 'color', 'slug'))
+ingredients = ReferenceData(Ingredient, ('id', 'name', 'measurement_unit'))
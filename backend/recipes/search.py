@@ -0,0 +1,107 @@
+import re
+
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector)
+from django.db import connections
+from django.db.models import F, OuterRef, Q, Subquery
+from django.db.models.expressions import RawSQL
+
+SEARCH_CONFIG = 'russian'
+SEARCH_ORDERING = ('-search_rank', '-pub_date', '-id')
+
+FTS_TABLE = 'recipes_recipe_search'
+# unicode61 не снимает диакритику с кириллицы, поэтому «ё» заменяется
+# на «е» и в индексе, и в запросе.
+SQLITE_FOLD_SQL = "replace(replace({}, 'ё', 'е'), 'Ё', 'Е')"
+SQLITE_UPDATE_SQL = (
+    f'INSERT OR REPLACE INTO {FTS_TABLE} (rowid, name, text, ingredients) '
+    'SELECT recipe.id, '
+    + SQLITE_FOLD_SQL.format('recipe.name') + ', '
+    + SQLITE_FOLD_SQL.format('recipe.text') + ', (SELECT '
+    + SQLITE_FOLD_SQL.format("group_concat(ingredient.name, ' ')")
+    + ' FROM {through} item '
+    'JOIN {ingredient} ingredient ON ingredient.id = item.ingredient_id '
+    'WHERE item.recipe_id = recipe.id) '
+    'FROM {recipe} recipe WHERE recipe.id IN ({ids})'
+)
+# Веса колонок совпадают с весами A, B и C в ts_rank.
+SQLITE_RANK_SQL = (
+    f'SELECT -bm25({FTS_TABLE}, 1.0, 0.4, 0.2) FROM {FTS_TABLE} '
+    f'WHERE {FTS_TABLE} MATCH %s AND rowid = {{recipe}}.id'
+)
+SQLITE_MATCH_SQL = f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s'
+
+# У SQLite нет русского стеммера: окончания отрезаются заранее, а основа
+# ищется как префикс.
+ENDINGS = sorted((
+    'иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ой',
+    'ей', 'ом', 'ем', 'ах', 'ях', 'ов', 'ев', 'ам', 'ям', 'ую', 'юю', 'ая',
+    'яя', 'ое', 'ее', 'ые', 'ие', 'ый', 'ий', 'а', 'я', 'о', 'е', 'ы', 'и',
+    'у', 'ю', 'ь',
+), key=len, reverse=True)
+MIN_STEM_LENGTH = 3
+
+
+def get_tables(model, connection):
+    tables = {
+        'recipe': model,
+        'through': model.ingredients.through,
+        'ingredient': model.ingredients.field.related_model,
+    }
+    return {name: connection.ops.quote_name(table._meta.db_table)
+            for name, table in tables.items()}
+
+
+def update_index(queryset):
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        names = queryset.model.ingredients.through.objects.filter(
+            recipe=OuterRef('pk')).order_by().values('recipe').annotate(
+            names=StringAgg('ingredient__name', ' ')).values('names')
+        return queryset.update(search_vector=(
+            SearchVector('name', weight='A', config=SEARCH_CONFIG)
+            + SearchVector('text', weight='B', config=SEARCH_CONFIG)
+            + SearchVector(Subquery(names), weight='C', config=SEARCH_CONFIG)
+        ))
+    if connection.vendor != 'sqlite':
+        return 0
+    ids, params = queryset.order_by().values('id').query.sql_with_params()
+    tables = get_tables(queryset.model, connection)
+    with connection.cursor() as cursor:
+        cursor.execute(SQLITE_UPDATE_SQL.format(ids=ids, **tables), params)
+        return cursor.rowcount
+
+
+def stem(word):
+    for ending in ENDINGS:
+        base = word[:-len(ending)]
+        if word.endswith(ending) and len(base) >= MIN_STEM_LENGTH:
+            return base
+    return word
+
+
+def get_match_query(text):
+    words = re.findall(r'\w+', text.lower().replace('ё', 'е'))
+    return ' '.join(f'"{stem(word)}"*' for word in words)
+
+
+def search(queryset, text):
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        query = SearchQuery(text, config=SEARCH_CONFIG,
+                            search_type='websearch')
+        return queryset.filter(search_vector=query).annotate(
+            search_rank=SearchRank(F('search_vector'), query)).order_by(
+            *SEARCH_ORDERING)
+    if connection.vendor != 'sqlite':
+        return queryset.filter(
+            Q(name__icontains=text) | Q(text__icontains=text))
+    match = get_match_query(text)
+    if not match:
+        return queryset.none()
+    tables = get_tables(queryset.model, connection)
+    return queryset.filter(
+        id__in=RawSQL(SQLITE_MATCH_SQL, (match,))).annotate(
+        search_rank=RawSQL(SQLITE_RANK_SQL.format(**tables),
+                           (match,))).order_by(*SEARCH_ORDERING)
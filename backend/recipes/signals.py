@@ -0,0 +1,95 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from recipes import pantry, reference
+from recipes.images import schedule_variants
+from recipes.versions import get_recipe_scopes, responses
+from recipes.models import Ingredient, Recipe, ShoppingListItem, Tag
+from users.models import User
+
+USER_DISPLAY_FIELDS = {'email', 'username', 'first_name', 'last_name'}
+
+
+@receiver((post_save, post_delete), sender=Tag)
+def invalidate_tags(**kwargs):
+    transaction.on_commit(reference.tags.invalidate)
+
+
+@receiver((post_save, post_delete), sender=Ingredient)
+def invalidate_ingredients(**kwargs):
+    transaction.on_commit(reference.ingredients.invalidate)
+
+
+@receiver((post_save, post_delete), sender=Recipe)
+def invalidate_recipe_responses(instance, **kwargs):
+    transaction.on_commit(partial(
+        responses.invalidate,
+        *get_recipe_scopes(instance.id, instance.author_id)))
+
+
+@receiver(post_delete, sender=Recipe)
+def forget_pantry_recipe(instance, **kwargs):
+    pantry.record_changes([instance.id])
+
+
+@receiver(pre_delete, sender=Recipe)
+def release_shopping_lists(instance, **kwargs):
+    ShoppingListItem.objects.release_recipe(instance)
+
+
+@receiver(post_save, sender=Recipe)
+def process_recipe_image(instance, raw=False, **kwargs):
+    if not raw:
+        schedule_variants(instance)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(pre_delete, sender=Tag)
+def touch_tag_recipes(instance, created=False, **kwargs):
+    if not created:
+        Recipe.objects.filter(tags=instance).touch()
+        transaction.on_commit(partial(responses.invalidate, 'catalog'))
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(pre_delete, sender=Ingredient)
+def touch_ingredient_recipes(instance, created=False, **kwargs):
+    if not created:
+        Recipe.objects.filter(ingredients=instance).touch()
+        transaction.on_commit(partial(responses.invalidate, 'catalog'))
+
+
+@receiver(post_save, sender=Ingredient)
+def reindex_ingredient_recipes(instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        Recipe.objects.filter(ingredients=instance).update_search_index()
+
+
+@receiver(pre_delete, sender=Ingredient)
+def schedule_ingredient_recipes_reindex(instance, **kwargs):
+    recipe_ids = list(Recipe.objects.filter(
+        ingredients=instance).values_list('id', flat=True))
+    transaction.on_commit(
+        Recipe.objects.filter(id__in=recipe_ids).update_search_index)
+    pantry.record_changes(recipe_ids)
+
+
+@receiver(pre_delete, sender=User)
+def release_recipe_counters(instance, **kwargs):
+    Recipe.objects.filter(favorites__user=instance).shift_counter(
+        'favorites_count', -1)
+    Recipe.objects.filter(carts__user=instance).shift_counter(
+        'carts_count', -1)
+
+
+@receiver(post_save, sender=User)
+def touch_author_recipes(instance, created, update_fields, **kwargs):
+    if created or (update_fields
+                   and not USER_DISPLAY_FIELDS.intersection(update_fields)):
+        return
+    Recipe.objects.filter(author=instance).touch()
+    transaction.on_commit(partial(responses.invalidate, 'feed',
+                                  f'author:{instance.id}'))
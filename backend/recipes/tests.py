@@ -0,0 +1,209 @@
+import json
+import shutil
+import tempfile
+from io import StringIO
+from pathlib import Path
+from unittest import mock, skipUnless
+
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+
+from recipes import images
+from recipes.management.commands import add_ingredients
+from recipes.models import (Favorite, Ingredient, IngredientRecipe, Recipe,
+                            Tag)
+from recipes.versions import popularity
+from users.models import User
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+
+class AddIngredientsTests(TestCase):
+    def write(self, name, content):
+        path = Path(MEDIA_ROOT, name)
+        path.write_text(content, encoding='utf-8')
+        return str(path)
+
+    def load(self, path, *args):
+        call_command('add_ingredients', path, *args, stdout=StringIO())
+        return set(Ingredient.objects.values_list('name',
+                                                  'measurement_unit'))
+
+    def test_json_is_idempotent(self):
+        path = self.write('ingredients.json', json.dumps([
+            {'name': 'мука', 'measurement_unit': 'г'},
+            {'name': 'молоко', 'measurement_unit': 'мл'},
+            {'name': 'мука', 'measurement_unit': 'г'}],
+            ensure_ascii=False, indent=2))
+        expected = {('мука', 'г'), ('молоко', 'мл')}
+        # Объекты режутся границами блоков чтения.
+        with mock.patch.object(add_ingredients, 'READ_SIZE', 7):
+            self.assertEqual(self.load(path, '--batch-size', '1'), expected)
+        self.assertEqual(self.load(path), expected)
+
+    def test_csv(self):
+        path = self.write('ingredients.csv', 'мука,г\n\nяйца,шт\n')
+        self.assertEqual(self.load(path), {('мука', 'г'), ('яйца', 'шт')})
+
+    def test_errors(self):
+        with self.assertRaises(CommandError):
+            self.load(self.write('ingredients.txt', ''))
+        with self.assertRaises(CommandError):
+            self.load(self.write('broken.json', '[{"name": "мука"'))
+        with self.assertRaises(CommandError):
+            self.load(self.write('ingredients.csv', ''), '--copy')
+
+
+class RecipeGraphTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        tags = [Tag.objects.create(name=f'Тег {number}', slug=f'tag{number}',
+                                   color=f'#00000{number}')
+                for number in range(2)]
+        ingredients = [
+            Ingredient.objects.create(name=f'Ингредиент {number}',
+                                      measurement_unit='г')
+            for number in range(3)]
+        for number in range(4):
+            author = User.objects.create_user(
+                username=f'author{number}',
+                email=f'author{number}@foodgram.ru',
+                password='Sup3r-secret-pass')
+            recipe = Recipe.objects.create(
+                author=author, name=f'Рецепт {number}',
+                text=f'Описание {number}', image='recipes/test.png',
+                cooking_time=30)
+            recipe.tags.set(tags)
+            for ingredient in ingredients:
+                IngredientRecipe.objects.create(
+                    recipe=recipe, ingredient=ingredient, amount=number + 1)
+
+    def test_with_related_loads_graph_in_fixed_queries(self):
+        with self.assertNumQueries(3):
+            graph = [
+                (recipe.author.username,
+                 [tag.slug for tag in recipe.tags.all()],
+                 [(item.ingredient.name, item.amount)
+                  for item in recipe.recipe_ingredients.all()])
+                for recipe in Recipe.objects.with_related()]
+        self.assertEqual(len(graph), 4)
+        for _, tags, ingredients in graph:
+            self.assertEqual(sorted(tags), ['tag0', 'tag1'])
+            self.assertEqual(len(ingredients), 3)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'План запроса в формате SQLite')
+class IndexUsageTests(TestCase):
+    def get_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return ' '.join(row[3] for row in cursor.fetchall())
+
+    def test_feed_filters_use_composite_indexes(self):
+        recipes = Recipe.objects.order_by('-pub_date', '-id')
+        for queryset, index in (
+                (recipes.filter(author_id=1), 'recipe_author_pub_date_idx'),
+                (recipes.filter(recipe_tags__tag__slug='breakfast'),
+                 'recipe_tag_tag_recipe_idx'),
+                (recipes.filter(favorites__user_id=1),
+                 'sqlite_autoindex_recipes_favorite_1'),
+                (Recipe.objects.filter(updated_at__gt=timezone.now())
+                 .order_by('updated_at', 'id'), 'recipe_updated_at_idx')):
+            with self.subTest(index=index):
+                self.assertIn(f'INDEX {index} ', self.get_plan(queryset))
+
+
+class RecipeCounterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            username='author', email='author@foodgram.ru',
+            password='Sup3r-secret-pass')
+        cls.user = User.objects.create_user(
+            username='cook', email='cook@foodgram.ru',
+            password='Sup3r-secret-pass')
+        cls.recipe = Recipe.objects.create(
+            author=cls.author, name='Блины', text='Описание блинов',
+            image='recipes/test.png', cooking_time=30)
+
+    def test_save_keeps_counters(self):
+        stale = Recipe.objects.get(id=self.recipe.id)
+        Recipe.objects.filter(id=self.recipe.id).shift_counter(
+            'favorites_count', 2)
+        stale.name = 'Оладьи'
+        stale.save()
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.name, 'Оладьи')
+        self.assertEqual(self.recipe.favorites_count, 2)
+
+    def test_recount(self):
+        Favorite.objects.create(user=self.user, recipe=self.recipe)
+        Recipe.objects.filter(id=self.recipe.id).update(carts_count=5)
+        self.assertEqual(Recipe.objects.recount(), 1)
+        self.assertEqual(Recipe.objects.recount(), 0)
+        self.recipe.refresh_from_db()
+        self.assertEqual(
+            (self.recipe.favorites_count, self.recipe.carts_count), (1, 0))
+
+    def test_user_delete_releases_counters(self):
+        Favorite.objects.create(user=self.user, recipe=self.recipe)
+        Recipe.objects.recount()
+        self.user.delete()
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.favorites_count, 0)
+
+    def test_counter_change_bumps_popularity(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            Recipe.objects.filter(id=self.recipe.id).shift_counter(
+                'favorites_count', 1)
+        self.assertIn(popularity.invalidate, callbacks)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class ImageVariantsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(
+            username='author', email='author@foodgram.ru',
+            password='Sup3r-secret-pass')
+        cls.recipes = []
+        for number in range(3):
+            image = Path(MEDIA_ROOT, 'recipes', f'test_{number}.png')
+            image.parent.mkdir(exist_ok=True)
+            Image.new('RGB', (64, 64), '#E26C2D').save(image)
+            cls.recipes.append(Recipe.objects.create(
+                author=author, name=f'Рецепт {number}',
+                text=f'Описание {number}',
+                image=f'recipes/test_{number}.png', cooking_time=30))
+
+    def test_command_keeps_connection_with_executor(self):
+        with mock.patch.object(images, 'executor', mock.Mock()), \
+                mock.patch.object(images, 'connection') as connection:
+            call_command('build_image_variants', stdout=StringIO())
+        connection.close.assert_not_called()
+        for recipe in self.recipes:
+            recipe.refresh_from_db()
+            self.assertEqual(set(images.get_variants(recipe)),
+                             set(images.VARIANTS))
+
+    def test_worker_closes_connection(self):
+        recipe = self.recipes[0]
+        executor = mock.Mock()
+        with mock.patch.object(images, 'executor', executor):
+            with self.captureOnCommitCallbacks(execute=True):
+                images.schedule_variants(recipe)
+        executor.submit.assert_called_once_with(
+            images.process_image_in_worker, recipe.id, recipe.image.name)
+        with mock.patch.object(images, 'connection') as connection:
+            images.process_image_in_worker(recipe.id, recipe.image.name)
+        connection.close.assert_called_once_with()
+        recipe.refresh_from_db()
+        self.assertTrue(images.get_variants(recipe))
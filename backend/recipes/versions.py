@@ -0,0 +1,71 @@
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+
+from backend.caches import is_shared
+
+
+class CacheVersion:
+    def __init__(self, key, cache_setting='REFERENCE_DATA_CACHE'):
+        self.key = key
+        self.cache_setting = cache_setting
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, self.cache_setting)]
+
+    # Без общего кеша другие воркеры не узнают о сбросе версии: каждый
+    # вызов получает новую, и закешированное по старой не используется.
+    def get(self):
+        if not is_shared(getattr(settings, self.cache_setting)):
+            return uuid4().hex
+        version = self.cache.get(self.key)
+        if version is None:
+            self.cache.add(self.key, uuid4().hex, None)
+            version = self.cache.get(self.key)
+        return version
+
+    def invalidate(self):
+        self.cache.set(self.key, uuid4().hex, None)
+
+
+# Версии частей кеша ответов: запись сбрасывает только зависящие от
+# неё записи. catalog входит во все ключи и меняется вместе с тегами и
+# ингредиентами, feed — со списком всех рецептов, recipe:<id> — с
+# карточкой рецепта, author:<id> — с данными автора, а
+# author-recipes:<id> — со списком его рецептов.
+class ScopedVersions:
+    def __init__(self, prefix, cache_setting):
+        self.prefix = prefix
+        self.cache_setting = cache_setting
+
+    @property
+    def cache(self):
+        return caches[getattr(settings, self.cache_setting)]
+
+    def get(self, *scopes):
+        if not is_shared(getattr(settings, self.cache_setting)):
+            return tuple(uuid4().hex for _ in scopes)
+        keys = [f'{self.prefix}:{scope}' for scope in scopes]
+        versions = self.cache.get_many(keys)
+        missing = [key for key in keys if key not in versions]
+        if missing:
+            for key in missing:
+                self.cache.add(key, uuid4().hex, None)
+            versions.update(self.cache.get_many(missing))
+        return tuple(versions[key] for key in keys)
+
+    def invalidate(self, *scopes):
+        self.cache.set_many({f'{self.prefix}:{scope}': uuid4().hex
+                             for scope in scopes}, None)
+
+
+def get_recipe_scopes(recipe_id, author_id):
+    return ('feed', f'recipe:{recipe_id}', f'author-recipes:{author_id}')
+
+
+responses = ScopedVersions('responses:version', 'RESPONSE_CACHE')
+# Меняется вместе со счётчиками избранного: порядок ?ordering=popular
+# зависит от них, а не от даты изменения рецептов.
+popularity = CacheVersion('recipes:popularity', 'RESPONSE_CACHE')
@@ -3,7 +3,23 @@ from django.contrib.auth.admin import UserAdmin
 
 from users.models import Subscription, User
 
-admin.site.register(Subscription)
+
+class RelationAdmin(admin.ModelAdmin):
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        self.model.objects.touch_users(obj.user_id, form.initial.get('user'))
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        self.model.objects.touch_users(obj.user_id)
+
+    def delete_queryset(self, request, queryset):
+        user_ids = set(queryset.values_list('user_id', flat=True))
+        super().delete_queryset(request, queryset)
+        self.model.objects.touch_users(*user_ids)
+
+
+admin.site.register(Subscription, RelationAdmin)
 
 
 @admin.register(User)
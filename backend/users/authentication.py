@@ -0,0 +1,51 @@
+from functools import partial
+from hashlib import sha256
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.authentication import TokenAuthentication
+
+from backend.caches import is_shared
+
+
+def get_cache():
+    return caches[settings.AUTH_TOKEN_CACHE]
+
+
+def get_token_key(key):
+    return f'auth:token:{sha256(key.encode()).hexdigest()}'
+
+
+def get_user_key(user_id):
+    return f'auth:user:{user_id}'
+
+
+def delete_credentials(user_ids):
+    cache = get_cache()
+    user_keys = [get_user_key(user_id) for user_id in user_ids if user_id]
+    if user_keys:
+        token_keys = cache.get_many(user_keys).values()
+        cache.delete_many([*user_keys, *token_keys])
+
+
+def invalidate_users(*user_ids):
+    transaction.on_commit(partial(delete_credentials, user_ids))
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        # Из локального кеша отозванный токен удалится только в одном
+        # воркере, поэтому без общего кеша токен проверяется в базе.
+        if not is_shared(settings.AUTH_TOKEN_CACHE):
+            return super().authenticate_credentials(key)
+        cache = get_cache()
+        token_key = get_token_key(key)
+        credentials = cache.get(token_key)
+        if credentials is None:
+            credentials = super().authenticate_credentials(key)
+            user, _ = credentials
+            cache.set_many({token_key: credentials,
+                            get_user_key(user.pk): token_key},
+                           settings.AUTH_TOKEN_CACHE_TIMEOUT)
+        return credentials
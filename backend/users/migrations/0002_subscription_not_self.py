@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+def delete_self_subscriptions(apps, schema_editor):
+    Subscription = apps.get_model('users', 'Subscription')
+    Subscription.objects.filter(user=models.F('author')).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_self_subscriptions,
+                             migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='subscription',
+            constraint=models.CheckConstraint(
+                check=~models.Q(user=models.F('author')),
+                name='subscription_not_self'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_subscription_not_self'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='cart_updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата изменения списка покупок'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='favorites_updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата изменения избранного'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='subscriptions_updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата изменения подписок'),
+        ),
+    ]
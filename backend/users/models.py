@@ -1,7 +1,11 @@
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import connections, models
+from django.db.models.sql import InsertQuery
 from django.conf import settings
+from django.utils import timezone
+
+from users.authentication import invalidate_users
 
 
 class User(AbstractUser):
@@ -9,6 +13,12 @@ class User(AbstractUser):
     username = models.CharField('Никнейм', unique=True, max_length=20)
     last_name = models.CharField('Фамилия', max_length=120)
     first_name = models.CharField('Имя', max_length=120)
+    favorites_updated_at = models.DateTimeField(
+        'Дата изменения избранного', default=timezone.now)
+    cart_updated_at = models.DateTimeField(
+        'Дата изменения списка покупок', default=timezone.now)
+    subscriptions_updated_at = models.DateTimeField(
+        'Дата изменения подписок', default=timezone.now)
 
     class Meta:
         verbose_name = 'Пользователь'
@@ -18,14 +28,97 @@ class User(AbstractUser):
         return self.username[:settings.LIMIT_VIEW_SYMBOLS]
 
 
+# Базы, которые возвращают из INSERT с пропуском конфликтов только
+# действительно вставленные строки.
+def can_return_inserted(connection):
+    return connection.vendor == 'postgresql' or (
+        connection.vendor == 'sqlite'
+        and connection.Database.sqlite_version_info >= (3, 35))
+
+
+class RelationQuerySet(models.QuerySet):
+    def get_insert_sql(self, rows):
+        query = InsertQuery(self.model, ignore_conflicts=True)
+        query.insert_values(
+            [field for field in self.model._meta.concrete_fields
+             if not field.primary_key],
+            [self.model(**values) for values in rows])
+        return query.get_compiler(self.db).as_sql()
+
+    def insert_ignore(self, *rows):
+        inserted = 0
+        with connections[self.db].cursor() as cursor:
+            for sql, params in self.get_insert_sql(rows):
+                cursor.execute(sql, params)
+                inserted += cursor.rowcount
+        return inserted
+
+    # Значения поля field у строк, которые вставил именно этот запрос:
+    # строки, добавленные параллельно, сюда не попадают.
+    def insert_ignore_returning(self, field, *rows):
+        connection = connections[self.db]
+        if not can_return_inserted(connection):
+            return [values[field] for values in rows
+                    if self.insert_ignore(values)]
+        column = connection.ops.quote_name(
+            self.model._meta.get_field(field).column)
+        inserted = []
+        with connection.cursor() as cursor:
+            for sql, params in self.get_insert_sql(rows):
+                cursor.execute(f'{sql} RETURNING {column}', params)
+                inserted += [value for value, in cursor.fetchall()]
+        return inserted
+
+    def touch_users(self, *user_ids):
+        invalidate_users(*user_ids)
+        return User.objects.filter(id__in=user_ids).update(
+            **{self.model.user_watermark: timezone.now()})
+
+    def add(self, user, **values):
+        inserted = self.insert_ignore(dict(user=user, **values))
+        if inserted:
+            self.touch_users(user.id)
+        return inserted
+
+    def remove(self, user, **values):
+        deleted, _ = self.filter(user=user, **values).delete()
+        if deleted:
+            self.touch_users(user.id)
+        return deleted
+
+    def get_existing(self, user, field, values):
+        return set(self.filter(user=user, **{f'{field}__in': values})
+                   .values_list(field, flat=True))
+
+    def add_many(self, user, field, values):
+        existing = self.get_existing(user, field, values)
+        added = [value for value in values if value not in existing]
+        if not added:
+            return added
+        inserted = set(self.insert_ignore_returning(
+            field, *({'user': user, field: value} for value in added)))
+        if inserted:
+            self.touch_users(user.id)
+        return [value for value in added if value in inserted]
+
+    def remove_many(self, user, field, values):
+        removed = list(self.get_existing(user, field, values))
+        if removed:
+            self.remove(user, **{f'{field}__in': removed})
+        return removed
+
+
 class Subscription(models.Model):
     user = models.ForeignKey(User, verbose_name='Подписчик',
                              on_delete=models.CASCADE,
-                             related_name='subscriptions')
+                             related_name='subscriptions', db_index=False)
     author = models.ForeignKey(User, verbose_name='Автор',
                                on_delete=models.CASCADE,
                                related_name='author_subscriptions')
 
+    objects = RelationQuerySet.as_manager()
+    user_watermark = 'subscriptions_updated_at'
+
     class Meta:
         verbose_name = 'Подписка'
         verbose_name_plural = 'Подписки'
@@ -33,16 +126,13 @@ class Subscription(models.Model):
             models.UniqueConstraint(
                 fields=['user', 'author'],
                 name='subscription_unique'
-            )
+            ),
+            models.CheckConstraint(
+                check=~models.Q(user=models.F('author')),
+                name='subscription_not_self'
+            ),
         ]
 
     def clean(self):
-        if self.author == self.user:
+        if self.author_id == self.user_id:
             raise ValidationError('Нельзя подписаться на себя')
-        if Subscription.objects.filter(
-                author=self.author, user=self.user).exists():
-            raise ValidationError('Вы уже подписаны')
-
-    def save(self, *args, **kwargs):
-        self.full_clean()
-        return super().save(*args, **kwargs)
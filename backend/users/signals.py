@@ -0,0 +1,16 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from users.authentication import invalidate_users
+from users.models import User
+
+
+@receiver((post_save, post_delete), sender=User)
+def invalidate_user_credentials(instance, **kwargs):
+    invalidate_users(instance.pk)
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_token_credentials(instance, **kwargs):
+    invalidate_users(instance.user_id)